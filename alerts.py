@@ -0,0 +1,445 @@
+"""
+Gemte søgninger: besked når nye mødepunkter matcher en stående søgning.
+
+Efter hver opdatering af view'et matches kun rækkerne med id over vandmærket
+mod alle gemte søgninger i én omgang. I stedet for at køre hver søgning mod
+view'et vendes opgaven om: søgningerne ligger i et indeks over deres ord, og
+hver ny række slår sine ord op i indekset. Kun de (søgning, række)-par, der
+kan matche, tjekkes med @@ i Postgres; træf gemmes i
+sourceview.saved_search_matches (sql/007_saved_searches.sql) og vises i appen.
+
+    python alerts.py add --owner jens@example.dk --municipality Aarhus fjernvarme
+    python alerts.py list --owner jens@example.dk
+    python alerts.py evaluate                       kører ellers efter hver opdatering
+
+Gennemløb for indekset uden database (10.000 gemte søgninger):
+    python alerts.py bench --saved 10000 --docs 5000
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import time
+
+import refresh
+from db import db_cursor
+from search import LIST_COLUMNS, VIEW_NAME
+from tsquery import parse_query
+
+# =====================
+# Saved-search Settings
+# =====================
+SAVED_SEARCHES_TABLE = "sourceview.saved_searches"
+MATCHES_TABLE = "sourceview.saved_search_matches"
+ALERTS_WATERMARK = "saved_search_alerts"  # row in sourceview.rollup_watermark
+ALERTS_CHUNK = int(os.getenv("ALERTS_CHUNK", "2000"))  # new rows matched per round trip
+ALERTS_MAX_PER_OWNER = int(os.getenv("ALERTS_MAX_PER_OWNER", "50"))
+
+# A lexeme in the text form of a tsquery ('ord', 'ord':* or with weights 'ord':AB),
+# a phrase operator (<-> or <N>) or one of & | ! ( )
+TSQUERY_TOKEN_RE = re.compile(r"'((?:[^']|'')*)'(:[*A-Da-d]*)?|<(?:-|\d+)>|[&|!()]")
+
+logger = logging.getLogger(__name__)
+
+
+def _selectivity(anchor_set):
+    """Sort key for anchor sets: fewer lexemes, fewer prefixes, then longer (rarer) words first"""
+    return (len(anchor_set), sum(anchor.endswith(":*") for anchor in anchor_set),
+            -sum(len(anchor) for anchor in anchor_set))
+
+
+def anchors(tsquery_text):
+    """
+    Lexemes of which every matching row contains at least one, from the text
+    form of a tsquery (prefixes end in ":*"), or None when a row can match
+    without any of them (e.g. a pure negation). AND and phrases keep their most
+    selective side; OR needs the lexemes of all its sides.
+    """
+    tokens = [(match.group(0), match) for match in TSQUERY_TOKEN_RE.finditer(tsquery_text)]
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def unary():
+        nonlocal position
+        token, match = tokens[position]
+        position += 1
+        if token == "!":
+            unary()
+            return None
+        if token == "(":
+            result = disjunction()
+            position += 1  # ")"
+            return result
+        word = match.group(1).replace("''", "'")
+        return frozenset([word + ":*" if "*" in (match.group(2) or "") else word])
+
+    def conjunction(operand, is_operator):
+        nonlocal position
+        sides = [operand()]
+        while peek() is not None and is_operator(peek()):
+            position += 1
+            sides.append(operand())
+        anchored = [side for side in sides if side is not None]
+        return min(anchored, key=_selectivity) if anchored else None
+
+    def phrase():
+        return conjunction(unary, lambda token: token.startswith("<"))
+
+    def intersection():
+        return conjunction(phrase, lambda token: token == "&")
+
+    def disjunction():
+        nonlocal position
+        sides = [intersection()]
+        while peek() == "|":
+            position += 1
+            sides.append(intersection())
+        if any(side is None for side in sides):
+            return None
+        return frozenset().union(*sides)
+
+    if not tokens:
+        return None
+    return disjunction()
+
+
+class SavedSearchIndex:
+    """
+    Inverted index from anchor lexemes to saved searches. candidates() returns
+    the saved searches a row can match, from the row's lexemes, without
+    looking at the other searches.
+    """
+
+    def __init__(self, searches):
+        self.exact = {}
+        self.prefixes = {}
+        self.unanchored = []
+        self.municipality = {}
+        for saved in searches:
+            self.municipality[saved["id"]] = saved["municipality"]
+            if saved["anchors"] is None:
+                self.unanchored.append(saved["id"])
+                continue
+            for anchor in saved["anchors"]:
+                if anchor.endswith(":*"):
+                    self.prefixes.setdefault(anchor[:-2], []).append(saved["id"])
+                else:
+                    self.exact.setdefault(anchor, []).append(saved["id"])
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.prefixes})
+
+    def __len__(self):
+        return len(self.municipality)
+
+    def candidates(self, lexemes, municipality=None):
+        """Ids of the saved searches a row with these lexemes (and municipality) can match"""
+        found = set(self.unanchored)
+        for lexeme in self.exact.keys() & set(lexemes):
+            found.update(self.exact[lexeme])
+        if self.prefix_lengths:
+            for lexeme in lexemes:
+                for length in self.prefix_lengths:
+                    if length > len(lexeme):
+                        break
+                    found.update(self.prefixes.get(lexeme[:length], ()))
+        return [saved_id for saved_id in found if self.municipality[saved_id] in (None, municipality)]
+
+
+def _owner_key(owner):
+    return owner.strip().lower()
+
+
+def save_search(owner, query_text, municipality=None):
+    """
+    Save a standing search for `owner`. Only rows added to the view after this
+    are matched. The search box syntax is supported (tsquery.py) and matched
+    exactly, without the loose prefix and similarity matches of the search.
+    Returns the new id; raises ValueError when there is nothing to match.
+    """
+    parsed = parse_query(query_text)
+    if not parsed.match:
+        raise ValueError("The search has no words to match")
+    municipality = None if municipality in (None, "", "Alle") else municipality
+    with db_cursor(commit=True) as cur:
+        cur.execute("SELECT to_tsquery('danish', %s)::text AS match_query", [parsed.match])
+        match_query = cur.fetchone()["match_query"]
+        if not match_query:
+            # Only stop words, which to_tsquery drops
+            raise ValueError("The search has no words to match")
+        anchor_set = anchors(match_query)
+        cur.execute(
+            f"""
+            INSERT INTO {SAVED_SEARCHES_TABLE} (owner, query_text, municipality, match_query, exclude_query, anchors)
+            VALUES (
+                %(owner)s, %(query_text)s, %(municipality)s, %(match_query)s::tsquery,
+                to_tsquery('danish', NULLIF(%(exclude)s, '')), %(anchors)s
+            )
+            RETURNING id
+            """,
+            {
+                "owner": _owner_key(owner),
+                "query_text": query_text,
+                "municipality": municipality,
+                "match_query": match_query,
+                "exclude": parsed.exclude,
+                "anchors": sorted(anchor_set) if anchor_set is not None else None,
+            }
+        )
+        return cur.fetchone()["id"]
+
+
+def delete_search(owner, saved_search_id):
+    """Delete one of the owner's saved searches and its matches"""
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"DELETE FROM {SAVED_SEARCHES_TABLE} WHERE id = %s AND owner = %s",
+                    [saved_search_id, _owner_key(owner)])
+
+
+def list_searches(owner):
+    """The owner's saved searches, newest first, with their number of unseen matches"""
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT s.id, s.query_text, s.municipality, s.created_at,
+                   COUNT(m.item_id) FILTER (WHERE NOT m.seen) AS unseen
+            FROM {SAVED_SEARCHES_TABLE} s
+            LEFT JOIN {MATCHES_TABLE} m ON m.saved_search_id = s.id
+            WHERE s.owner = %s
+            GROUP BY s.id
+            ORDER BY s.created_at DESC
+            """,
+            [_owner_key(owner)]
+        )
+        return cur.fetchall()
+
+
+def unseen_matches(owner, limit=ALERTS_MAX_PER_OWNER):
+    """Result headers of the owner's unseen matches, newest first, with the saved search they matched"""
+    columns = ", ".join(f"v.{column}" for column in LIST_COLUMNS)
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT {columns}, m.saved_search_id, s.query_text, m.matched_at
+            FROM {MATCHES_TABLE} m
+            JOIN {SAVED_SEARCHES_TABLE} s ON s.id = m.saved_search_id
+            JOIN {VIEW_NAME} v ON v.id = m.item_id
+            WHERE s.owner = %s AND NOT m.seen
+            ORDER BY m.matched_at DESC, v.id DESC
+            LIMIT %s
+            """,
+            [_owner_key(owner), limit]
+        )
+        return cur.fetchall()
+
+
+def mark_seen(owner, matches):
+    """
+    Mark the owner's matches as seen, given as (saved_search_id, item_id) pairs:
+    only the ones that were shown, so matches that arrived meanwhile stay new
+    """
+    if not matches:
+        return
+    saved_search_ids, item_ids = zip(*matches)
+    with db_cursor(commit=True) as cur:
+        cur.execute(
+            f"""
+            UPDATE {MATCHES_TABLE} m
+            SET seen = true
+            FROM {SAVED_SEARCHES_TABLE} s,
+                 unnest(%(saved_search_ids)s::bigint[], %(item_ids)s::bigint[]) AS shown(saved_search_id, item_id)
+            WHERE s.id = m.saved_search_id AND s.owner = %(owner)s AND NOT m.seen
+              AND m.saved_search_id = shown.saved_search_id AND m.item_id = shown.item_id
+            """,
+            {"owner": _owner_key(owner), "saved_search_ids": list(saved_search_ids), "item_ids": list(item_ids)}
+        )
+
+
+def _record_matches(cur, index, rows):
+    """
+    Look up the candidate saved searches of each new row in the index and let
+    Postgres check just those pairs with @@. Returns (candidate pairs, matches stored).
+    """
+    pairs = [(saved_id, row["id"]) for row in rows
+             for saved_id in index.candidates(row["lexemes"], row["municipality"])]
+    if not pairs:
+        return 0, 0
+    cur.execute(
+        f"""
+        INSERT INTO {MATCHES_TABLE} (saved_search_id, item_id)
+        SELECT s.id, v.id
+        FROM unnest(%s::bigint[], %s::bigint[]) AS c(saved_search_id, item_id)
+        JOIN {SAVED_SEARCHES_TABLE} s ON s.id = c.saved_search_id
+        JOIN {VIEW_NAME} v ON v.id = c.item_id
+        WHERE v.search_vector @@ s.match_query
+          AND (s.exclude_query IS NULL OR NOT v.search_vector @@ s.exclude_query)
+        ON CONFLICT (saved_search_id, item_id) DO NOTHING
+        """,
+        [[saved_id for saved_id, _ in pairs], [item_id for _, item_id in pairs]]
+    )
+    return len(pairs), cur.rowcount
+
+
+def evaluate_new_rows(generation=None, chunk=ALERTS_CHUNK):
+    """
+    Match the view rows added since the last run (id above the watermark)
+    against all saved searches in one batch and store the matches. Registered
+    as a refresh callback. Returns {"rows", "candidates", "matches", "seconds"}.
+    """
+    started = time.monotonic()
+    stats = {"rows": 0, "candidates": 0, "matches": 0}
+    with db_cursor(commit=True) as cur:
+        # The row lock makes concurrent processes match each id range only once
+        cur.execute("SELECT last_id FROM sourceview.rollup_watermark WHERE rollup_name = %s FOR UPDATE",
+                    [ALERTS_WATERMARK])
+        row = cur.fetchone()
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) AS max_id FROM {VIEW_NAME}")
+        max_id = cur.fetchone()["max_id"]
+        # Without a watermark, or with a view rebuilt from scratch (lower ids), the existing
+        # rows cannot be told apart from new ones; start from here instead of alerting on all
+        last_id = row["last_id"] if row and row["last_id"] <= max_id else max_id
+
+        if max_id > last_id:
+            cur.execute(f"SELECT id, municipality, anchors FROM {SAVED_SEARCHES_TABLE}")
+            index = SavedSearchIndex(cur.fetchall())
+            position = last_id if len(index) else max_id
+            while position < max_id:
+                cur.execute(
+                    f"""
+                    SELECT id, municipality, tsvector_to_array(search_vector) AS lexemes
+                    FROM {VIEW_NAME}
+                    WHERE id > %s AND id <= %s
+                    ORDER BY id
+                    LIMIT %s
+                    """,
+                    [position, max_id, chunk]
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                position = rows[-1]["id"]
+                candidates, matches = _record_matches(cur, index, rows)
+                stats["rows"] += len(rows)
+                stats["candidates"] += candidates
+                stats["matches"] += matches
+
+        cur.execute(
+            """
+            INSERT INTO sourceview.rollup_watermark (rollup_name, last_id, updated_at)
+            VALUES (%s, %s, now())
+            ON CONFLICT (rollup_name) DO UPDATE SET last_id = EXCLUDED.last_id, updated_at = EXCLUDED.updated_at
+            """,
+            [ALERTS_WATERMARK, max_id]
+        )
+    stats["seconds"] = time.monotonic() - started
+    logger.info("Matched ids %s-%s against saved searches: %d rows, %d candidate pairs, %d matches in %.2fs",
+                last_id + 1, max_id, stats["rows"], stats["candidates"], stats["matches"], stats["seconds"])
+    return stats
+
+
+refresh.on_refresh(evaluate_new_rows)
+
+
+# =====================
+# Benchmark
+# =====================
+def _synthetic_tsquery(rng, words):
+    """A saved search in the text form to_tsquery returns, shaped like parse_query's output"""
+    terms = [f"'{rng.choice(words)}'" for _ in range(rng.choice((1, 1, 2, 2, 3)))]
+    shape = rng.random()
+    if shape < 0.2:
+        terms[0] = f"( {terms[0]} | '{rng.choice(words)}' )"
+    elif shape < 0.3:
+        terms[0] += ":*"
+    elif shape < 0.35:
+        terms[0] = f"{terms[0]} <-> '{rng.choice(words)}'"
+    return " & ".join(terms)
+
+
+def bench(saved=10000, docs=5000, lexemes_per_doc=150, vocabulary=20000, seed=1):
+    """
+    Throughput of the saved-search index without a database: `saved` synthetic
+    searches over a Zipf-distributed vocabulary, matched against `docs`
+    synthetic rows. Reports the time to parse (once per saved search) and to
+    index the searches (once per evaluation), rows per second through
+    candidates(), and how many (search, row) pairs are left for Postgres to
+    check compared with checking every search against every row.
+    """
+    rng = random.Random(seed)
+    words = [f"ord{rank}" for rank in range(vocabulary)]
+    cum_weights = []
+    total = 0.0
+    for rank in range(vocabulary):
+        total += 1.0 / (rank + 1)
+        cum_weights.append(total)
+    municipalities = [f"kommune{number}" for number in range(98)]
+    # Saved searches use content words, not the most frequent ones
+    query_words = words[100:]
+
+    queries = [(_synthetic_tsquery(rng, query_words), rng.choice(municipalities) if rng.random() < 0.4 else None)
+               for _ in range(saved)]
+
+    # Anchors are parsed once when a search is saved; the index is built on every evaluation
+    started = time.perf_counter()
+    searches = [{"id": saved_id, "municipality": municipality, "anchors": anchors(tsquery_text)}
+                for saved_id, (tsquery_text, municipality) in enumerate(queries)]
+    parse_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    index = SavedSearchIndex(searches)
+    index_ms = (time.perf_counter() - started) * 1000
+
+    rows = [(set(rng.choices(words, cum_weights=cum_weights, k=lexemes_per_doc)), rng.choice(municipalities))
+            for _ in range(docs)]
+    started = time.perf_counter()
+    candidates = sum(len(index.candidates(lexemes, municipality)) for lexemes, municipality in rows)
+    match_seconds = time.perf_counter() - started
+
+    return {
+        "saved_searches": saved,
+        "rows": docs,
+        "parse_ms": parse_ms,
+        "index_ms": index_ms,
+        "rows_per_s": docs / match_seconds,
+        "candidates_per_row": candidates / docs,
+        "pairs_checked": candidates,
+        "pairs_naive": saved * docs,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="save a search for an owner")
+    add_parser.add_argument("--owner", required=True)
+    add_parser.add_argument("--municipality")
+    add_parser.add_argument("query", nargs="+")
+    list_parser = subparsers.add_parser("list", help="an owner's saved searches and unseen matches")
+    list_parser.add_argument("--owner", required=True)
+    subparsers.add_parser("evaluate", help="match the rows added since the last run")
+    bench_parser = subparsers.add_parser("bench", help="index throughput on synthetic data, without a database")
+    bench_parser.add_argument("--saved", type=int, default=10000)
+    bench_parser.add_argument("--docs", type=int, default=5000)
+    bench_parser.add_argument("--lexemes", type=int, default=150, help="distinct lexemes per row")
+    bench_parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "add":
+        print(save_search(args.owner, " ".join(args.query), args.municipality))
+    elif args.command == "list":
+        for saved in list_searches(args.owner):
+            print(f"{saved['id']:>6}  {saved['unseen']:>4} nye  {saved['query_text']}"
+                  f"{' (' + saved['municipality'] + ')' if saved['municipality'] else ''}")
+        for match in unseen_matches(args.owner):
+            print(f"  {match['query_text']}: {match['municipality']} {match['date']} {match['subject_title']}")
+    elif args.command == "evaluate":
+        print(evaluate_new_rows())
+    else:
+        result = bench(args.saved, args.docs, args.lexemes, seed=args.seed)
+        print(f"{result['saved_searches']} saved searches parsed in {result['parse_ms']:.0f} ms, "
+              f"indexed in {result['index_ms']:.0f} ms")
+        print(f"{result['rows']} rows at {result['rows_per_s']:.0f} rows/s, "
+              f"{result['candidates_per_row']:.1f} candidate searches per row")
+        print(f"{result['pairs_checked']} pairs left for Postgres instead of {result['pairs_naive']} "
+              f"({result['pairs_checked'] / result['pairs_naive']:.4%})")
@@ -0,0 +1,334 @@
+"""
+JSON-API til søgningen og kategoritallene, uden Streamlit.
+
+Start (kører ved siden af Streamlit-appen, se startup.sh):
+    python api.py serve --port 8001
+
+API'et lytter kun på 127.0.0.1, medmindre API_ADDRESS (eller --address)
+siger andet. Er API_TOKEN sat, kræver /export og /search/batch headeren
+"Authorization: Bearer <API_TOKEN>"; appens eksportlinks er i stedet
+signeret med tokenet (se export.sign_export_params).
+
+Endepunkter:
+    GET  /search?q=budget&municipality=Aarhus&start_date=2024-01-01&limit=20&cursor=...
+                           (&collapse=0 viser også næsten ens punkter, se dedup.py)
+    POST /search/batch     {"queries": [{"q": "budget"}, {"q": "skole", "limit": 5}]}
+    GET  /details?ids=1,2,3
+    GET  /export?q=budget&format=csv       alle resultater som CSV eller Parquet, sendt fra disken i bidder
+    GET  /categories                       alle kommuner samlet
+    GET  /categories/by-municipality       (?municipality=Aarhus for én kommune)
+    GET  /health
+    GET  /metrics                          Prometheus-format (se metrics.py)
+
+Gennemløb mod en kørende API (og dermed Postgres):
+    python api.py bench --url http://localhost:8001 --concurrency 16 --requests 2000 budget skole
+"""
+import argparse
+import asyncio
+import base64
+import hmac
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+from urllib.parse import urlencode
+
+import tornado.web
+from tornado.httpclient import AsyncHTTPClient
+
+import export
+import metrics
+import refresh
+import rollup
+import search
+import warmup
+from db import DB_POOL_MAX, pool_stats
+
+# =====================
+# API Settings
+# =====================
+API_PORT = int(os.getenv("API_PORT", "8001"))
+API_ADDRESS = os.getenv("API_ADDRESS", "127.0.0.1")  # 0.0.0.0 lytter på alle interfaces
+API_TOKEN = os.getenv("API_TOKEN", "")  # kræves af /export og /search/batch, hvis sat
+API_WORKERS = int(os.getenv("API_WORKERS", str(DB_POOL_MAX)))  # tråde til databasekald
+API_MAX_BATCH = int(os.getenv("API_MAX_BATCH", "50"))  # maks. antal søgninger pr. batch
+
+_executor = ThreadPoolExecutor(max_workers=API_WORKERS, thread_name_prefix="api")
+
+
+def to_json(value):
+    """json.dumps default for the types psycopg2 and pandas hand back"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, "item"):  # NumPy scalars
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def encode_cursor(row):
+    """Opaque page cursor from the (score, id) of the last row on a page"""
+    return base64.urlsafe_b64encode(json.dumps([row["score"], row["id"]]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        score, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(score), doc_id
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def parse_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        raise ValueError(f"Invalid date: {value}")
+
+
+@metrics.tagged("api.search")
+def search_request(params):
+    """
+    Run one search from request parameters (query string or a batch entry)
+    and build its response. Blocking; runs on the API thread pool.
+    """
+    limit = search.clamp_limit(params.get("limit") or 20)
+    cursor = params.get("cursor")
+    with_count = str(params.get("count", "1")).lower() not in ("0", "false") and not cursor
+    rows, total_count = search.search(
+        query_text=params.get("q", ""),
+        municipality=params.get("municipality"),
+        start_date=parse_date(params.get("start_date")),
+        end_date=parse_date(params.get("end_date")),
+        limit=limit,
+        with_count=with_count,
+        after=decode_cursor(cursor) if cursor else None,
+        collapse=str(params["collapse"]).lower() not in ("0", "false") if "collapse" in params else None,
+    )
+    return {
+        "results": rows,
+        "total_count": total_count,
+        "total_count_capped": search.count_is_capped(total_count),
+        "next_cursor": encode_cursor(rows[-1]) if len(rows) == limit else None,
+    }
+
+
+@metrics.tagged("api.export")
+def export_request(fmt, params):
+    """Write every result of a search to a temporary file; returns (file, row count). The caller closes it"""
+    if fmt not in export.EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(sorted(export.EXPORT_FORMATS))}")
+    return export.export_to_tempfile(
+        fmt,
+        query_text=params.get("q", ""),
+        municipality=params.get("municipality"),
+        start_date=parse_date(params.get("start_date")),
+        end_date=parse_date(params.get("end_date")),
+    )
+
+
+@metrics.tagged("api.categories")
+def categories_request(municipality=None):
+    category_rollup = rollup.load_category_rollup()
+    if municipality:
+        df = rollup.municipality_categories(category_rollup, municipality)
+    else:
+        df = rollup.categories_by_municipality(category_rollup)
+    return {"categories": df.to_dict("records")}
+
+
+class BaseHandler(tornado.web.RequestHandler):
+    async def run(self, func, *args):
+        """Run a blocking call on the shared thread pool and write its result as JSON"""
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        self.write_json(result)
+
+    def write_json(self, result):
+        self.set_header("Content-Type", "application/json; charset=utf-8")
+        self.write(json.dumps(result, default=to_json, ensure_ascii=False))
+
+    def write_error(self, status_code, **kwargs):
+        self.write_json({"error": self._reason})
+
+
+class TokenHandler(BaseHandler):
+    """Handler for the expensive endpoints: with API_TOKEN set, requests must carry it as a bearer token"""
+
+    def prepare(self):
+        if not API_TOKEN:
+            return
+        scheme, _, token = self.request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.encode(), API_TOKEN.encode()):
+            self.set_header("WWW-Authenticate", "Bearer")
+            raise tornado.web.HTTPError(401, reason="Missing or invalid API token")
+
+
+class SearchHandler(BaseHandler):
+    async def get(self):
+        params = {name: self.get_query_argument(name) for name in self.request.query_arguments}
+        await self.run(search_request, params)
+
+
+class BatchSearchHandler(TokenHandler):
+    async def post(self):
+        try:
+            queries = json.loads(self.request.body)["queries"]
+        except (ValueError, KeyError, TypeError):
+            raise tornado.web.HTTPError(400, reason='Body must be {"queries": [...]}')
+        if not isinstance(queries, list) or len(queries) > API_MAX_BATCH:
+            raise tornado.web.HTTPError(400, reason=f"queries must be a list of at most {API_MAX_BATCH} searches")
+
+        # All searches share the thread pool, the connection pool and the result cache
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(
+            *(loop.run_in_executor(_executor, search_request, params) for params in queries),
+            return_exceptions=True
+        )
+        self.write_json({"responses": [
+            {"error": str(outcome)} if isinstance(outcome, Exception) else outcome for outcome in outcomes
+        ]})
+
+
+class DetailsHandler(BaseHandler):
+    async def get(self):
+        try:
+            ids = [int(doc_id) for doc_id in self.get_query_argument("ids", "").split(",") if doc_id]
+        except ValueError:
+            raise tornado.web.HTTPError(400, reason="ids must be a comma separated list of integers")
+        await self.run(lambda: {"details": list(search.fetch_details(ids).values())})
+
+
+class ExportHandler(TokenHandler):
+    def prepare(self):
+        # Links from the app's export button carry a signature instead of the token
+        params = {name: self.get_query_argument(name) for name in self.request.query_arguments}
+        if API_TOKEN and "signature" in params:
+            if not export.export_signature_valid(params, API_TOKEN):
+                raise tornado.web.HTTPError(403, reason="Invalid or expired export link")
+            return
+        super().prepare()
+
+    async def get(self):
+        params = {name: self.get_query_argument(name) for name in self.request.query_arguments}
+        fmt = params.get("format", "csv")
+        loop = asyncio.get_running_loop()
+        try:
+            export_file, row_count = await loop.run_in_executor(_executor, export_request, fmt, params)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+
+        suffix, mime = export.EXPORT_FORMATS[fmt]
+        with export_file:
+            self.set_header("Content-Type", mime)
+            self.set_header("Content-Disposition", f'attachment; filename="soegeresultater{suffix}"')
+            self.set_header("X-Total-Count", str(row_count))
+            # One chunk in memory at a time: the next is read only when the previous has been sent
+            chunks = export.iter_file_chunks(export_file)
+            while True:
+                chunk = await loop.run_in_executor(_executor, next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await self.flush()
+
+
+class CategoriesHandler(BaseHandler):
+    async def get(self):
+        await self.run(lambda: {
+            "categories": rollup.all_categories(rollup.load_category_rollup()).to_dict("records")
+        })
+
+
+class MunicipalityCategoriesHandler(BaseHandler):
+    async def get(self):
+        await self.run(categories_request, self.get_query_argument("municipality", None))
+
+
+class MetricsHandler(BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.prometheus_text(pool_stats()))
+
+
+class HealthHandler(BaseHandler):
+    def get(self):
+        generation, refreshed_at = refresh.current_generation()
+        self.write_json({"generation": generation, "refreshed_at": refreshed_at, "pool": pool_stats()})
+
+
+def make_app():
+    return tornado.web.Application([
+        (r"/search", SearchHandler),
+        (r"/search/batch", BatchSearchHandler),
+        (r"/details", DetailsHandler),
+        (r"/export", ExportHandler),
+        (r"/categories", CategoriesHandler),
+        (r"/categories/by-municipality", MunicipalityCategoriesHandler),
+        (r"/health", HealthHandler),
+        (r"/metrics", MetricsHandler),
+    ], compress_response=True)
+
+
+async def serve(port=API_PORT, address=API_ADDRESS):
+    refresh.start_scheduler()
+    # Fill the caches before listening, so the first requests do not pay for them
+    await asyncio.get_running_loop().run_in_executor(_executor, warmup.warm_up)
+    make_app().listen(port, address)
+    await asyncio.Event().wait()
+
+
+# =====================
+# Benchmark
+# =====================
+async def benchmark(url, queries, concurrency=16, requests=2000):
+    """Send `requests` searches with `concurrency` in flight and print requests/s and latency percentiles"""
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = []
+    errors = 0
+    sent = 0
+
+    async def worker():
+        nonlocal errors, sent
+        while sent < requests:
+            query_text = queries[sent % len(queries)]
+            sent += 1
+            started = time.perf_counter()
+            response = await client.fetch(f"{url}/search?{urlencode({'q': query_text})}", raise_error=False,
+                                          decompress_response=True)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{len(latencies)} requests, concurrency {concurrency}: {len(latencies) / elapsed:.0f} req/s, "
+          f"p50 {percentiles[49]:.1f} ms, p95 {percentiles[94]:.1f} ms, p99 {percentiles[98]:.1f} ms, "
+          f"{errors} errors")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    serve_parser = subparsers.add_parser("serve", help="run the API server")
+    serve_parser.add_argument("--port", type=int, default=API_PORT)
+    serve_parser.add_argument("--address", default=API_ADDRESS)
+    bench_parser = subparsers.add_parser("bench", help="measure search throughput of a running API")
+    bench_parser.add_argument("--url", default=f"http://localhost:{API_PORT}")
+    bench_parser.add_argument("--concurrency", type=int, default=16)
+    bench_parser.add_argument("--requests", type=int, default=2000)
+    bench_parser.add_argument("queries", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        asyncio.run(serve(args.port, args.address))
+    else:
+        asyncio.run(benchmark(args.url.rstrip("/"), args.queries, args.concurrency, args.requests))
@@ -1,36 +1,52 @@
 import streamlit as st
-import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
 from collections import Counter, defaultdict
-import pandas as pd
-import altair as alt
 # from duckduckgo_search import DDGS
 import time
 import random
+import os
+from datetime import date, timedelta
+from urllib.parse import urlencode
 
-# from datetime import datetime
-
-# =====================
-# Database Settings
-# =====================
-DB_NAME = os.getenv("DB_NAME")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_HOST = os.getenv("DB_HOST")
-DB_PORT = os.getenv("DB_PORT", "5432")
-
+import psycopg2
 
-def get_db_connection():
-    """Create database connection"""
-    return psycopg2.connect(
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        host=DB_HOST,
-        port=DB_PORT,
-        cursor_factory=RealDictCursor
-    )
+import alerts
+import db
+import export
+import metrics
+import refresh
+import pipeline
+import rollup
+import search
+import suggest
+import warmup
+
+RESULTS_PER_PAGE = pipeline.RESULTS_PER_PAGE
+
+# Sider i appen. Kun den valgte side køres ved en rerun (st.tabs kører alle faners indhold hver gang)
+SEARCH_PAGE = "Søg i kommunale møder"
+TOPICS_PAGE = "Populære emner"
+ADMIN_PAGE = "Drift"
+
+# Streamlit drops the state of widgets that are not rendered in a run, so the search form
+# would be reset after a visit to another page unless these keys are carried over
+SEARCH_FORM_KEYS = ("query", "municipality_filter", "period", "start_date", "end_date", "collapse_duplicates",
+                    "alert_owner")
+
+# The export is sent from disk by the JSON API (GET /export in api.py), so the file never sits in the
+# app's memory; the address must be reachable from the user's browser
+EXPORT_URL = os.getenv("EXPORT_URL", "http://localhost:8001/export")
+# With API_TOKEN set the API only serves exports to signed links (see export.sign_export_params)
+API_TOKEN = os.getenv("API_TOKEN")
+
+# The "Drift" tab is only shown with ?admin=<ADMIN_TOKEN> in the URL
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Periodevalg i søgningen: antal dage tilbage fra i dag (None = ingen afgrænsning)
+DATE_PRESETS = {
+    "Alle datoer": None,
+    "Seneste 12 måneder": 365,
+    "Seneste 3 måneder": 91,
+}
 
 
 # =====================
@@ -75,189 +91,248 @@ def get_db_connection():
 # =====================
 # Søgefunktionalitet
 # =====================
+@metrics.tagged("refresh_materialized_view")
 def refresh_materialized_view():
-    """Refresh the materialized view"""
+    """
+    Manually refresh the materialized view (normally done by the background
+    scheduler in refresh.py, outside the search path)
+    """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("REFRESH MATERIALIZED VIEW sourceview.foraisearch_with_search")
-        conn.commit()
+        return refresh.refresh_view(force=True)
     except Exception as e:
         st.error(f"Error refreshing materialized view: {e}")
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-def do_search(query_text="", municipality=None, start_date=None, end_date=None, limit=20):
+@metrics.tagged("do_search")
+def do_search(query_text="", municipality=None, start_date=None, end_date=None, limit=20, with_count=True,
+              after=None):
     """
-    Perform full-text search using PostgreSQL
+    Perform full-text search using PostgreSQL.
+    Returns one page of result headers and the total number of matches in a single query
+    (see search.py); `after` is the (score, id) of the last row on the previous page.
     """
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-
-        # Build the query
-        query = """
-                    SELECT 
-                        t.id, t.municipality, t.date, t.participants, t.guests, t.title, 
-                        t.summary, t.tags, t.content_url, t.category, t.search_sentences,
-                        t.decided_or_not, t.future_action, t.description, t.subject_title, t.amount,
-                        COALESCE(ts_rank_score, 0) as ts_rank_score,
-                        COALESCE(similarity_score, 0) as similarity_score
-                    FROM (
-                        SELECT 
-                            *,
-                            ts_rank(search_vector, plainto_tsquery('danish', %s)) as ts_rank_score,
-                            similarity(
-                                (((((((((COALESCE(municipality, '')::text || ' ') || 
-                                COALESCE(title, '')::text) || ' ') || 
-                                COALESCE(category, '')::text) || ' ') || 
-                                COALESCE(description, '')::text) || ' ') || 
-                                COALESCE(future_action, '')::text) || ' ') || 
-                                COALESCE(subject_title, '')::text,
-                                %s
-                            ) as similarity_score
-                        FROM sourceview.foraisearch_with_search
-                    ) t
-                    WHERE """
-
-        params = [query_text, query_text]
-
-        # Add wildcard search for even better matches
-        wildcard_query = " | ".join([f"{word}:*" for word in query_text.split()])
-
-        # Add conditions - both exact matches and similarity
-        where_conditions = [
-            "t.search_vector @@ plainto_tsquery('danish', %s)",
-            "t.search_vector @@ to_tsquery('danish', %s)",
-            "t.similarity_score > 0.05"  # Adjust threshold as needed
-        ]
-
-        query += " OR ".join(where_conditions)
-        params.extend([query_text, wildcard_query])
-
-        # Add filters
-        if municipality and municipality != "Alle":
-            query += " AND municipality = %s"
-            params.append(municipality)
-
-            # if start_date:
-            #     query += " AND date::date >= %s"
-            #     params.append(start_date)
-            #
-            # if end_date:
-            #     query += " AND date::date <= %s"
-            #     params.append(end_date)
-
-            # Add ordering and limit
-            query += """
-            ORDER BY ((ts_rank(search_vector, plainto_tsquery('danish', %s))) + (similarity(
-                                (((((((((COALESCE(municipality, '')::text || ' ') || 
-                                COALESCE(title, '')::text) || ' ') || 
-                                COALESCE(category, '')::text) || ' ') || 
-                                COALESCE(description, '')::text) || ' ') || 
-                                COALESCE(future_action, '')::text) || ' ') || 
-                                COALESCE(subject_title, '')::text,
-                                %s
-                            )) * 0.8) DESC LIMIT %s
-            """
-            params.append(limit)
-
-        # Execute search
-        cur.execute(query, params)
-        results = cur.fetchall()
-
-        # Count query for total matches
-        count_query = """
-                    SELECT COUNT(*) 
-                    FROM (
-                        SELECT 
-                            *,
-                            ts_rank(search_vector, plainto_tsquery('danish', %s)) as ts_rank_score,
-                            similarity(
-                                (((((((((COALESCE(municipality, '')::text || ' ') || 
-                                COALESCE(title, '')::text) || ' ') || 
-                                COALESCE(category, '')::text) || ' ') || 
-                                COALESCE(description, '')::text) || ' ') || 
-                                COALESCE(future_action, '')::text) || ' ') || 
-                                COALESCE(subject_title, '')::text,
-                                %s
-                            ) as similarity_score
-                        FROM sourceview.foraisearch_with_search
-                    ) t
-                    WHERE """
-
-        count_params = [query_text, query_text]
-
-        count_query += " OR ".join(where_conditions)
-        count_params.extend([query_text, wildcard_query])
-
-        if municipality and municipality != "Alle":
-            count_query += " AND municipality = %s"
-            count_params.append(municipality)
-
-        # if start_date:
-        #     count_query += " AND date::date >= %s"
-        #     count_params.append(start_date)
-        #
-        # if end_date:
-        #     count_query += " AND date::date <= %s"
-        #     count_params.append(end_date)
-
-        cur.execute(count_query, count_params)
-        total_count = cur.fetchone()['count']
-
-        return results, total_count
-
+        return search.search(
+            query_text=query_text,
+            municipality=municipality,
+            start_date=start_date,
+            end_date=end_date,
+            limit=limit,
+            with_count=with_count,
+            after=after
+        )
     except Exception as e:
         st.error(f"Search error: {e}")
         return [], 0
-    finally:
-        if 'cur' in locals():
-            cur.close()
-        if 'conn' in locals():
-            conn.close()
 
 
-def show_results(docs, total_count=None):
+@metrics.tagged("do_search_page")
+def do_search_page(query_text="", municipality=None, start_date=None, end_date=None, limit=20, after=None,
+                   with_count=True, collapse=None):
+    """
+    Perform the search with the results, total count and facet counts running in parallel
+    (see pipeline.py). Count and facets are None if they did not finish in time.
+    With `collapse` near-duplicate items are shown once (see dedup.py).
+    """
+    try:
+        return pipeline.search_page(
+            query_text=query_text,
+            municipality=municipality,
+            start_date=start_date,
+            end_date=end_date,
+            limit=limit,
+            after=after,
+            with_count=with_count,
+            with_facets=with_count,
+            collapse=collapse
+        )
+    except psycopg2.errors.QueryCanceled:
+        st.warning("Søgningen tog for lang tid. Prøv med flere ord, en kommune eller en periode.")
+        return {"rows": [], "total_count": None, "facets": None, "timings": {}}
+    except Exception as e:
+        st.error(f"Search error: {e}")
+        return {"rows": [], "total_count": 0, "facets": None, "timings": {}}
+
+
+@metrics.tagged("fetch_municipalities")
+def fetch_municipalities():
+    """
+    "Alle" plus every municipality in the view (from the snapshot when it is
+    fresh, see snapshot.py), also those without categorised items
+    """
+    try:
+        return ["Alle"] + rollup.load_municipalities()
+    except Exception as e:
+        st.error(f"Error fetching municipalities: {e}")
+        return ["Alle"]
+
+
+@metrics.tagged("fetch_result_details")
+def fetch_result_details(ids):
+    """Fetch the detail fields for the opened results"""
+    if not ids:
+        return {}
+    try:
+        return search.fetch_details(ids)
+    except Exception as e:
+        st.error(f"Error fetching result details: {e}")
+        return {}
+
+
+@metrics.tagged("fetch_similar_results")
+def fetch_similar_results(doc, search_state):
+    """Fetch the other matching items in the near-duplicate cluster of a result"""
+    try:
+        return search.fetch_similar(
+            doc["cluster_id"],
+            doc["id"],
+            query_text=search_state["query"],
+            municipality=search_state["municipality"],
+            start_date=search_state["start_date"],
+            end_date=search_state["end_date"]
+        )
+    except Exception as e:
+        st.error(f"Error fetching similar items: {e}")
+        return []
+
+
+def format_date(date_val):
+    """Konverter datoformat til YYYY-MM-DD"""
+    if not date_val:
+        return ""
+    if isinstance(date_val, str):
+        return date_val.split("T")[0]
+    return date_val.strftime("%Y-%m-%d")
+
+
+def format_count(total_count):
+    """Antal resultater; over search.COUNT_CAP tælles der ikke videre"""
+    if search.count_is_capped(total_count):
+        return f"over {search.COUNT_CAP:,}".replace(",", ".")
+    return str(total_count)
+
+
+def show_similar(doc, search_state):
+    """Knap til og liste over de næsten ens punkter, der er samlet under et resultat"""
+    similar_count = doc.get("similar_count") or 0
+    if not similar_count or search_state is None:
+        return
+    opened_similar = st.session_state.setdefault("opened_similar", set())
+    if doc["id"] not in opened_similar:
+        st.button(f"Vis {similar_count} lignende", key=f"similar_{doc['id']}", on_click=opened_similar.add,
+                  args=(doc["id"],))
+        return
+    st.write(f"**{similar_count} næsten ens punkter:**")
+    for similar in fetch_similar_results(doc, search_state):
+        st.write(f"- {similar['municipality']} ({format_date(similar['date'])}) – {similar['subject_title']}")
+
+
+@metrics.tagged("fetch_saved_searches")
+def fetch_saved_searches(owner):
+    """Fetch the owner's saved searches and their unseen matches"""
+    try:
+        return alerts.list_searches(owner), alerts.unseen_matches(owner)
+    except Exception as e:
+        st.error(f"Error fetching saved searches: {e}")
+        return [], []
+
+
+def delete_saved_search(owner, saved_search_id):
+    try:
+        alerts.delete_search(owner, saved_search_id)
+    except Exception as e:
+        st.error(f"Error deleting saved search: {e}")
+
+
+def mark_matches_seen(owner, matches):
+    try:
+        alerts.mark_seen(owner, matches)
+    except Exception as e:
+        st.error(f"Error updating saved searches: {e}")
+
+
+def show_saved_searches(search_state):
+    """
+    Gemte søgninger: gem den aktuelle søgning og se de nye mødepunkter, der matcher.
+    Nye rækker matches efter hver opdatering af view'et (se alerts.py).
+    """
+    with st.expander("🔔 Gemte søgninger"):
+        owner = st.text_input("Din e-mail eller dit navn:", key="alert_owner")
+        if not owner.strip():
+            st.write("Angiv din e-mail eller dit navn for at gemme søgninger og se nye møder, der matcher dem.")
+            return
+
+        if search_state and st.button("Gem søgningen", help="Vis nye mødepunkter, der matcher søgningen"):
+            try:
+                alerts.save_search(owner, search_state["query"], search_state["municipality"])
+                st.success(f"Søgningen '{search_state['query']}' er gemt")
+            except Exception as e:
+                st.error(f"Error saving search: {e}")
+
+        saved_searches, matches = fetch_saved_searches(owner)
+        for saved in saved_searches:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.write(f"**{saved['query_text']}** ({saved['municipality'] or 'Alle'}) – {saved['unseen']} nye")
+            with col2:
+                st.button("Slet", key=f"delete_saved_{saved['id']}", on_click=delete_saved_search,
+                          args=(owner, saved["id"]))
+
+        if matches:
+            st.write("**Nye mødepunkter:**")
+            for match in matches:
+                st.write(f"- {match['municipality']} ({format_date(match['date'])}) – {match['subject_title']} "
+                         f"· *{match['query_text']}*")
+            shown = [(match["saved_search_id"], match["id"]) for match in matches]
+            st.button("Markér som set", key="mark_seen", on_click=mark_matches_seen, args=(owner, shown))
+
+
+def show_results(docs, total_count=None, search_state=None):
     """
     Viser en liste over dokumenter i Streamlit UI samt relaterede artikler.
+    Listen viser kun overskrifter; detaljerne hentes først, når et resultat åbnes.
+    Næsten ens punkter er samlet under ét resultat med "Vis N lignende".
     """
     if total_count is not None:
-        st.write(f"**Antal resultater:** {total_count}")
-
-    for doc in docs:
-        date_val = doc.get("date", "")
+        st.write(f"**Antal resultater:** {format_count(total_count)}")
+    elif docs:
+        st.write("**Antal resultater:** ukendt")
 
-        # Konverter datoformat til YYYY-MM-DD
-        # With this:
-        if date_val:
-            if isinstance(date_val, str):
-                date_val = date_val.split("T")[0]
-            else:
-                date_val = date_val.strftime("%Y-%m-%d")
+    opened = st.session_state.setdefault("opened_results", set())
+    details = fetch_result_details([doc["id"] for doc in docs if doc["id"] in opened])
 
+    for doc in docs:
+        doc_id = doc["id"]
+        date_val = format_date(doc.get("date", ""))
         municipality_val = doc.get("municipality", "")
-        summary_val = doc.get("summary", "")
-        decided = doc.get("decided_or_not", False)
-        content_url = doc.get("content_url", "#")
-        amount = doc.get("amount", "")
-        search_sentences_val = doc.get("search_sentences", "")
         subject_title_val = doc.get("subject_title", "")
-        description_val = doc.get("description", "")
-        future_action_val = doc.get("future_action", "")
-        tags_val = doc.get("tags", [])
-        category_val = doc.get("category", "Ingen kategori")
-        base_url = doc.get("site", "")
 
-        # # Hent relaterede artikler
-        # articles = scrape_articles(f"{subject_title_val} {municipality_val}")
+        label = f"📌 {municipality_val} ({date_val}) – {subject_title_val}"
+        if doc.get("similar_count"):
+            label += f" · +{doc['similar_count']} lignende"
+        expanded = doc_id in opened or doc_id in st.session_state.get("opened_similar", ())
+        with st.expander(label, expanded=expanded):
+            show_similar(doc, search_state)
+            detail = details.get(doc_id)
+            if detail is None:
+                st.button("Vis detaljer", key=f"details_{doc_id}", on_click=opened.add, args=(doc_id,))
+                continue
+
+            summary_val = detail.get("summary", "")
+            decided = detail.get("decided_or_not", False)
+            content_url = detail.get("content_url", "#")
+            amount = detail.get("amount", "")
+            search_sentences_val = detail.get("search_sentences", "")
+            description_val = detail.get("description", "")
+            future_action_val = detail.get("future_action", "")
+            tags_val = detail.get("tags", [])
+            category_val = detail.get("category") or "Ingen kategori"
+
+            # # Hent relaterede artikler
+            # articles = scrape_articles(f"{subject_title_val} {municipality_val}")
 
-        with st.expander(f"📌 {municipality_val} ({date_val})"):
             st.write(f"**Kommune:** {municipality_val}")
+            st.write(f"**Kategori:** {category_val}")
             st.write(f"**Resumé:** {summary_val}")
             st.write(f"**Emnetitel:** {subject_title_val}")
             st.write(f"**Emnebeskrivelse:** {description_val}")
@@ -288,6 +363,151 @@ def show_results(docs, total_count=None):
             #     st.write("Ingen relaterede artikler fundet.")
 
 
+def apply_suggestion(word):
+    """Erstat det sidste ord i søgefeltet med det valgte forslag"""
+    words = st.session_state["query"].split()
+    st.session_state["query"] = " ".join(words[:-1] + [word])
+
+
+def show_suggestions(query_text):
+    """
+    Forslag til det sidst indtastede ord, fra ordene i møderne vægtet efter hvor mange
+    dokumenter de står i (se suggest.py)
+    """
+    words = query_text.split()
+    if not words or query_text.endswith(" "):
+        return
+    try:
+        suggestions = [(word, ndoc) for word, ndoc in suggest.get_suggester().suggest(words[-1])
+                       if word != words[-1].lower()]
+    except Exception as e:
+        st.error(f"Error fetching suggestions: {e}")
+        return
+    if not suggestions:
+        return
+
+    for col, (word, ndoc) in zip(st.columns(len(suggestions)), suggestions):
+        with col:
+            st.button(word, key=f"suggest_{word}", help=f"Står i {ndoc} dokumenter",
+                      on_click=apply_suggestion, args=(word,), use_container_width=True)
+
+
+def show_facets(facets):
+    """Fordeling af alle resultater (ikke kun den viste side) på kommune og kategori"""
+    if not facets:
+        return
+    import pandas as pd
+
+    with st.expander("Fordeling af resultater"):
+        col1, col2 = st.columns(2)
+        for col, facet, label in ((col1, "municipality", "Kommune"), (col2, "category", "Kategori")):
+            with col:
+                df = pd.DataFrame(facets[facet], columns=[label, "Antal"])
+                df[label] = df[label].replace("", "Ingen kategori")
+                st.dataframe(df.sort_values("Antal", ascending=False), hide_index=True)
+
+
+def show_export(search_state):
+    """
+    Eksport af alle resultater for søgningen (ikke kun den viste side) til CSV eller Parquet.
+    Linket går til API'ets /export, som skriver filen i bidder til disken (se export.py) og sender
+    den derfra, så hverken rækkerne eller filen ligger i appens hukommelse.
+    """
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        fmt = st.radio("Eksportformat", list(export.EXPORT_FORMATS), format_func=str.upper, horizontal=True,
+                       key="export_format")
+    params = {"q": search_state["query"], "format": fmt}
+    if search_state["municipality"] and search_state["municipality"] != "Alle":
+        params["municipality"] = search_state["municipality"]
+    for name in ("start_date", "end_date"):
+        if search_state[name]:
+            params[name] = search_state[name].isoformat()
+    if API_TOKEN:
+        params = export.sign_export_params(params, API_TOKEN)
+    with col2:
+        st.link_button("📥 Eksportér alle resultater", f"{EXPORT_URL}?{urlencode(params)}")
+
+
+def show_pagination(search_state, docs):
+    """
+    Forrige/Næste-knapper. Siderne bruger keyset pagination, så hver side gemmer
+    (score, id) for sidste række på den forrige side.
+    """
+    cursors = search_state["cursors"]
+    col1, col2, col3 = st.columns([1, 1, 4])
+    with col1:
+        if len(cursors) > 1 and st.button("← Forrige", key="prev_page"):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        if len(docs) == RESULTS_PER_PAGE and st.button("Næste →", key="next_page"):
+            cursors.append((docs[-1]["score"], docs[-1]["id"]))
+            st.rerun()
+    with col3:
+        st.caption(f"Side {len(cursors)}")
+
+
+def show_admin_panel():
+    """
+    Driftsoverblik: forbindelsespulje, caches og tidsforbrug pr. DB-kald (se metrics.py),
+    inkl. EXPLAIN-planer for langsomme forespørgsler og Prometheus-tekst
+    """
+    import pandas as pd
+
+    st.subheader("Drift")
+    if not metrics.METRICS_ENABLED:
+        st.info("Instrumentering er slået fra (METRICS_ENABLED=0).")
+
+    col1, col2 = st.columns(2)
+    with col1:
+        st.write("**Forbindelsespulje**")
+        st.json(db.pool_stats() or {})
+    with col2:
+        st.write("**Søgecache**")
+        st.json(search.search_cache.stats())
+
+    st.write("**DB-kald pr. funktion**")
+    totals = pd.DataFrame([
+        {
+            "funktion": tag,
+            "kald": values["calls"],
+            "fejl": values["errors"],
+            "langsomme": values["slow"],
+            "gns. execute (ms)": values["execute_seconds"] * 1000 / values["calls"],
+            "gns. acquire (ms)": values["acquire_seconds"] * 1000 / values["calls"],
+            "rækker": values["rows"],
+            "bytes": values["bytes"],
+        }
+        for tag, values in metrics.totals().items()
+    ])
+    st.dataframe(totals, hide_index=True)
+
+    st.write("**Seneste DB-kald**")
+    calls = pd.DataFrame(metrics.recent_calls())
+    if not calls.empty:
+        calls["time"] = pd.to_datetime(calls["time"], unit="s")
+    st.dataframe(calls, hide_index=True)
+
+    st.write(f"**Langsomme forespørgsler (over {metrics.SLOW_QUERY_MS:.0f} ms)**")
+    for slow in metrics.slow_query_plans():
+        with st.expander(f"{slow['tag']} – {slow['execute_ms']:.0f} ms"):
+            st.code(slow["statement"], language="sql")
+            st.json(slow["plan"])
+
+    prometheus = metrics.prometheus_text(db.pool_stats())
+    with st.expander("Prometheus"):
+        st.code(prometheus)
+    st.download_button("Download metrics", prometheus, file_name="metrics.txt", mime="text/plain")
+
+
+def keep_search_form_state():
+    """Carry the search form's widget values over runs where the search page is not shown"""
+    for key in SEARCH_FORM_KEYS:
+        if key in st.session_state:
+            st.session_state[key] = st.session_state[key]
+
+
 def add_custom_css():
     # Create custom CSS for input field styling
     custom_css = """
@@ -323,15 +543,26 @@ def main():
     # Add custom CSS for styling input fields
     add_custom_css()
 
+    # Materialized view opdateres i baggrunden, ikke ved hver søgning
+    refresh.start_scheduler()
+    # Første session i processen varmer resten af caches op i baggrunden (se warmup.py)
+    warmup.start()
+
     st.title("🔍 Kommunale Mødeudtræk")
+    generation, refreshed_at = refresh.current_generation()
+    if refreshed_at:
+        st.caption(f"Data opdateret: {refreshed_at.strftime('%Y-%m-%d %H:%M')}")
 
-    # Opret faner til navigation
-    tab1, tab2 = st.tabs(["Søg i kommunale møder", "Populære emner"])
+    # Navigation mellem siderne
+    show_admin = bool(ADMIN_TOKEN) and st.query_params.get("admin") == ADMIN_TOKEN
+    pages = [SEARCH_PAGE, TOPICS_PAGE] + ([ADMIN_PAGE] if show_admin else [])
+    page = st.radio("Side", pages, horizontal=True, label_visibility="collapsed", key="page")
+    keep_search_form_state()
 
     # =====================
     # Hovedsøgefunktion
     # =====================
-    with tab1:
+    if page == SEARCH_PAGE:
         with st.expander("### ℹ️ Sådan bruger du appen (Klik for at se mere)"):
             st.markdown("""
                 Denne **Kommunale Mødeudtræk** app gør det nemt at **søge og udforske kommunale mødereferater** fra forskellige danske kommuner.
@@ -339,6 +570,7 @@ def main():
                 ### 🔍 **Sådan bruger du appen:**
                 1️⃣ **Søg i kommunale møder**  
                    - Indtast et søgeord (f.eks. *"bolig"*, *"budget"*, *"miljø"*).  
+                   - Brug *OR*, *-ord*, *"flere ord"* og *ord\** for at præcisere søgningen.  
                    - Filtrér på **kommune** og **dato** efter behov.  
                    - Klik på **"🔎 Søg"** for at finde relevante møder.  
 
@@ -352,7 +584,10 @@ def main():
                    - Klik på de viste links for at læse mere.  
 
                 4️⃣ **Populære emner**  
-                   - Under fanen **"Populære emner"** kan du se **hvilke emner der diskuteres mest** i kommunerne.  
+                   - Under siden **"Populære emner"** kan du se **hvilke emner der diskuteres mest** i kommunerne.  
+
+                5️⃣ **Gemte søgninger**  
+                   - Gem en søgning under **"🔔 Gemte søgninger"** og se **nye møder**, der matcher den, når du kommer tilbage.  
 
                 📌 **Formål:** Øget gennemsigtighed i kommunale beslutninger og let adgang til information om lokalpolitik.
             """)
@@ -361,163 +596,127 @@ def main():
 
         query = st.text_input(
             "Søg efter et emne (f.eks. 'budget', 'lokalplan', 'fjernvarme', 'takster', 'ældreboliger', 'personalepolitik', 'udbuds', 'klimatilpasning', 'whistleblower', 'daginstitution', 'anlægsbevilling', 'garantistillelse'):",
-            "")
-        # Get unique municipalities from database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT municipality FROM sourceview.foraisearch_with_search ORDER BY municipality")
-        municipalities = ["Alle"] + [row['municipality'] for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-
-        municipality_filter = st.selectbox("Filtrér efter kommune:", municipalities)
-
-        # col1, col2 = st.columns(2)
-        # with col1:
-        #     start_date = st.date_input("Startdato", value=None)
-        # with col2:
-        #     end_date = st.date_input("Slutdato", value=None)
-
-        filter_clauses = []
-        if municipality_filter != "Alle":
-            filter_clauses.append(f"municipality eq '{municipality_filter}'")
-
-        # if start_date and end_date:
-        #     filter_clauses.append(f"date ge {start_date.isoformat()}T00:00:00Z and date le {end_date.isoformat()}T23:59:59Z")
-        # elif start_date:
-        #     filter_clauses.append(f"date ge {start_date.isoformat()}T00:00:00Z")
-        # elif end_date:
-        #     filter_clauses.append(f"date le {end_date.isoformat()}T23:59:59Z")
-
-        filter_query = " and ".join(filter_clauses) if filter_clauses else None
+            "", key="query")
+        show_suggestions(query)
+        municipality_filter = st.selectbox("Filtrér efter kommune:", fetch_municipalities(),
+                                           key="municipality_filter")
+
+        period = st.selectbox("Periode:", list(DATE_PRESETS) + ["Vælg datoer"], key="period")
+        if period == "Vælg datoer":
+            col1, col2 = st.columns(2)
+            with col1:
+                start_date = st.date_input("Startdato", value=None, key="start_date")
+            with col2:
+                end_date = st.date_input("Slutdato", value=None, key="end_date")
+        else:
+            days = DATE_PRESETS[period]
+            start_date = date.today() - timedelta(days=days) if days else None
+            end_date = None
+
+        collapse = st.checkbox("Saml næsten ens punkter", value=search.COLLAPSE_DUPLICATES, key="collapse_duplicates",
+                               help="Faste punkter med næsten samme tekst (fx budgetopfølgninger) vises én gang")
 
         if st.button("🔎 Søg"):
+            # Ny søgning: start forfra på første side med alle resultater lukket
+            st.session_state["search"] = {
+                "query": query,
+                "municipality": municipality_filter,
+                "start_date": start_date,
+                "end_date": end_date,
+                "collapse": collapse,
+                "cursors": [None],
+                "total_count": None,
+                "facets": None,
+            }
+            st.session_state["opened_results"] = set()
+            st.session_state["opened_similar"] = set()
+
+        search_state = st.session_state.get("search")
+        if search_state:
             with st.spinner("Søger..."):
                 try:
-                    # Refresh materialized view before searching
-                    refresh_materialized_view()
                     # Perform search
-                    docs, total_count = do_search(
-                        query_text=query,
-                        municipality=municipality_filter,
-                        # start_date=start_date,
-                        # end_date=end_date
+                    # Antal og fordeling hentes kun for første side og huskes mens man bladrer
+                    first_page = len(search_state["cursors"]) == 1
+                    result_page = do_search_page(
+                        query_text=search_state["query"],
+                        municipality=search_state["municipality"],
+                        limit=RESULTS_PER_PAGE,
+                        after=search_state["cursors"][-1],
+                        with_count=first_page,
+                        start_date=search_state["start_date"],
+                        end_date=search_state["end_date"],
+                        collapse=search_state.get("collapse")
                     )
-                    show_results(docs, total_count)
+                    docs = result_page["rows"]
+                    if first_page:
+                        search_state["total_count"] = result_page["total_count"]
+                        search_state["facets"] = result_page["facets"]
+                    show_results(docs, search_state["total_count"], search_state)
+                    show_facets(search_state["facets"])
+                    if docs:
+                        show_export(search_state)
+                    show_pagination(search_state, docs)
                 except Exception as e:
                     st.error(f"Der opstod en fejl: {e}")
 
+        show_saved_searches(search_state)
+
         st.markdown("---")
 
     # =====================
     # Sektion for Populære Emner
     # =====================
-    with tab2:
+    if page == TOPICS_PAGE:
+        # Only needed on this page; warmup.py imports Altair once the first page view is warm
+        import altair as alt
+        import pandas as pd
+
         st.subheader("Populære Emner")
 
-        def fetch_all_categories():
+        @metrics.tagged("fetch_category_rollup")
+        def fetch_category_rollup():
             """
-            Fetch category data from PostgreSQL
+            Fetch the (municipality, category, count) rollup with a single query;
+            every aggregation below is derived from it in pandas
             """
             try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-
-                query = """
-                SELECT 
-                    category,
-                    COUNT(*) as count
-                FROM sourceview.foraisearch_with_search
-                WHERE category IS NOT NULL
-                GROUP BY category
-                ORDER BY count DESC
-                """
-
-                cur.execute(query)
-                results = cur.fetchall()
-                return results
+                return rollup.load_category_rollup()
             except Exception as e:
                 st.error(f"Error fetching categories: {e}")
-                return []
-            finally:
-                if 'cur' in locals():
-                    cur.close()
-                if 'conn' in locals():
-                    conn.close()
+                return pd.DataFrame(columns=rollup.ROLLUP_COLUMNS)
+
+        category_rollup = fetch_category_rollup()
 
+        @metrics.tagged("fetch_all_categories")
+        def fetch_all_categories():
+            """
+            Category counts across all municipalities
+            """
+            return rollup.all_categories(category_rollup)
+
+        @metrics.tagged("fetch_categories_by_municipality")
         def fetch_categories_by_municipality():
             """
-            Fetch category data grouped by municipality
+            Category counts grouped by municipality
             """
-            try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-
-                query = """
-                SELECT 
-                    municipality,
-                    category,
-                    COUNT(*) as count
-                FROM sourceview.foraisearch_with_search
-                WHERE category IS NOT NULL
-                GROUP BY municipality, category
-                ORDER BY municipality, count DESC
-                """
-
-                cur.execute(query)
-                results = cur.fetchall()
-                return results
-            except Exception as e:
-                st.error(f"Error fetching municipality categories: {e}")
-                return []
-            finally:
-                if 'cur' in locals():
-                    cur.close()
-                if 'conn' in locals():
-                    conn.close()
+            return rollup.categories_by_municipality(category_rollup)
 
+        @metrics.tagged("fetch_municipality_categories")
         def fetch_municipality_categories(municipality):
             """
             Fetch categories for a specific municipality
             """
-            try:
-                conn = get_db_connection()
-                cur = conn.cursor()
-
-                query = """
-                SELECT 
-                    category,
-                    COUNT(*) as count
-                FROM sourceview.foraisearch_with_search
-                WHERE municipality = %s
-                AND category IS NOT NULL
-                GROUP BY category
-                ORDER BY count DESC
-                """
-
-                cur.execute(query, [municipality])
-                results = cur.fetchall()
-                return results
-            except Exception as e:
-                st.error(f"Error fetching municipality categories: {e}")
-                return []
-            finally:
-                if 'cur' in locals():
-                    cur.close()
-                if 'conn' in locals():
-                    conn.close()
+            return rollup.municipality_categories(category_rollup, municipality)
 
         def show_popular_categories():
             """
             Display overall category frequency
             """
             st.header("Populære Kategorier (Alle Kommuner)")
-            categories = fetch_all_categories()
-
-            if categories:
-                # Convert to DataFrame
-                df = pd.DataFrame(categories)
+            df = fetch_all_categories()
 
+            if not df.empty:
                 # Display table
                 st.dataframe(df)
 
@@ -531,12 +730,9 @@ def main():
             Display categories across municipalities
             """
             st.header("Kategorier efter Kommuner (Samlet Overblik)")
-            results = fetch_categories_by_municipality()
-
-            if results:
-                # Convert to DataFrame
-                df = pd.DataFrame(results)
+            df = fetch_categories_by_municipality()
 
+            if not df.empty:
                 # Create Altair chart
                 chart = alt.Chart(df).mark_bar().encode(
                     x=alt.X("category:N", sort='-y'),
@@ -557,21 +753,11 @@ def main():
             """
             st.header("Kategorier for Udvalgte Kommuner")
 
-            # Get unique municipalities
-            conn = get_db_connection()
-            cur = conn.cursor()
-            cur.execute("SELECT DISTINCT municipality FROM sourceview.foraisearch_with_search ORDER BY municipality")
-            municipalities = ["Alle"] + [row['municipality'] for row in cur.fetchall()]
-            cur.close()
-            conn.close()
-
-            selected_muni = st.selectbox("Vælg en kommune:", municipalities)
+            selected_muni = st.selectbox("Vælg en kommune:", fetch_municipalities())
 
             if selected_muni != "Alle":
-                results = fetch_municipality_categories(selected_muni)
-                if results:
-                    df = pd.DataFrame(results)
-
+                df = fetch_municipality_categories(selected_muni)
+                if not df.empty:
                     # Show table
                     st.dataframe(df)
 
@@ -588,6 +774,68 @@ def main():
                 else:
                     st.write("Ingen kategorier fundet for denne kommune.")
 
+        @metrics.tagged("fetch_category_trends")
+        def fetch_category_trends():
+            """
+            Fetch the (municipality, category, month, count) trends rollup, which is
+            maintained incrementally after each refresh (see rollup.py)
+            """
+            try:
+                return rollup.load_category_trends()
+            except Exception as e:
+                st.error(f"Error fetching trends: {e}")
+                return pd.DataFrame(columns=rollup.TREND_COLUMNS)
+
+        def show_category_trends():
+            """
+            Display category frequency over time, per month, quarter or year
+            """
+            st.header("Udvikling over Tid")
+            trends = fetch_category_trends()
+            if trends.empty:
+                st.write("Ingen data fundet.")
+                return
+
+            col1, col2 = st.columns(2)
+            with col1:
+                trend_muni = st.selectbox("Kommune:", fetch_municipalities(), key="trend_municipality")
+            municipality = None if trend_muni == "Alle" else trend_muni
+            with col2:
+                resolution_labels = {"Automatisk": "auto", "Måned": "month", "Kvartal": "quarter", "År": "year"}
+                resolution_label = st.radio("Opløsning:", list(resolution_labels), horizontal=True,
+                                            key="trend_resolution")
+
+            categories = st.multiselect(
+                "Kategorier:",
+                sorted(trends["category"].unique()),
+                default=rollup.top_categories(trends, 5, municipality),
+                key="trend_categories"
+            )
+            first_month = trends["month"].min().date()
+            last_month = trends["month"].max().date()
+            start_month, end_month = st.slider("Periode:", min_value=first_month, max_value=last_month,
+                                               value=(first_month, last_month), format="MM/YYYY",
+                                               key="trend_period")
+
+            df = rollup.category_trends(trends, municipality, categories, start_month, end_month)
+            df, resolution = rollup.downsample_trends(df, resolution_labels[resolution_label])
+            if df.empty:
+                st.write("Ingen data fundet for det valgte.")
+                return
+
+            time_units = {"month": "yearmonth", "quarter": "yearquarter", "year": "year"}
+            chart = alt.Chart(df).mark_line(point=len(df) <= 400).encode(
+                x=alt.X(f"{time_units[resolution]}(period):T", title="Periode"),
+                y=alt.Y("count:Q", title="Antal"),
+                color=alt.Color("category:N", title="Kategori"),
+                tooltip=[alt.Tooltip(f"{time_units[resolution]}(period):T", title="Periode"),
+                         "category:N", "count:Q"]
+            ).properties(
+                width=600,
+                height=400
+            )
+            st.altair_chart(chart, use_container_width=True)
+
         # Main function for tab 2
         def popular_topics_app():
             """
@@ -605,11 +853,21 @@ def main():
 
             # Show categories for single municipality
             show_categories_for_single_municipality()
+            st.write("---")
+
+            # Show category trends over time
+            show_category_trends()
 
         popular_topics_app()
 
         # st.write("This section is currently under development.")
 
+    # =====================
+    # Driftsfane (skjult)
+    # =====================
+    if page == ADMIN_PAGE:
+        show_admin_panel()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,502 @@
+"""
+Benchmark af appens varme stier mod en lokal Postgres med syntetiske data.
+
+Generér et syntetisk korpus (10k-10M rækker, dansk tekst, skæv fordeling af
+kommuner og kategorier) i en SEPARAT benchmark-database og kør migreringerne:
+    DB_NAME=kommunedata_bench python benchmark.py generate --rows 100000 --reset
+
+Mål søgning, opdatering af view'et og kategorifanen; resultatet gemmes som JSON:
+    DB_NAME=kommunedata_bench SNAPSHOT_DIR=/tmp/bench_snapshot python benchmark.py run --repeat 20
+
+Sammenlign to kørsler (fx før og efter en ændring):
+    python benchmark.py compare benchmark_results/A.json benchmark_results/B.json
+"""
+import argparse
+import glob
+import json
+import os
+import resource
+import statistics
+import subprocess
+import time
+import tracemalloc
+from datetime import date, datetime, timedelta, timezone
+
+import metrics
+import refresh
+import rollup
+import search
+from db import DB_NAME, db_cursor
+
+# =====================
+# Benchmark Settings
+# =====================
+BENCH_RESULTS_DIR = os.getenv("BENCH_RESULTS_DIR", "benchmark_results")
+SYNTHETIC_TABLE = "source.synthetic_meetings"
+GENERATE_CHUNK = 100_000
+
+# Roughly ordered by size, so the skewed draw favours the large municipalities
+MUNICIPALITIES = [
+    "København", "Aarhus", "Aalborg", "Odense", "Vejle", "Esbjerg", "Frederiksberg", "Randers", "Viborg",
+    "Silkeborg", "Kolding", "Horsens", "Herning", "Roskilde", "Næstved", "Slagelse", "Gentofte", "Holbæk",
+    "Sønderborg", "Gladsaxe", "Hjørring", "Skanderborg", "Helsingør", "Køge", "Guldborgsund", "Frederikshavn",
+    "Holstebro", "Svendborg", "Aabenraa", "Lyngby-Taarbæk", "Ringkøbing-Skjern", "Haderslev", "Hillerød",
+    "Kalundborg", "Favrskov", "Varde", "Rudersdal", "Vordingborg", "Ikast-Brande", "Hedensted", "Faaborg-Midtfyn",
+    "Thisted", "Skive", "Ballerup", "Lolland", "Fredericia", "Hvidovre", "Syddjurs", "Mariagerfjord",
+    "Tønder", "Middelfart", "Odsherred", "Norddjurs", "Vesthimmerland", "Brønderslev", "Assens", "Jammerbugt",
+    "Ringsted", "Billund", "Struer", "Lemvig", "Samsø", "Ærø", "Fanø", "Læsø",
+]
+CATEGORIES = [
+    "Økonomi og budget", "Plan og byggeri", "Børn og unge", "Ældre og sundhed", "Skole og uddannelse",
+    "Teknik og miljø", "Klima og energi", "Trafik og veje", "Beskæftigelse", "Kultur og fritid",
+    "Social og handicap", "Forsyning", "Erhverv og turisme", "Personale", "Digitalisering",
+    "Boliger", "Natur", "Beredskab", "Integration", "Valg og demokrati",
+]
+# Common words first: the skewed draw gives a Zipf-like word frequency
+VOCABULARY = [
+    "kommunen", "budget", "forslag", "udvalget", "godkendelse", "byrådet", "sagen", "borgere", "anlæg",
+    "bevilling", "lokalplan", "skole", "daginstitution", "ældreboliger", "fjernvarme", "takster", "udbud",
+    "klimatilpasning", "renovering", "vedligeholdelse", "trafiksikkerhed", "cykelsti", "kloakering",
+    "spildevand", "affald", "genbrug", "plejehjem", "hjemmehjælp", "sundhedshus", "bibliotek", "idrætshal",
+    "svømmehal", "kulturhus", "boligområde", "erhvervsområde", "byfornyelse", "landdistrikter", "vandværk",
+    "naturgenopretning", "skovrejsning", "solceller", "varmepumpe", "energirenovering", "kollektiv", "trafik",
+    "busrute", "parkering", "byggetilladelse", "dispensation", "høring", "indsigelse", "kommuneplan",
+    "tillæg", "regnskab", "halvårsregnskab", "overførsel", "anlægsbevilling", "garantistillelse", "lån",
+    "ejendom", "salg", "køb", "grund", "udstykning", "personalepolitik", "whistleblower", "arbejdsmiljø",
+    "sygefravær", "rekruttering", "digitalisering", "velfærdsteknologi", "tilsyn", "kvalitetsrapport",
+    "inklusion", "specialundervisning", "ungdomsuddannelse", "beskæftigelsesindsats", "integration",
+    "flygtninge", "boligsocial", "helhedsplan", "beredskab", "oversvømmelse", "kystbeskyttelse", "dige",
+    "vandløb", "grøn", "omstilling", "strategi", "handleplan", "politik", "evaluering", "orientering",
+    "beslutning", "økonomiudvalget", "teknikudvalget", "børneudvalget", "socialudvalget", "kulturudvalget",
+    "tilskud", "pulje", "ansøgning", "samarbejde", "aftale", "kontrakt", "leverandør", "licitation",
+]
+
+DEFAULT_QUERIES = {
+    "single_word": "budget",
+    "multi_word": "lokalplan boligområde",
+    "prefix": "fjernvarm*",
+    "phrase": '"kollektiv trafik"',
+    "or": "skole OR daginstitution",
+    "not": "budget -anlæg",
+    "typo": "fjernvarne",
+    "rare_word": VOCABULARY[-1],
+}
+
+RANGE_WIDTHS_DAYS = (30, 90, 365, 3 * 365)
+
+SCAN_NODES = ("Seq Scan", "Bitmap Heap Scan", "Index Scan", "Index Only Scan")
+
+# The search as app.py ran it before the single-statement rewrite: the rows and the count in two
+# statements, both scoring every row of the view. Kept verbatim (including the ORDER BY/LIMIT that
+# only applied with a municipality) as the baseline for the search/*/legacy_two_query cases.
+LEGACY_SIMILARITY_SQL = """similarity(
+        (((((((((COALESCE(municipality, '')::text || ' ') ||
+        COALESCE(title, '')::text) || ' ') ||
+        COALESCE(category, '')::text) || ' ') ||
+        COALESCE(description, '')::text) || ' ') ||
+        COALESCE(future_action, '')::text) || ' ') ||
+        COALESCE(subject_title, '')::text,
+        %s
+    )"""
+LEGACY_SCORED_SQL = f"""
+    FROM (
+        SELECT
+            *,
+            ts_rank(search_vector, plainto_tsquery('danish', %s)) as ts_rank_score,
+            {LEGACY_SIMILARITY_SQL} as similarity_score
+        FROM sourceview.foraisearch_with_search
+    ) t
+    WHERE t.search_vector @@ plainto_tsquery('danish', %s)
+       OR t.search_vector @@ to_tsquery('danish', %s)
+       OR t.similarity_score > 0.05"""
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def check_benchmark_database(cur):
+    """Refuse to touch a database that has the real source tables"""
+    cur.execute("SELECT to_regclass('source.referater') IS NOT NULL AS is_real")
+    if cur.fetchone()["is_real"]:
+        raise SystemExit(f"Database {DB_NAME!r} has source.referater; use a separate benchmark database")
+
+
+# =====================
+# Corpus generator
+# =====================
+def create_synthetic_table(cur, reset=False):
+    """
+    Create SYNTHETIC_TABLE (dropping it and the search view first with `reset`)
+    and the pg_temp helpers that generate() fills it with.
+    """
+    if reset:
+        cur.execute(f"""
+            DROP MATERIALIZED VIEW IF EXISTS sourceview.foraisearch_with_search CASCADE;
+            DROP TABLE IF EXISTS {SYNTHETIC_TABLE};
+            DROP TABLE IF EXISTS sourceview.view_refresh_log;
+        """)
+    cur.execute(f"""
+        CREATE SCHEMA IF NOT EXISTS source;
+        CREATE SCHEMA IF NOT EXISTS sourceview;
+        CREATE TABLE IF NOT EXISTS {SYNTHETIC_TABLE} (
+            id               bigint PRIMARY KEY,
+            municipality     text,
+            date             date,
+            title            text,
+            subject_title    text,
+            summary          text,
+            description      text,
+            future_action    text,
+            search_sentences text,
+            tags             text[],
+            category         text,
+            decided_or_not   boolean,
+            amount           numeric,
+            content_url      text
+        );
+        -- power(random(), skew) picks early array entries far more often than late ones
+        CREATE OR REPLACE FUNCTION pg_temp.pick(items text[], skew float8) RETURNS text
+            LANGUAGE sql VOLATILE
+            AS $$ SELECT items[1 + floor(power(random(), skew) * array_length(items, 1))::int] $$;
+        CREATE OR REPLACE FUNCTION pg_temp.words(vocabulary text[], n int) RETURNS text
+            LANGUAGE sql VOLATILE
+            AS $$ SELECT string_agg(pg_temp.pick(vocabulary, 2.0), ' ') FROM generate_series(1, n) $$;
+    """)
+
+
+def build_view(cur, verbose=True):
+    """
+    Build the search view on top of SYNTHETIC_TABLE and run the migrations in
+    sql/ the same way as on a real database
+    """
+    # The view as it looks before the migrations; they add search_text, meeting_date and the indexes
+    cur.execute(f"""
+        CREATE MATERIALIZED VIEW IF NOT EXISTS sourceview.foraisearch_with_search AS
+        SELECT
+            m.*,
+            to_tsvector('danish', concat_ws(' ', m.municipality, m.title, m.category, m.description,
+                                            m.future_action, m.subject_title)) AS search_vector
+        FROM {SYNTHETIC_TABLE} m
+    """)
+    cur.connection.commit()
+
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql", "*.sql"))):
+        if verbose:
+            print(f"Running {os.path.basename(path)}")
+        with open(path) as f:
+            cur.execute(f.read())
+        cur.connection.commit()
+
+
+def generate(rows, reset=False, seed=0.42):
+    """
+    Fill SYNTHETIC_TABLE with `rows` synthetic agenda items, build the search
+    view on top of it and run the migrations in sql/ the same way as on a real
+    database. Rows are generated inside Postgres, so 10M rows do not pass
+    through Python.
+    """
+    with db_cursor(commit=True) as cur:
+        check_benchmark_database(cur)
+        create_synthetic_table(cur, reset)
+        cur.execute("SELECT setseed(%s)", [seed])
+        cur.execute(f"SELECT COALESCE(MAX(id), 0) AS max_id FROM {SYNTHETIC_TABLE}")
+        first_id = cur.fetchone()["max_id"] + 1
+
+        started = time.monotonic()
+        params = {"municipalities": MUNICIPALITIES, "categories": CATEGORIES, "vocabulary": VOCABULARY,
+                  "first_date": date.today() - timedelta(days=10 * 365), "days": 10 * 365}
+        for chunk_start in range(first_id, first_id + rows, GENERATE_CHUNK):
+            params.update(start=chunk_start, stop=min(chunk_start + GENERATE_CHUNK, first_id + rows) - 1)
+            cur.execute(f"""
+                INSERT INTO {SYNTHETIC_TABLE}
+                SELECT
+                    g,
+                    pg_temp.pick(%(municipalities)s, 2.5),
+                    %(first_date)s::date + floor(random() * %(days)s)::int,
+                    'Dagsordenspunkt ' || g,
+                    initcap(pg_temp.words(%(vocabulary)s, 3 + (g %% 4)::int)),
+                    pg_temp.words(%(vocabulary)s, 25 + (g %% 30)::int),
+                    pg_temp.words(%(vocabulary)s, 40 + (g %% 60)::int),
+                    pg_temp.words(%(vocabulary)s, 10 + (g %% 15)::int),
+                    pg_temp.words(%(vocabulary)s, 8 + (g %% 8)::int),
+                    ARRAY[pg_temp.pick(%(vocabulary)s, 1.5), pg_temp.pick(%(vocabulary)s, 1.5),
+                          pg_temp.pick(%(vocabulary)s, 1.5)],
+                    CASE WHEN random() < 0.9 THEN pg_temp.pick(%(categories)s, 1.8) END,
+                    random() < 0.6,
+                    CASE WHEN random() < 0.3 THEN round((random() * 10000000)::numeric) END,
+                    'https://example.invalid/referat/' || g || '.pdf'
+                FROM generate_series(%(start)s::bigint, %(stop)s::bigint) g
+            """, params)
+            cur.connection.commit()
+            print(f"{params['stop'] - first_id + 1}/{rows} rows ({time.monotonic() - started:.0f} s)")
+
+        build_view(cur)
+
+    generation = refresh.refresh_view(force=True)
+    print(f"Generated {rows} rows in {time.monotonic() - started:.0f} s; view generation {generation}")
+
+
+# =====================
+# Measurements
+# =====================
+def percentiles(samples):
+    """p50/p95/p99 and mean in ms"""
+    if len(samples) == 1:
+        p50 = p95 = p99 = samples[0]
+    else:
+        cuts = statistics.quantiles(samples, n=100, method="inclusive")
+        p50, p95, p99 = cuts[49], cuts[94], cuts[98]
+    return {"p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "mean_ms": statistics.fmean(samples)}
+
+
+def scan_stats(plan):
+    """Rows read from tables (returned + removed by filters) and buffer blocks in an EXPLAIN ANALYZE plan"""
+    rows = 0
+    if plan["Node Type"] in SCAN_NODES:
+        rows += (plan["Actual Rows"] + plan.get("Rows Removed by Filter", 0)
+                 + plan.get("Rows Removed by Index Recheck", 0)) * plan["Actual Loops"]
+    for child in plan.get("Plans", []):
+        rows += scan_stats(child)["rows_scanned"]
+    return {
+        "rows_scanned": rows,
+        "shared_hit_blocks": plan.get("Shared Hit Blocks"),
+        "shared_read_blocks": plan.get("Shared Read Blocks"),
+    }
+
+
+def measure(name, func, repeat, params=None, plan=None, setup=None):
+    """
+    Time `func` `repeat` times (after one warm-up call) and return one result
+    record. Python allocations are measured in a separate call, so tracemalloc
+    does not distort the timings.
+    """
+    if setup:
+        setup()
+    result = func()
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        result = func()
+        samples.append((time.perf_counter() - started) * 1000)
+
+    if setup:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    record = {"name": name, "params": params or {}, "n": repeat, **percentiles(samples),
+              "python_peak_kb": peak / 1024}
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        record["rows_returned"] = len(result[0])
+    elif hasattr(result, "__len__"):
+        record["rows_returned"] = len(result)
+    if plan:
+        record.update(scan_stats(plan()))
+    print(f"{name:<48} p50 {record['p50_ms']:8.1f} ms  p95 {record['p95_ms']:8.1f} ms  "
+          f"p99 {record['p99_ms']:8.1f} ms")
+    return record
+
+
+def legacy_search(query_text, municipality=None, limit=20):
+    """The two-query search path from before the single-statement rewrite, for comparison"""
+    wildcard_query = " | ".join(f"{word}:*" for word in query_text.split())
+    params = [query_text, query_text, query_text, wildcard_query]
+    query = f"""
+        SELECT
+            t.id, t.municipality, t.date, t.title, t.summary, t.tags, t.content_url, t.category,
+            t.search_sentences, t.decided_or_not, t.future_action, t.description, t.subject_title, t.amount,
+            COALESCE(ts_rank_score, 0) as ts_rank_score,
+            COALESCE(similarity_score, 0) as similarity_score
+        {LEGACY_SCORED_SQL}"""
+    count_query = f"SELECT COUNT(*) {LEGACY_SCORED_SQL}"
+    count_params = list(params)
+    if municipality and municipality != "Alle":
+        query += f"""
+            AND municipality = %s
+            ORDER BY ((ts_rank(search_vector, plainto_tsquery('danish', %s))) + ({LEGACY_SIMILARITY_SQL}) * 0.8) DESC
+            LIMIT %s"""
+        params += [municipality, query_text, query_text, limit]
+        count_query += " AND municipality = %s"
+        count_params.append(municipality)
+    with db_cursor() as cur:
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.execute(count_query, count_params)
+        total_count = cur.fetchone()["count"]
+    return rows, total_count
+
+
+def municipality_sizes():
+    with db_cursor() as cur:
+        cur.execute(f"SELECT municipality, COUNT(*) AS n FROM {search.VIEW_NAME} GROUP BY 1 ORDER BY 2 DESC")
+        return [row["municipality"] for row in cur.fetchall()]
+
+
+def refresh_statement():
+    """Only the REFRESH MATERIALIZED VIEW CONCURRENTLY that refresh_view() runs, without its callbacks"""
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {refresh.VIEW_NAME}")
+
+
+def explain_rollup():
+    with db_cursor() as cur:
+        cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT municipality, category, count "
+                    f"FROM {rollup.CATEGORY_ROLLUP_VIEW}")
+        return cur.fetchone()["QUERY PLAN"][0]["Plan"]
+
+
+def run(repeat=20, refresh_repeat=3, queries=None):
+    """Run every benchmark case and return the results document"""
+    queries = queries or DEFAULT_QUERIES
+    # The instrumentation would be timed along with every call, and its slow-query
+    # EXPLAIN ANALYZE runs the searches a second time on another connection
+    metrics.METRICS_ENABLED = False
+    with db_cursor() as cur:
+        check_benchmark_database(cur)
+        cur.execute(f"SELECT COUNT(*) AS n FROM {search.VIEW_NAME}")
+        row_count = cur.fetchone()["n"]
+        cur.execute("SELECT version() AS version")
+        pg_version = cur.fetchone()["version"]
+    refresh.load_generation()
+
+    by_size = municipality_sizes()
+    municipality_cases = {"Alle": "Alle", "large": by_size[0], "small": by_size[-1]}
+    results = []
+
+    for shape, query_text in queries.items():
+        for scope, municipality in municipality_cases.items():
+            params = {"query_text": query_text, "municipality": municipality}
+            results.append(measure(
+                f"search/{shape}/{scope}",
+                lambda: search.search(query_text, municipality, limit=20, use_cache=False),
+                repeat, params,
+                plan=lambda: search.explain_search(query_text, analyze=True, municipality=municipality),
+            ))
+    for shape in ("single_word", "multi_word", "typo"):
+        for scope in ("Alle", "large"):
+            query_text, municipality = queries[shape], municipality_cases[scope]
+            results.append(measure(
+                f"search/{shape}/{scope}/legacy_two_query",
+                lambda: legacy_search(query_text, municipality),
+                max(3, repeat // 4), {"query_text": query_text, "municipality": municipality},
+            ))
+    # Latency against the width of the date range, "Alle" and the largest municipality
+    for days in RANGE_WIDTHS_DAYS:
+        start_date = date.today() - timedelta(days=days)
+        for scope in ("Alle", "large"):
+            municipality = municipality_cases[scope]
+            results.append(measure(
+                f"search/single_word/{scope}/last_{days}_days",
+                lambda: search.search(queries["single_word"], municipality, start_date=start_date, limit=20,
+                                      use_cache=False),
+                repeat, {"query_text": queries["single_word"], "municipality": municipality,
+                         "start_date": start_date.isoformat(), "days": days},
+                plan=lambda: search.explain_search(queries["single_word"], analyze=True, municipality=municipality,
+                                                   start_date=start_date),
+            ))
+    results.append(measure(
+        "search/single_word/Alle/page_2",
+        lambda: search.search(queries["single_word"], limit=20, with_count=False, use_cache=False,
+                              after=_second_page(queries["single_word"])),
+        repeat, {"query_text": queries["single_word"]},
+    ))
+
+    # Category tab: the rollup load (snapshot or live, as in the app) plus each derived table
+    def clear_rollup_cache():
+        rollup.rollup_cache.clear()
+
+    for name, func in (
+        ("fetch_all_categories", lambda: rollup.all_categories(rollup.load_category_rollup())),
+        ("fetch_categories_by_municipality", lambda: rollup.categories_by_municipality(rollup.load_category_rollup())),
+        ("fetch_municipality_categories", lambda: rollup.municipality_categories(rollup.load_category_rollup(),
+                                                                                by_size[0])),
+    ):
+        results.append(measure(f"categories/{name}", func, repeat, setup=clear_rollup_cache, plan=explain_rollup))
+
+    # The REFRESH statement on its own, and the whole refresh_view() with the on_refresh callbacks
+    # (rollup, trends, snapshot, ...) that run after it
+    results.append(measure("refresh_materialized_view/statement", refresh_statement, refresh_repeat))
+    results.append(measure("refresh_materialized_view/with_callbacks", lambda: refresh.refresh_view(force=True),
+                           refresh_repeat))
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "rows": row_count,
+        "postgres": pg_version,
+        "search_backend": search.SEARCH_BACKEND,
+        "peak_rss_mb": peak_rss_mb(),
+        "results": results,
+    }
+
+
+def _second_page(query_text):
+    rows, _ = search.search(query_text, limit=20, with_count=False, use_cache=False)
+    return (rows[-1]["score"], rows[-1]["id"]) if rows else None
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(document):
+    os.makedirs(BENCH_RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(BENCH_RESULTS_DIR, f"{stamp}-{document['rows']}-rows.json")
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, default=str)
+    return path
+
+
+def compare(old_path, new_path, threshold=0.10):
+    """Print p50/p95 per case for two result files and flag slowdowns above `threshold`"""
+    with open(old_path) as f:
+        old = {record["name"]: record for record in json.load(f)["results"]}
+    with open(new_path) as f:
+        new = {record["name"]: record for record in json.load(f)["results"]}
+    regressions = 0
+    for name, record in new.items():
+        if name not in old:
+            continue
+        changes = []
+        for metric in ("p50_ms", "p95_ms"):
+            change = record[metric] / old[name][metric] - 1 if old[name][metric] else 0.0
+            changes.append(change)
+            regressions += change > threshold
+        flag = "  <-- slower" if max(changes) > threshold else ""
+        print(f"{name:<48} p50 {old[name]['p50_ms']:8.1f} -> {record['p50_ms']:8.1f} ms ({changes[0]:+.0%})  "
+              f"p95 {old[name]['p95_ms']:8.1f} -> {record['p95_ms']:8.1f} ms ({changes[1]:+.0%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    generate_parser = subparsers.add_parser("generate", help="generate a synthetic corpus in the benchmark database")
+    generate_parser.add_argument("--rows", type=int, default=100_000)
+    generate_parser.add_argument("--reset", action="store_true", help="drop the synthetic data first")
+    run_parser = subparsers.add_parser("run", help="run the benchmarks and save the results as JSON")
+    run_parser.add_argument("--repeat", type=int, default=20)
+    run_parser.add_argument("--refresh-repeat", type=int, default=3)
+    compare_parser = subparsers.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        generate(args.rows, args.reset)
+    elif args.command == "run":
+        print(f"Results: {save(run(args.repeat, args.refresh_repeat))}")
+    elif compare(args.old, args.new, args.threshold):
+        raise SystemExit(1)
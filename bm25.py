@@ -0,0 +1,337 @@
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+
+import numpy as np
+from nltk.stem.snowball import SnowballStemmer
+from rapidfuzz import fuzz, process
+
+import refresh
+from db import db_cursor
+from search import LIST_COLUMNS, SIMILARITY_WEIGHT, VIEW_NAME, clamp_limit
+from tsquery import parse_query
+
+# =====================
+# BM25 Settings
+# =====================
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+PREFIX_WEIGHT = 0.5  # word:* matches count less than exact stems
+MAX_PREFIX_TERMS = 100  # most frequent expansions per prefix
+FUZZY_CUTOFF = float(os.getenv("BM25_FUZZY_CUTOFF", "80"))  # RapidFuzz score 0-100
+MAX_FUZZY_TERMS = 10
+FETCH_CHUNK = 5000
+
+TOKEN_RE = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+_stemmer = SnowballStemmer("danish")
+_stem_cache = {}
+
+
+def stem(token):
+    """Danish Snowball stem, memoised (the vocabulary is small compared to the number of tokens)"""
+    stemmed = _stem_cache.get(token)
+    if stemmed is None:
+        stemmed = _stem_cache[token] = _stemmer.stem(token)
+    return stemmed
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_RE.findall((text or "").lower())]
+
+
+class BM25Index:
+    """
+    Immutable inverted index over one snapshot of the search view.
+
+    Postings are stored CSR-style in flat NumPy arrays: the documents and term
+    frequencies of term t are postings_docs/postings_tfs[indptr[t]:indptr[t + 1]].
+    Documents are numbered in id order, which is also the tie-break order.
+    """
+
+    def __init__(self, headers, meeting_dates, doc_terms, terms, generation):
+        self.generation = generation
+        self.headers = headers
+        self.ids = [row["id"] for row in headers]
+        self.id_to_doc = {doc_id: doc for doc, doc_id in enumerate(self.ids)}
+        n_docs = len(headers)
+        n_terms = len(terms)
+
+        municipalities = sorted({row["municipality"] for row in headers if row["municipality"] is not None})
+        self.municipality_codes = {name: code for code, name in enumerate(municipalities)}
+        self.doc_municipality = np.array(
+            [self.municipality_codes.get(row["municipality"], -1) for row in headers], dtype=np.int32)
+        self.doc_date = np.array(meeting_dates, dtype="datetime64[D]")
+        self.subject_titles = [row["subject_title"] or "" for row in headers]
+
+        counts = np.array([len(term_ids) for term_ids, _ in doc_terms], dtype=np.int64)
+        term_ids = np.concatenate([t for t, _ in doc_terms]) if n_docs else np.zeros(0, np.int32)
+        tfs = np.concatenate([f for _, f in doc_terms]) if n_docs else np.zeros(0, np.float32)
+        doc_ids = np.repeat(np.arange(n_docs, dtype=np.int32), counts)
+
+        order = np.argsort(term_ids, kind="stable")
+        self.postings_docs = doc_ids[order]
+        self.postings_tfs = tfs[order]
+        self.indptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=n_terms), out=self.indptr[1:])
+
+        self.doc_freq = np.diff(self.indptr)
+        self.idf = np.log(1 + (n_docs - self.doc_freq + 0.5) / (self.doc_freq + 0.5))
+        self.doc_len = np.array([f.sum() for _, f in doc_terms], dtype=np.float32)
+        self.avg_doc_len = float(self.doc_len.mean()) if n_docs else 0.0
+
+        # Sorted vocabulary of terms present in this snapshot, for prefix and fuzzy lookups
+        present = np.nonzero(self.doc_freq)[0]
+        vocabulary = sorted((terms[t], int(t)) for t in present)
+        self.sorted_terms = [term for term, _ in vocabulary]
+        self.sorted_term_ids = np.array([t for _, t in vocabulary], dtype=np.int64)
+        self.term_ids = {term: t for term, t in vocabulary}
+
+    @property
+    def n_docs(self):
+        return len(self.ids)
+
+    def nbytes(self):
+        """Memory held by the NumPy arrays of the index"""
+        arrays = (self.postings_docs, self.postings_tfs, self.indptr, self.doc_freq, self.idf,
+                  self.doc_len, self.doc_municipality, self.doc_date, self.sorted_term_ids)
+        return sum(array.nbytes for array in arrays)
+
+    def prefix_terms(self, prefix):
+        """Term ids starting with `prefix`, the most frequent first"""
+        start = bisect_left(self.sorted_terms, prefix)
+        end = bisect_left(self.sorted_terms, prefix + "\uffff")
+        candidates = self.sorted_term_ids[start:end]
+        if len(candidates) > MAX_PREFIX_TERMS:
+            candidates = candidates[np.argsort(-self.doc_freq[candidates], kind="stable")[:MAX_PREFIX_TERMS]]
+        return candidates
+
+    def fuzzy_terms(self, word):
+        """(term id, score 0-1) for vocabulary terms close to `word` (typo tolerance instead of pg_trgm)"""
+        matches = process.extract(word, self.sorted_terms, scorer=fuzz.ratio,
+                                  score_cutoff=FUZZY_CUTOFF, limit=MAX_FUZZY_TERMS)
+        return [(int(self.sorted_term_ids[position]), score / 100) for _, score, position in matches]
+
+    def _bm25(self, weights):
+        scores = np.zeros(self.n_docs, dtype=np.float64)
+        k1, b = BM25_K1, BM25_B
+        for term_id, weight in weights.items():
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.postings_docs[start:end]
+            tfs = self.postings_tfs[start:end]
+            norm = k1 * (1 - b + b * self.doc_len[docs] / self.avg_doc_len)
+            scores[docs] += weight * self.idf[term_id] * tfs * (k1 + 1) / (tfs + norm)
+        return scores
+
+    def _docs_with(self, term_ids):
+        """Boolean mask of the documents containing any of `term_ids`"""
+        mask = np.zeros(self.n_docs, dtype=bool)
+        for term_id in term_ids:
+            mask[self.postings_docs[self.indptr[term_id]:self.indptr[term_id + 1]]] = True
+        return mask
+
+    def _term_mask(self, words, prefix):
+        """
+        Documents containing every word of a term; the last word is matched as
+        a prefix when `prefix` is set. Word order is not checked, so a phrase
+        matches a little more loosely than <-> does in Postgres.
+        """
+        mask = np.ones(self.n_docs, dtype=bool)
+        for position, word in enumerate(words):
+            if prefix and position == len(words) - 1:
+                term_ids = self.prefix_terms(stem(word))
+            else:
+                exact = self.term_ids.get(stem(word))
+                term_ids = [] if exact is None else [exact]
+            mask &= self._docs_with(term_ids)
+        return mask
+
+    def search(self, query_text="", municipality=None, start_date=None, end_date=None, limit=20,
+               with_count=True, after=None):
+        """
+        Same contract as search.search(): (rows, total_count) for one page.
+
+        The query text goes through tsquery.parse_query like in Postgres, so
+        OR, "phrases", word* and -excluded words mean the same in both backends.
+        score = bm25 (normalised to the best hit) + SIMILARITY_WEIGHT * fuzzy
+        similarity, mirroring ts_rank + 0.8 * similarity in Postgres.
+        """
+        limit = clamp_limit(limit)
+        parsed = parse_query(query_text)
+        terms = parsed.positive
+        words = [word for term_words, _ in terms for word in term_words]
+        if not words or not self.n_docs:
+            return [], (0 if with_count else None)
+
+        # to_tsquery / word:* / pg_trgm counterparts: a single word matches as a
+        # prefix (or fuzzily), a phrase needs all of its words
+        weights = {}
+        matched = np.zeros(self.n_docs, dtype=bool)
+        fuzzy = np.zeros(self.n_docs, dtype=np.float64)
+        for term_words, prefix in terms:
+            for word in term_words:
+                for term_id in self.prefix_terms(stem(word)):
+                    weights[int(term_id)] = max(weights.get(int(term_id), 0.0), PREFIX_WEIGHT)
+                exact = self.term_ids.get(stem(word))
+                if exact is not None:
+                    weights[exact] = 1.0
+            if len(term_words) == 1:
+                matched |= self._docs_with(self.prefix_terms(stem(term_words[0])))
+                for term_id, score in self.fuzzy_terms(term_words[0]):
+                    docs = self.postings_docs[self.indptr[term_id]:self.indptr[term_id + 1]]
+                    fuzzy[docs] = np.maximum(fuzzy[docs], score)
+            else:
+                matched |= self._term_mask(term_words, prefix)
+
+        # NOT terms remove the documents that contain them, fuzzy hits included
+        for term_words, prefix in parsed.excluded:
+            excluded = self._term_mask(term_words, prefix)
+            matched &= ~excluded
+            fuzzy[excluded] = 0.0
+
+        text_scores = self._bm25(weights)
+        candidates = np.nonzero(matched | (fuzzy > 0))[0]
+
+        # Filters
+        if municipality and municipality != "Alle":
+            code = self.municipality_codes.get(municipality, -2)
+            candidates = candidates[self.doc_municipality[candidates] == code]
+        if start_date:
+            candidates = candidates[self.doc_date[candidates] >= np.datetime64(start_date, "D")]
+        if end_date:
+            candidates = candidates[self.doc_date[candidates] <= np.datetime64(end_date, "D")]
+
+        text_scores = text_scores[candidates]
+        best = text_scores.max() if len(text_scores) else 0.0
+        ts_rank_scores = text_scores / best if best > 0 else text_scores
+        query = " ".join(words)
+        titles = [self.subject_titles[doc] for doc in candidates]
+        title_similarity = (process.cdist([query], titles, scorer=fuzz.partial_ratio, workers=-1)[0] / 100
+                            if titles else np.zeros(0))
+        similarity_scores = np.maximum(fuzzy[candidates], title_similarity)
+        scores = ts_rank_scores + similarity_scores * SIMILARITY_WEIGHT
+        total_count = len(candidates)
+
+        # Keyset pagination on (score DESC, id)
+        if after is not None:
+            after_score, after_id = after
+            after_doc = self.id_to_doc.get(after_id, -1)
+            keep = (scores < after_score) | ((scores == after_score) & (candidates > after_doc))
+            candidates, scores = candidates[keep], scores[keep]
+            ts_rank_scores, similarity_scores = ts_rank_scores[keep], similarity_scores[keep]
+
+        # Top-k: partial selection first, then sort only the survivors
+        if len(scores) > limit:
+            kth = np.partition(scores, len(scores) - limit)[len(scores) - limit]
+            keep = scores >= kth
+            candidates, scores = candidates[keep], scores[keep]
+            ts_rank_scores, similarity_scores = ts_rank_scores[keep], similarity_scores[keep]
+        order = np.lexsort((candidates, -scores))[:limit]
+
+        rows = [
+            dict(self.headers[candidates[i]],
+                 ts_rank_score=float(ts_rank_scores[i]),
+                 similarity_score=float(similarity_scores[i]),
+                 score=float(scores[i]))
+            for i in order
+        ]
+        return rows, (total_count if with_count else None)
+
+
+class MemorySearchEngine:
+    """
+    Process-wide owner of the current BM25Index.
+
+    The first search builds the index synchronously. When the view generation
+    changes, a new index is built in the background while the old one keeps
+    serving; only rows whose search_text changed are fetched and tokenised again.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._docs = {}  # id -> (text hash, term ids, term frequencies)
+        self._vocabulary = {}
+        self._terms = []
+        self._build_lock = threading.Lock()
+
+    def _term_id(self, term):
+        term_id = self._vocabulary.get(term)
+        if term_id is None:
+            term_id = self._vocabulary[term] = len(self._terms)
+            self._terms.append(term)
+        return term_id
+
+    def build(self, generation=None):
+        """Build a new index from the view, reusing the tokenised rows that did not change"""
+        started = time.monotonic()
+        columns = ", ".join(LIST_COLUMNS)
+        with db_cursor() as cur:
+            cur.execute(f"SELECT {columns}, meeting_date, md5(search_text) AS text_hash FROM {VIEW_NAME} ORDER BY id")
+            rows = cur.fetchall()
+
+            changed = [row["id"] for row in rows if self._docs.get(row["id"], (None,))[0] != row["text_hash"]]
+            for chunk_start in range(0, len(changed), FETCH_CHUNK):
+                cur.execute(f"SELECT id, md5(search_text) AS text_hash, search_text FROM {VIEW_NAME} WHERE id = ANY(%s)",
+                            [changed[chunk_start:chunk_start + FETCH_CHUNK]])
+                for row in cur.fetchall():
+                    counts = Counter(self._term_id(term) for term in tokenize(row["search_text"]))
+                    self._docs[row["id"]] = (
+                        row["text_hash"],
+                        np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)),
+                        np.fromiter(counts.values(), dtype=np.float32, count=len(counts)),
+                    )
+
+        current_ids = {row["id"] for row in rows}
+        for doc_id in [doc_id for doc_id in self._docs if doc_id not in current_ids]:
+            del self._docs[doc_id]
+
+        headers = [{column: row[column] for column in LIST_COLUMNS} for row in rows]
+        meeting_dates = [row["meeting_date"] for row in rows]
+        doc_terms = [self._docs[row["id"]][1:] for row in rows]
+        index = BM25Index(headers, meeting_dates, doc_terms, list(self._terms), generation)
+        logger.info("Built BM25 index for generation %s: %d docs (%d re-tokenised), %d terms, %.1f MB in %.1fs",
+                    generation, index.n_docs, len(changed), len(index.sorted_terms),
+                    index.nbytes() / 1e6, time.monotonic() - started)
+        return index
+
+    def _rebuild(self, generation):
+        try:
+            self._index = self.build(generation)
+        except Exception:
+            logger.exception("Rebuilding the BM25 index failed")
+        finally:
+            self._build_lock.release()
+
+    def index(self):
+        """Current index; triggers a background rebuild when the view generation moved on"""
+        generation, _ = refresh.current_generation()
+        if self._index is None:
+            with self._build_lock:
+                if self._index is None:
+                    self._index = self.build(generation)
+        elif self._index.generation != generation and self._build_lock.acquire(blocking=False):
+            threading.Thread(target=self._rebuild, args=(generation,), name="bm25-rebuild", daemon=True).start()
+        return self._index
+
+    def search(self, *args, **kwargs):
+        return self.index().search(*args, **kwargs)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """Return the process-wide in-memory search engine"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = MemorySearchEngine()
+    return _engine
@@ -0,0 +1,120 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# =====================
+# Cache Settings
+# =====================
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "600"))  # sekunder
+
+
+def approx_size(value):
+    """Rough size in bytes of a cached value (lists/tuples of dict rows, scalars)"""
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(approx_size(item) for item in value.values())
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with a TTL and a memory bound, shared by all
+    Streamlit sessions in the process.
+
+    Every entry belongs to a materialized view generation (see refresh.py);
+    when a lookup carries a newer generation the whole cache is dropped.
+    Values are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, max_bytes=SEARCH_CACHE_MAX_BYTES, max_entries=SEARCH_CACHE_MAX_ENTRIES,
+                 ttl=SEARCH_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = None
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def _check_generation(self, generation):
+        if generation != self.generation:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._bytes = 0
+            self.generation = generation
+
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key, generation=None):
+        """Return the cached value, or None on a miss"""
+        with self._lock:
+            self._check_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(key)
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[2]
+
+    def put(self, key, value, generation=None):
+        size = approx_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._check_generation(generation)
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "max_entries": self.max_entries,
+                "generation": self.generation,
+            })
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+def search_key(query_text, municipality=None, start_date=None, end_date=None, limit=20, *extra):
+    """
+    Normalized cache key for a search. Case and whitespace do not change the
+    result (tsquery and pg_trgm both lowercase), and "Alle" means no filter.
+    """
+    normalized_query = " ".join((query_text or "").lower().split())
+    normalized_municipality = None if municipality in (None, "", "Alle") else municipality
+    return (normalized_query, normalized_municipality, start_date, end_date, limit) + extra
+
+
+# Process-wide caches in front of search.search() and search.fetch_details()
+search_cache = ResultCache()
+detail_cache = ResultCache(max_bytes=SEARCH_CACHE_MAX_BYTES // 4, max_entries=SEARCH_CACHE_MAX_ENTRIES * 5)
@@ -0,0 +1,348 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+
+import metrics
+
+# =====================
+# Database Settings
+# =====================
+DB_NAME = os.getenv("DB_NAME")
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT", "5432")
+
+# Pool sizing and health checks
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # sekunder for at vente på en ledig forbindelse
+DB_POOL_HEALTHCHECK_AFTER = float(os.getenv("DB_POOL_HEALTHCHECK_AFTER", "30"))  # sekunder uden brug før SELECT 1
+
+
+class TimedCursor(RealDictCursor):
+    """
+    RealDictCursor that reports execute time, rows and bytes of every call to
+    metrics.py, tagged with the calling function. A no-op when METRICS_ENABLED is off.
+    """
+    _entry = None
+
+    def execute(self, query, vars=None):
+        if not metrics.METRICS_ENABLED:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        try:
+            result = super().execute(query, vars)
+        except Exception as e:
+            metrics.record_execute(query, vars, time.perf_counter() - started, error=f"{type(e).__name__}: {e}")
+            raise
+        self._entry = metrics.record_execute(query, vars, time.perf_counter() - started)
+        return result
+
+    def fetchone(self):
+        row = super().fetchone()
+        metrics.record_fetch(self._entry, row)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        metrics.record_fetch(self._entry, rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        metrics.record_fetch(self._entry, rows)
+        return rows
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection became available within the checkout timeout"""
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of PostgreSQL connections.
+
+    Keeps every returned connection open for reuse (up to maxconn), with a
+    checkout timeout instead of failing immediately when exhausted, a health
+    check for connections that have been idle for a while, and counters that
+    can be read via stats(). minconn connections are opened up front.
+    """
+
+    def __init__(self, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX, timeout=DB_POOL_TIMEOUT,
+                 healthcheck_after=DB_POOL_HEALTHCHECK_AFTER, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_after = healthcheck_after
+        self._conn_kwargs = conn_kwargs
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = []  # returned connections, the most recently used last
+        self._open = set()  # every connection this pool has opened and not closed
+        self._last_used = {}
+        self._prepared = {}  # connection -> names of statements PREPAREd on it
+        self._stats = {
+            "checkouts": 0,
+            "connects": 0,
+            "timeouts": 0,
+            "healthcheck_failures": 0,
+            "discarded": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+        for _ in range(minconn):
+            self._idle.append(self._connect())
+
+    def _connect(self):
+        conn = psycopg2.connect(**self._conn_kwargs)
+        with self._lock:
+            self._open.add(conn)
+            self._stats["connects"] += 1
+        return conn
+
+    def _close(self, conn):
+        """Close a connection and forget everything the pool knew about it"""
+        with self._lock:
+            self._open.discard(conn)
+            self._last_used.pop(conn, None)
+            self._prepared.pop(conn, None)
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _is_healthy(self, conn):
+        """Check a connection that has been idle longer than healthcheck_after"""
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(conn)
+        if last_used is not None and time.monotonic() - last_used < self.healthcheck_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def _checkout_healthy(self):
+        """
+        The most recently returned idle connection that passes its health
+        check; broken ones are closed on the way. Opens a new connection when
+        no idle one is left.
+        """
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                return self._connect()
+            if self._is_healthy(conn):
+                return conn
+            with self._lock:
+                self._stats["healthcheck_failures"] += 1
+            self._close(conn)
+
+    def getconn(self):
+        """Check out a connection, waiting up to `timeout` seconds for a free slot"""
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"No database connection available within {self.timeout:.1f}s "
+                              f"(pool max {self.maxconn})")
+        try:
+            conn = self._checkout_healthy()
+        except Exception:
+            self._slots.release()
+            raise
+
+        waited = time.monotonic() - started
+        if metrics.METRICS_ENABLED:
+            metrics.note_acquire(waited)
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += waited
+            self._stats["wait_seconds_max"] = max(self._stats["wait_seconds_max"], waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        """Return a connection to the pool for reuse; broken connections are closed"""
+        try:
+            if not conn.closed and not close:
+                status = conn.info.transaction_status
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                        close = True
+            if close or conn.closed:
+                self._close(conn)
+                with self._lock:
+                    self._stats["discarded"] += 1
+            else:
+                with self._lock:
+                    self._last_used[conn] = time.monotonic()
+                    self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager that checks a connection out and always returns it"""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self.putconn(conn, close=broken)
+
+    def prepared_statements(self, conn):
+        """Names of the statements already prepared on a checked-out connection"""
+        with self._lock:
+            return self._prepared.setdefault(conn, set())
+
+    def stats(self):
+        """Snapshot of pool counters and current usage"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": len(self._open) - len(self._idle),
+                "idle": len(self._idle),
+                "open": len(self._open),
+            })
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            connections = list(self._open)
+            self._idle.clear()
+        for conn in connections:
+            self._close(conn)
+
+
+# Process-wide pool, shared by every Streamlit session and rerun. Kept at module
+# level because app.py itself is re-executed on each rerun, while imported
+# modules stay in sys.modules.
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return the process-wide connection pool, creating it on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    cursor_factory=TimedCursor
+                )
+    return _pool
+
+
+def pool_stats():
+    """Pool statistics, or None if the pool has not been created yet"""
+    return _pool.stats() if _pool is not None else None
+
+
+@contextmanager
+def db_cursor(commit=False):
+    """
+    Check out a pooled connection and yield a RealDictCursor.
+    Commits on success when `commit` is set; anything uncommitted is rolled back
+    when the connection goes back to the pool.
+    """
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+            if commit:
+                conn.commit()
+        finally:
+            cur.close()
+
+
+# =====================
+# Prepared statements
+# =====================
+PARAM_RE = re.compile(r"%\((\w+)\)s")
+_statements = {}
+_statements_by_name = {}
+
+
+def prepared_form(query):
+    """
+    Turn a query with %(name)s parameters into (statement name, SQL with $n
+    parameters, parameter names in $n order). The name is derived from the
+    SQL, so each distinct query text gets its own prepared statement.
+    """
+    statement = _statements.get(query)
+    if statement is None:
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return f"${names.index(match.group(1)) + 1}"
+
+        sql = PARAM_RE.sub(number, query).replace("%%", "%")
+        name = "stmt_" + hashlib.md5(sql.encode()).hexdigest()[:16]
+        statement = _statements[query] = (name, sql, names)
+        _statements_by_name[name] = sql
+    return statement
+
+
+def prepared_sql(name):
+    """The SQL of a statement made by prepared_form(), or None for an unknown name"""
+    return _statements_by_name.get(name)
+
+
+def ensure_prepared(cur, name):
+    """Prepare a statement made by prepared_form() on this cursor's connection, if it is not already"""
+    prepared = get_pool().prepared_statements(cur.connection)
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {_statements_by_name[name]}")
+        prepared.add(name)
+
+
+def execute_prepared(cur, query, params, setup=""):
+    """
+    Execute `query` as a server-side prepared statement, preparing it the first
+    time it runs on this pooled connection, so Postgres parses it only once per
+    connection. `setup` is SQL (e.g. set_config calls) sent in the same round
+    trip before the EXECUTE, using the same params.
+    """
+    name, sql, names = prepared_form(query)
+    prepared = get_pool().prepared_statements(cur.connection)
+    execute_sql = setup + f"EXECUTE {name} ({', '.join(f'%({param})s' for param in names)})"
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {sql}")
+        prepared.add(name)
+    try:
+        cur.execute(execute_sql, params)
+    except psycopg2.errors.InvalidSqlStatementName:
+        # The session lost the statement (e.g. DISCARD ALL by a proxy); prepare it again
+        cur.connection.rollback()
+        cur.execute(f"PREPARE {name} AS {sql}")
+        cur.execute(execute_sql, params)
@@ -0,0 +1,300 @@
+"""
+Næsten ens mødepunkter: MinHash-signaturer og LSH-bånd.
+
+Mange kommuner har mødepunkter med næsten samme tekst (faste budgetopfølgninger,
+takster). Dette job giver hver række i view'et et cluster_id, så søgningen kan
+vise ét punkt pr. klynge med "vis N lignende".
+
+Nye rækker behandles efter hver opdatering af view'et (refresh.on_refresh),
+når sql/006_near_duplicates.sql er kørt. Som batch-job (kun rækker der ikke er
+behandlet endnu):
+    python dedup.py cluster
+    python dedup.py cluster --rebuild     forfra, fx efter ændrede indstillinger
+
+De største klynger og antal punkter, søgningen samler:
+    python dedup.py stats
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+import time
+import zlib
+
+import numpy as np
+from psycopg2.extras import execute_values
+
+import refresh
+from db import db_cursor
+from search import NEAR_DUPLICATES_TABLE, VIEW_NAME, collapse_available
+
+# =====================
+# Near-duplicate Settings
+# =====================
+DEDUP_NUM_PERM = int(os.getenv("DEDUP_NUM_PERM", "128"))  # MinHash-permutationer
+DEDUP_BANDS = int(os.getenv("DEDUP_BANDS", "32"))  # LSH-bånd; skal gå op i DEDUP_NUM_PERM
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.6"))  # estimeret Jaccard for at være "næsten ens"
+DEDUP_SHINGLE_WORDS = int(os.getenv("DEDUP_SHINGLE_WORDS", "2"))
+DEDUP_CHUNK = int(os.getenv("DEDUP_CHUNK", "5000"))
+DEDUP_SEED = 1918  # fixed, so signatures stay comparable across runs
+
+BUCKETS_TABLE = "sourceview.minhash_buckets"
+DEDUP_COLUMNS = ("subject_title", "description", "search_sentences")
+
+# Key for pg_advisory_xact_lock, so concurrent jobs do not cluster the same rows
+DEDUP_LOCK_KEY = 74_201_002
+
+# With 32 bands of 4 values, pairs at the threshold (Jaccard 0.6) share a bucket with
+# probability 1 - (1 - 0.6**4)**32 = 0.99, pairs at 0.3 with 0.23; candidates are then
+# checked against DEDUP_THRESHOLD. Two changed words in a 30-word item give about 0.65
+# on word pairs, so recurring items that differ in dates and amounts end up together.
+
+# Universal hashing (a * x + b) mod p with a Mersenne prime below 2**31: the
+# product of two values below 2**31 fits in uint64 and the result in int4
+PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(DEDUP_SEED)
+_A = _rng.randint(1, PRIME, size=DEDUP_NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, PRIME, size=DEDUP_NUM_PERM).astype(np.uint64)
+
+WORD_RE = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+if DEDUP_NUM_PERM % DEDUP_BANDS:
+    raise ValueError(f"DEDUP_NUM_PERM ({DEDUP_NUM_PERM}) must be a multiple of DEDUP_BANDS ({DEDUP_BANDS})")
+
+
+def document_text(row):
+    """The text that is compared for one row"""
+    return "\n".join(str(row[column]) for column in DEDUP_COLUMNS if row.get(column))
+
+
+def shingles(text, k=DEDUP_SHINGLE_WORDS):
+    """
+    crc32 of every run of k consecutive words (lowercased), as uint64. Texts
+    shorter than k words are one shingle.
+    """
+    words = WORD_RE.findall(text.lower())
+    if not words:
+        return np.zeros(0, dtype=np.uint64)
+    grams = {" ".join(words[i:i + k]) for i in range(max(1, len(words) - k + 1))}
+    return np.fromiter((zlib.crc32(gram.encode()) for gram in grams), dtype=np.uint64, count=len(grams))
+
+
+def signature(shingle_hashes):
+    """MinHash signature (DEDUP_NUM_PERM int32 values), or None for a text without words"""
+    if not len(shingle_hashes):
+        return None
+    x = shingle_hashes % PRIME
+    return ((np.outer(_A, x) + _B[:, None]) % PRIME).min(axis=1).astype(np.int32)
+
+
+def band_buckets(sig):
+    """One (band, bucket) per LSH band: a 64-bit hash of that band's slice of the signature"""
+    return [
+        (band, int.from_bytes(hashlib.blake2b(rows.tobytes(), digest_size=8).digest(), "little", signed=True))
+        for band, rows in enumerate(sig.reshape(DEDUP_BANDS, -1))
+    ]
+
+
+def similarity(sig_a, sig_b):
+    """Estimated Jaccard similarity: the share of equal MinHash values"""
+    return float(np.mean(sig_a == sig_b))
+
+
+class UnionFind:
+    """Disjoint sets of ids where the smallest id is the root, so a cluster keeps its oldest id"""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, node):
+        parent = self.parent.setdefault(node, node)
+        if parent != node:
+            parent = self.parent[node] = self.find(parent)
+        return parent
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+def _cluster_chunk(cur, rows):
+    """
+    Sign a chunk of new rows, find candidates through shared LSH buckets (among
+    the stored rows and within the chunk), verify them against DEDUP_THRESHOLD
+    and store the new rows with their cluster. Clusters that a new row joins
+    together are merged. Returns (rows stored, clusters merged).
+    """
+    signatures = {row["id"]: signature(shingles(document_text(row))) for row in rows}
+    buckets = {doc_id: band_buckets(sig) for doc_id, sig in signatures.items() if sig is not None}
+
+    keys = {key for doc_buckets in buckets.values() for key in doc_buckets}
+    members = {}  # (band, bucket) -> [(union-find node, signature)]
+    if keys:
+        bands, bucket_values = zip(*keys)
+        cur.execute(
+            f"""
+            SELECT b.band, b.bucket, nd.cluster_id, nd.signature
+            FROM {BUCKETS_TABLE} b
+            JOIN unnest(%s::smallint[], %s::bigint[]) AS q(band, bucket) ON q.band = b.band AND q.bucket = b.bucket
+            JOIN {NEAR_DUPLICATES_TABLE} nd ON nd.id = b.id
+            """,
+            [list(bands), list(bucket_values)]
+        )
+        # Stored rows are represented by their cluster, which is already merged
+        for row in cur.fetchall():
+            members.setdefault((row["band"], row["bucket"]), []).append(
+                (row["cluster_id"], np.asarray(row["signature"], dtype=np.int32)))
+
+    clusters = UnionFind()
+    checked = set()
+    for doc_id in sorted(buckets):
+        clusters.find(doc_id)
+        for key in buckets[doc_id]:
+            for node, other in members.get(key, ()):
+                if (doc_id, node) not in checked and clusters.find(doc_id) != clusters.find(node):
+                    checked.add((doc_id, node))
+                    if similarity(signatures[doc_id], other) >= DEDUP_THRESHOLD:
+                        clusters.union(doc_id, node)
+            members.setdefault(key, []).append((doc_id, signatures[doc_id]))
+
+    # New row ids are never cluster ids yet, so a stored cluster with a new root is a merge
+    merged = [(node, clusters.find(node)) for node in list(clusters.parent)
+              if node not in signatures and clusters.find(node) != node]
+    if merged:
+        cur.execute(
+            f"""
+            UPDATE {NEAR_DUPLICATES_TABLE} nd
+            SET cluster_id = m.new_id
+            FROM unnest(%s::bigint[], %s::bigint[]) AS m(old_id, new_id)
+            WHERE nd.cluster_id = m.old_id
+            """,
+            [[old for old, _ in merged], [new for _, new in merged]]
+        )
+    execute_values(
+        cur,
+        f"INSERT INTO {NEAR_DUPLICATES_TABLE} (id, cluster_id, signature) VALUES %s",
+        [(doc_id, clusters.find(doc_id), sig.tolist() if sig is not None else [])
+         for doc_id, sig in signatures.items()]
+    )
+    execute_values(
+        cur,
+        f"INSERT INTO {BUCKETS_TABLE} (band, bucket, id) VALUES %s ON CONFLICT DO NOTHING",
+        [(band, bucket, doc_id) for doc_id, doc_buckets in buckets.items() for band, bucket in doc_buckets]
+    )
+    return len(signatures), len(merged)
+
+
+def cluster_new_rows(rebuild=False, chunk=DEDUP_CHUNK):
+    """
+    Offline batch job: give every row of the view that has not been processed
+    yet a cluster id. Rows that later change text keep their cluster until a
+    `rebuild`. Returns the number of rows processed.
+    """
+    if rebuild:
+        with db_cursor(commit=True) as cur:
+            cur.execute(f"TRUNCATE {NEAR_DUPLICATES_TABLE}, {BUCKETS_TABLE}")
+
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT v.id
+            FROM {VIEW_NAME} v
+            WHERE NOT EXISTS (SELECT 1 FROM {NEAR_DUPLICATES_TABLE} nd WHERE nd.id = v.id)
+            ORDER BY v.id
+            """
+        )
+        new_ids = [row["id"] for row in cur.fetchall()]
+    if not new_ids:
+        logger.info("No new rows to cluster")
+        return 0
+
+    started = time.monotonic()
+    processed = merged = 0
+    columns = ", ".join(("id",) + DEDUP_COLUMNS)
+    for chunk_start in range(0, len(new_ids), chunk):
+        with db_cursor(commit=True) as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", [DEDUP_LOCK_KEY])
+            # Re-check under the lock, in case another job got to these rows first
+            cur.execute(
+                f"""
+                SELECT {columns}
+                FROM {VIEW_NAME} v
+                WHERE id = ANY(%s)
+                  AND NOT EXISTS (SELECT 1 FROM {NEAR_DUPLICATES_TABLE} nd WHERE nd.id = v.id)
+                ORDER BY id
+                """,
+                [new_ids[chunk_start:chunk_start + chunk]]
+            )
+            rows = cur.fetchall()
+            if rows:
+                chunk_processed, chunk_merged = _cluster_chunk(cur, rows)
+                processed += chunk_processed
+                merged += chunk_merged
+        logger.info("Clustered %d/%d rows", min(chunk_start + chunk, len(new_ids)), len(new_ids))
+
+    elapsed = time.monotonic() - started
+    logger.info("Clustered %d rows in %.1fs (%.0f rows/s), %d stored clusters merged",
+                processed, elapsed, processed / elapsed, merged)
+    return processed
+
+
+def cluster_after_refresh(generation):
+    """Cluster the rows a refresh added; skipped until the near-duplicate table exists"""
+    if collapse_available():
+        cluster_new_rows()
+
+
+refresh.on_refresh(cluster_after_refresh)
+
+
+def stats(top=10):
+    """How many rows are clustered, and the largest clusters with an example title"""
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT
+                COUNT(*) AS rows,
+                COUNT(DISTINCT cluster_id) AS clusters,
+                COUNT(*) FILTER (WHERE id <> cluster_id) AS collapsible
+            FROM {NEAR_DUPLICATES_TABLE}
+            """
+        )
+        totals = cur.fetchone()
+        cur.execute(
+            f"""
+            SELECT nd.cluster_id, COUNT(*) AS size, MIN(v.subject_title) AS example
+            FROM {NEAR_DUPLICATES_TABLE} nd
+            JOIN {VIEW_NAME} v ON v.id = nd.id
+            GROUP BY nd.cluster_id
+            HAVING COUNT(*) > 1
+            ORDER BY size DESC
+            LIMIT %s
+            """,
+            [top]
+        )
+        largest = cur.fetchall()
+    return totals, largest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    cluster_parser = subparsers.add_parser("cluster", help="assign clusters to the rows not processed yet")
+    cluster_parser.add_argument("--rebuild", action="store_true", help="start over from an empty table")
+    stats_parser = subparsers.add_parser("stats", help="print the cluster counts and the largest clusters")
+    stats_parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == "cluster":
+        cluster_new_rows(args.rebuild)
+    else:
+        totals, largest = stats(args.top)
+        print(f"{totals['rows']} rows in {totals['clusters']} clusters; "
+              f"{totals['collapsible']} rows are collapsed into another item")
+        for cluster in largest:
+            print(f"{cluster['size']:>6}  {cluster['cluster_id']:>10}  {cluster['example']}")
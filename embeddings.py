@@ -0,0 +1,495 @@
+"""
+Semantisk søgning: embeddings af mødepunkter på CPU.
+
+Offline batch-job (kun nye og ændrede rækker siden sidste kørsel embeddes):
+    python embeddings.py embed
+
+Måling af forespørgselslatens og hukommelse:
+    python embeddings.py bench "ældrepleje" "hjemmehjælp" "fjernvarme"
+
+Kun vektorlageret og IVF-indekset, med syntetiske vektorer (uden model og database):
+    python embeddings.py bench-store --rows 1000000 --dtype int8
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+
+import refresh
+from db import db_cursor
+from search import VIEW_NAME
+
+# =====================
+# Embedding Settings
+# =====================
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+EMBEDDING_DIR = os.getenv("EMBEDDING_DIR", "embeddings")
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "float16")  # float16 eller int8
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_MAX_TOKENS = int(os.getenv("EMBEDDING_MAX_TOKENS", "256"))
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # 0 = torch' standard
+IVF_NPROBE = int(os.getenv("EMBEDDING_NPROBE", "8"))
+FETCH_CHUNK = 2000
+
+EMBEDDED_COLUMNS = ("subject_title", "description", "summary")
+# 64 bits of the md5 of the embedded columns, so the batch job can tell which rows changed text
+CONTENT_HASH_SQL = f"('x' || left(md5(concat_ws(E'\\n', {', '.join(EMBEDDED_COLUMNS)})), 16))::bit(64)::bigint"
+
+logger = logging.getLogger(__name__)
+
+
+def passage_text(row):
+    """The text that is embedded for one row"""
+    return "\n".join(str(row[column]) for column in EMBEDDED_COLUMNS if row.get(column))
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb():
+    """Current resident set size of this process in MB, including mapped file pages (Linux)"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+class Encoder:
+    """Sentence encoder on CPU: transformer + mean pooling + L2 normalisation"""
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+
+        if EMBEDDING_THREADS:
+            torch.set_num_threads(EMBEDDING_THREADS)
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).eval()
+        self.dim = self.model.config.hidden_size
+
+    def encode(self, texts, batch_size=EMBEDDING_BATCH_SIZE):
+        """Return an (n, dim) float32 array of unit vectors"""
+        torch = self.torch
+        batches = []
+        with torch.inference_mode():
+            for start in range(0, len(texts), batch_size):
+                encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                         max_length=EMBEDDING_MAX_TOKENS, return_tensors="pt")
+                hidden = self.model(**encoded).last_hidden_state
+                mask = encoded["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+                pooled = torch.nn.functional.normalize(pooled, dim=1)
+                batches.append(pooled.numpy().astype(np.float32))
+        return np.concatenate(batches) if batches else np.zeros((0, self.dim), dtype=np.float32)
+
+
+class IVFIndex:
+    """
+    Approximate nearest neighbours: an inverted file over k-means centroids.
+    A query only scores the vectors in its `nprobe` closest lists.
+    """
+
+    def __init__(self, centroids, assignments):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind="stable")
+        self.offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=self.offsets[1:])
+
+    @staticmethod
+    def train(vectors, n_lists=None, iterations=10, sample_size=50_000, seed=0):
+        """k-means (spherical) centroids on a sample of the vectors"""
+        n = len(vectors)
+        n_lists = n_lists or max(1, int(np.sqrt(n)))
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, sample_size), replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(iterations):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[nearest == c]
+                if len(members):
+                    centroid = members.mean(axis=0)
+                    centroids[c] = centroid / max(np.linalg.norm(centroid), 1e-9)
+        return centroids
+
+    @staticmethod
+    def assign(centroids, vectors, chunk=65_536):
+        return np.concatenate([
+            np.argmax(np.asarray(vectors[start:start + chunk], dtype=np.float32) @ centroids.T, axis=1)
+            for start in range(0, len(vectors), chunk)
+        ]).astype(np.int32) if len(vectors) else np.zeros(0, dtype=np.int32)
+
+    def candidates(self, query, nprobe=IVF_NPROBE):
+        """Positions of the vectors in the `nprobe` lists closest to the query"""
+        lists = np.argsort(-(self.centroids @ query))[:nprobe]
+        return np.sort(np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in lists]))
+
+
+class EmbeddingStore:
+    """
+    Append-only, memory-mapped embedding matrix with an id map.
+
+    Files in EMBEDDING_DIR:
+      vectors.bin   (n, dim) float16, or int8 with a float32 scale per row in scales.npy
+      ids.npy       view id of each row
+      hashes.npy    content hash of each row when it was embedded (CONTENT_HASH_SQL)
+      ivf.npz       IVF centroids and list assignment per row
+      meta.json     model, dim, dtype, count and the view generation last embedded
+    """
+
+    def __init__(self, path=EMBEDDING_DIR):
+        self.path = path
+        self.meta = {"model": EMBEDDING_MODEL, "dim": None, "dtype": EMBEDDING_DTYPE, "count": 0, "generation": None}
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.hashes = np.zeros(0, dtype=np.int64)
+        self.scales = np.zeros(0, dtype=np.float32)
+        self.ivf = None
+        self.trained_count = 0
+        self.meta_mtime = None
+        self._vectors = None
+        self.load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def load(self):
+        if not os.path.exists(self._file("meta.json")):
+            return
+        self.meta_mtime = os.stat(self._file("meta.json")).st_mtime_ns
+        with open(self._file("meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.ids = np.load(self._file("ids.npy"))
+        # Stores written before the hashes were kept get 0, so every row counts as changed once
+        self.hashes = (np.load(self._file("hashes.npy")) if os.path.exists(self._file("hashes.npy"))
+                       else np.zeros(len(self.ids), dtype=np.int64))
+        if self.meta["dtype"] == "int8":
+            self.scales = np.load(self._file("scales.npy"))
+        if os.path.exists(self._file("ivf.npz")):
+            ivf = np.load(self._file("ivf.npz"))
+            self.ivf = IVFIndex(ivf["centroids"], ivf["assignments"])
+            self.trained_count = int(ivf["trained_count"])
+        self._vectors = None
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    def vectors(self):
+        """Read-only memory map of the stored vectors"""
+        if self._vectors is None and self.count:
+            self._vectors = np.memmap(self._file("vectors.bin"), dtype=self.meta["dtype"], mode="r",
+                                      shape=(self.count, self.meta["dim"]))
+        return self._vectors
+
+    def scores(self, query, positions):
+        """Cosine similarity between a unit query vector and the stored rows at `positions`"""
+        rows = np.asarray(self.vectors()[positions], dtype=np.float32)
+        scores = rows @ query
+        if self.meta["dtype"] == "int8":
+            scores *= self.scales[positions]
+        return scores
+
+    def _quantize(self, vectors):
+        """Vectors in the stored dtype, and their int8 scales (None for float16)"""
+        if self.meta["dtype"] == "int8":
+            scales = np.maximum(np.abs(vectors).max(axis=1), 1e-9) / 127
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(np.float16), None
+
+    def append(self, ids, vectors, generation=None, hashes=None):
+        """Append unit vectors for new ids (with their content hashes) and update the IVF lists"""
+        os.makedirs(self.path, exist_ok=True)
+        self.meta["dim"] = vectors.shape[1]
+        stored, scales = self._quantize(vectors)
+        if scales is not None:
+            self.scales = np.concatenate([self.scales, scales])
+        with open(self._file("vectors.bin"), "ab") as f:
+            # Drop bytes from an interrupted earlier append that meta.json does not account for
+            f.truncate(self.count * stored.shape[1] * stored.itemsize)
+            f.write(stored.tobytes())
+
+        self.ids = np.concatenate([self.ids, np.asarray(ids)]) if len(self.ids) else np.asarray(ids)
+        hashes = np.zeros(len(ids), dtype=np.int64) if hashes is None else np.asarray(hashes, dtype=np.int64)
+        self.hashes = np.concatenate([self.hashes, hashes])
+        self.meta["count"] = len(self.ids)
+        self.meta["generation"] = generation
+        self._vectors = None
+
+        # Retrain the coarse quantizer when the store has doubled, otherwise just assign the new rows
+        if self.ivf is None or self.count >= 2 * self.trained_count:
+            centroids = IVFIndex.train(self.vectors())
+            assignments = IVFIndex.assign(centroids, self.vectors())
+            self.trained_count = self.count
+        else:
+            centroids = self.ivf.centroids
+            assignments = np.concatenate([self.ivf.assignments, IVFIndex.assign(centroids, vectors)])
+        self.ivf = IVFIndex(centroids, assignments)
+        self._save_index()
+
+    def update(self, ids, vectors, generation=None, hashes=None):
+        """
+        Overwrite the vectors of ids already in the store (rows whose text
+        changed) in place, and move them to their new IVF lists
+        """
+        positions = self.positions(ids)
+        stored, scales = self._quantize(vectors)
+        writable = np.memmap(self._file("vectors.bin"), dtype=self.meta["dtype"], mode="r+",
+                             shape=(self.count, self.meta["dim"]))
+        writable[positions] = stored
+        writable.flush()
+        del writable
+        if scales is not None:
+            self.scales[positions] = scales
+        self.hashes[positions] = hashes
+        self.meta["generation"] = generation
+
+        assignments = self.ivf.assignments.copy()
+        assignments[positions] = IVFIndex.assign(self.ivf.centroids, vectors)
+        self.ivf = IVFIndex(self.ivf.centroids, assignments)
+        self._save_index()
+
+    def positions(self, ids):
+        """Row positions of ids that are in the store"""
+        order = np.argsort(self.ids, kind="stable")
+        return order[np.searchsorted(self.ids, ids, sorter=order)]
+
+    def _save_index(self):
+        """Save everything but the vectors; meta.json last, as readers reload when it changes"""
+        self._save("ids.npy", lambda f: np.save(f, self.ids))
+        self._save("hashes.npy", lambda f: np.save(f, self.hashes))
+        if self.meta["dtype"] == "int8":
+            self._save("scales.npy", lambda f: np.save(f, self.scales))
+        self._save("ivf.npz", lambda f: np.savez(f, centroids=self.ivf.centroids, assignments=self.ivf.assignments,
+                                                 trained_count=self.trained_count))
+        self._save("meta.json", lambda f: f.write(json.dumps(self.meta).encode("utf-8")))
+        self.meta_mtime = os.stat(self._file("meta.json")).st_mtime_ns
+
+    def _save(self, name, write):
+        """Write via a temporary file and rename, so readers never see a half-written file"""
+        tmp = self._file(name + ".tmp")
+        with open(tmp, "wb") as f:
+            write(f)
+        os.replace(tmp, self._file(name))
+
+    def nearest(self, query, k=100, nprobe=IVF_NPROBE):
+        """Approximate top-k as (ids, scores), best first"""
+        if not self.count:
+            return np.zeros(0, dtype=self.ids.dtype), np.zeros(0, dtype=np.float32)
+        positions = self.ivf.candidates(query, nprobe) if self.ivf is not None else np.arange(self.count)
+        scores = self.scores(query, positions)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+            positions, scores = positions[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return self.ids[positions[order]], scores[order]
+
+
+def embed_new_rows(store=None, encoder=None):
+    """
+    Offline batch job: embed the rows of the view that are not in the store
+    yet, and embed again the rows whose text changed since they were embedded
+    (by their content hash). Returns the number of rows embedded.
+    """
+    store = store or EmbeddingStore()
+    generation, _ = refresh.load_generation()
+
+    with db_cursor() as cur:
+        cur.execute(f"SELECT id, {CONTENT_HASH_SQL} AS content_hash FROM {VIEW_NAME}")
+        view_rows = cur.fetchall()
+    view_ids = np.array([row["id"] for row in view_rows], dtype=np.int64)
+    view_hashes = np.array([row["content_hash"] for row in view_rows], dtype=np.int64)
+    stored = np.isin(view_ids, store.ids) if store.count else np.zeros(len(view_ids), dtype=bool)
+    new_ids = view_ids[~stored]
+    changed_ids = view_ids[stored][view_hashes[stored] != store.hashes[store.positions(view_ids[stored])]]
+    if not len(new_ids) and not len(changed_ids):
+        logger.info("No new or changed rows to embed (generation %s)", generation)
+        return 0
+
+    encoder = encoder or Encoder()
+    started = time.monotonic()
+    columns = ", ".join(("id",) + EMBEDDED_COLUMNS)
+    for kind, ids, write in (("changed", changed_ids, store.update), ("new", new_ids, store.append)):
+        for chunk_start in range(0, len(ids), FETCH_CHUNK):
+            chunk = ids[chunk_start:chunk_start + FETCH_CHUNK].tolist()
+            with db_cursor() as cur:
+                cur.execute(f"SELECT {columns}, {CONTENT_HASH_SQL} AS content_hash "
+                            f"FROM {VIEW_NAME} WHERE id = ANY(%s) ORDER BY id", [chunk])
+                rows = cur.fetchall()
+            vectors = encoder.encode([passage_text(row) for row in rows])
+            write([row["id"] for row in rows], vectors, generation, [row["content_hash"] for row in rows])
+            logger.info("Embedded %d/%d %s rows", min(chunk_start + FETCH_CHUNK, len(ids)), len(ids), kind)
+
+    embedded = len(new_ids) + len(changed_ids)
+    elapsed = time.monotonic() - started
+    logger.info("Embedded %d rows (%d new, %d changed) in %.1fs (%.1f rows/s), peak RSS %.0f MB",
+                embedded, len(new_ids), len(changed_ids), elapsed, embedded / elapsed, peak_rss_mb())
+    return embedded
+
+
+# Process-wide encoder and store for query-time use; the model is only loaded on first hybrid search
+_encoder = None
+_store = None
+_lock = threading.Lock()
+
+
+def get_encoder():
+    global _encoder
+    if _encoder is None:
+        with _lock:
+            if _encoder is None:
+                _encoder = Encoder()
+    return _encoder
+
+
+def get_store():
+    """
+    Return the embedding store, reloading it when the batch job has written
+    it since (meta.json is written last, so its mtime is enough; a stat per
+    query instead of reading the file)
+    """
+    global _store
+    with _lock:
+        if _store is None:
+            _store = EmbeddingStore()
+        else:
+            try:
+                mtime = os.stat(_store._file("meta.json")).st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            if mtime != _store.meta_mtime:
+                _store.load()
+    return _store
+
+
+def vector_search(query_text, k=100):
+    """Approximate nearest neighbours of the query as (ids, scores)"""
+    query = get_encoder().encode([query_text])[0]
+    return get_store().nearest(query, k)
+
+
+def benchmark(queries, k=100, repeat=5):
+    """Print query latency (encode + ANN) and RSS for the given queries"""
+    print(f"RSS before model load: {peak_rss_mb():.0f} MB")
+    vector_search(queries[0], k)
+    store = get_store()
+    print(f"RSS after model + store load: {peak_rss_mb():.0f} MB "
+          f"({store.count} vectors, {store.meta['dtype']}, dim {store.meta['dim']})")
+    for query_text in queries:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            vector_search(query_text, k)
+            timings.append((time.perf_counter() - started) * 1000)
+        print(f"{query_text!r}: median {np.median(timings):.1f} ms, min {min(timings):.1f} ms")
+    print(f"Peak RSS: {peak_rss_mb():.0f} MB")
+
+
+def synthetic_vectors(n, dim, topics=200, noise=0.6, seed=0):
+    """
+    Unit vectors around `topics` random directions, standing in for sentence
+    embeddings (which cluster by subject), so the IVF lists are not uniform
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((topics, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    vectors = centers[rng.integers(0, topics, n)] + noise * rng.standard_normal((n, dim)).astype(np.float32) / np.sqrt(dim)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def exact_nearest(store, query, k=100, chunk=65_536):
+    """Exact top-k positions over the whole store, in chunks so the float32 copy stays small"""
+    best_positions, best_scores = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    for start in range(0, store.count, chunk):
+        positions = np.arange(start, min(start + chunk, store.count))
+        positions = np.concatenate([best_positions, positions])
+        scores = np.concatenate([best_scores, store.scores(query, positions[len(best_positions):])])
+        top = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+        best_positions, best_scores = positions[top], scores[top]
+    return best_positions[np.argsort(-best_scores, kind="stable")]
+
+
+def store_benchmark(rows, dim=384, dtype=EMBEDDING_DTYPE, queries=50, k=100, nprobe=IVF_NPROBE, path=None):
+    """
+    Vector store and IVF index alone, on synthetic vectors: append time (with
+    IVF training), RSS of a freshly loaded store while serving, ANN and exact
+    query latency and the ANN recall@k. The encoder is not involved.
+    """
+    import tempfile
+
+    with tempfile.TemporaryDirectory(dir=path) as directory:
+        store = EmbeddingStore(directory)
+        store.meta["dtype"] = dtype
+        started = time.perf_counter()
+        for start in range(0, rows, FETCH_CHUNK * 25):
+            count = min(FETCH_CHUNK * 25, rows - start)
+            store.append(np.arange(start, start + count), synthetic_vectors(count, dim, seed=start))
+        append_seconds = time.perf_counter() - started
+        del store
+
+        rss_before = rss_mb()
+        store = EmbeddingStore(directory)
+        query_vectors = synthetic_vectors(queries, dim, seed=rows + 1)
+        ann_ms, exact_ms, recall, found = [], [], [], []
+        for query in query_vectors:
+            started = time.perf_counter()
+            found.append(store.nearest(query, k, nprobe)[0])
+            ann_ms.append((time.perf_counter() - started) * 1000)
+        # Before the exact searches, whose float32 chunks would count as well
+        rss_serving = rss_mb()
+        for query, ids in zip(query_vectors, found):
+            started = time.perf_counter()
+            exact = store.ids[exact_nearest(store, query, k)]
+            exact_ms.append((time.perf_counter() - started) * 1000)
+            recall.append(len(np.intersect1d(ids, exact)) / len(exact))
+        file_mb = os.path.getsize(store._file("vectors.bin")) / 2**20
+
+    result = {
+        "rows": rows, "dim": dim, "dtype": dtype, "k": k, "nprobe": nprobe, "lists": len(store.ivf.centroids),
+        "queries": queries, "append_seconds": append_seconds, "vectors_file_mb": file_mb,
+        "ann_ms": {"p50": float(np.percentile(ann_ms, 50)), "p95": float(np.percentile(ann_ms, 95))},
+        "exact_ms": {"p50": float(np.percentile(exact_ms, 50)), "p95": float(np.percentile(exact_ms, 95))},
+        "recall_at_k": float(np.mean(recall)),
+        "rss_mb": {"before_load": rss_before, "serving": rss_serving, "peak": peak_rss_mb()},
+    }
+    print(f"{rows} vectors, dim {dim}, {dtype}: {file_mb:.0f} MB on disk, appended in {append_seconds:.1f}s "
+          f"({result['lists']} IVF lists)")
+    print(f"ANN (nprobe {nprobe}): p50 {result['ann_ms']['p50']:.1f} ms, p95 {result['ann_ms']['p95']:.1f} ms, "
+          f"recall@{k} {result['recall_at_k']:.3f}")
+    print(f"Exact: p50 {result['exact_ms']['p50']:.1f} ms, p95 {result['exact_ms']['p95']:.1f} ms")
+    print(f"RSS: {rss_before:.0f} MB before loading the store, {rss_serving:.0f} MB while serving "
+          f"(peak {result['rss_mb']['peak']:.0f} MB while generating)")
+    return result
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("embed", help="embed rows added since the last run")
+    bench_parser = subparsers.add_parser("bench", help="measure query latency and RSS")
+    bench_parser.add_argument("queries", nargs="+")
+    store_parser = subparsers.add_parser("bench-store", help="store and IVF latency and RSS on synthetic vectors")
+    store_parser.add_argument("--rows", type=int, default=100_000)
+    store_parser.add_argument("--dim", type=int, default=384)
+    store_parser.add_argument("--dtype", choices=("float16", "int8"), default=EMBEDDING_DTYPE)
+    store_parser.add_argument("--queries", type=int, default=50)
+    store_parser.add_argument("--nprobe", type=int, default=IVF_NPROBE)
+    store_parser.add_argument("--output", help="also write the result as JSON to this file")
+    args = parser.parse_args()
+
+    if args.command == "embed":
+        embed_new_rows()
+    elif args.command == "bench-store":
+        result = store_benchmark(args.rows, args.dim, args.dtype, args.queries, nprobe=args.nprobe)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+    else:
+        benchmark(args.queries)
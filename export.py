@@ -0,0 +1,270 @@
+"""
+Eksport af alle søgeresultater til CSV eller Parquet.
+
+Rækkerne hentes med en navngivet (server-side) cursor og skrives i Arrow
+record batches direkte til filen, så hukommelsesforbruget er det samme
+uanset antallet af træf. Filen sendes fra disken i bidder af API'et
+(GET /export i api.py), som appens eksportknap linker til.
+
+Måling af hukommelse med syntetiske rækker (ingen database):
+    python export.py bench --rows 1000000 --format parquet
+"""
+import argparse
+import hashlib
+import hmac
+import os
+import random
+import resource
+import tempfile
+import time
+from datetime import date, timedelta
+
+import psycopg2
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import search
+from db import get_pool
+
+# =====================
+# Export Settings
+# =====================
+EXPORT_ITERSIZE = int(os.getenv("SEARCH_EXPORT_ITERSIZE", "5000"))  # rækker pr. netværkskald
+EXPORT_BATCH_ROWS = int(os.getenv("SEARCH_EXPORT_BATCH_ROWS", "10000"))  # rækker pr. Arrow batch
+EXPORT_CHUNK_BYTES = int(os.getenv("SEARCH_EXPORT_CHUNK_BYTES", str(1024 * 1024)))  # bytes pr. skrivning til klienten
+EXPORT_LINK_TTL = int(os.getenv("EXPORT_LINK_TTL", "3600"))  # sekunder et signeret eksportlink virker
+
+EXPORT_FORMATS = {
+    # format: (file suffix, MIME type)
+    "csv": (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+# Column order of the export file; tags are joined into one text field so
+# CSV and Parquet files have the same columns
+EXPORT_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("municipality", pa.string()),
+    ("meeting_date", pa.date32()),
+    ("subject_title", pa.string()),
+    ("category", pa.string()),
+    ("summary", pa.string()),
+    ("description", pa.string()),
+    ("future_action", pa.string()),
+    ("decided_or_not", pa.bool_()),
+    ("amount", pa.string()),
+    ("tags", pa.string()),
+    ("search_sentences", pa.string()),
+    ("content_url", pa.string()),
+    ("score", pa.float64()),
+])
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def _tags(value):
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(tag) for tag in value)
+    return _text(value)
+
+
+# Per-column conversion from database values to the Arrow type above
+CONVERTERS = {
+    "amount": _text,
+    "tags": _tags,
+    "search_sentences": _text,
+}
+
+
+def build_export_query(query_text="", municipality=None, start_date=None, end_date=None, **kwargs):
+    """
+    All matching rows with the export columns, in the same order as the
+    result list (score DESC, id). Returns (sql, params); the trigram threshold
+    must be set separately since a named cursor runs a single statement.
+    """
+    columns = tuple(name for name in EXPORT_SCHEMA.names if name != "score")
+    source, params = search.build_match_source(query_text, municipality, start_date, end_date, columns=columns,
+                                               **kwargs)
+    params["weight"] = search.SIMILARITY_WEIGHT
+
+    query = f"""
+        SELECT
+            {", ".join(columns)},
+            ts_rank_score + similarity_score * %(weight)s AS score
+        FROM {source} matches
+        ORDER BY score DESC, id
+    """
+    return query, params
+
+
+def record_batches(rows, batch_rows=EXPORT_BATCH_ROWS, schema=EXPORT_SCHEMA):
+    """Turn an iterator of row tuples (in schema order) into Arrow record batches"""
+    names = schema.names
+    converters = [CONVERTERS.get(name) for name in names]
+    columns = [[] for _ in names]
+    for row in rows:
+        for column, convert, value in zip(columns, converters, row):
+            column.append(convert(value) if convert else value)
+        if len(columns[0]) >= batch_rows:
+            yield pa.RecordBatch.from_arrays(columns, schema=schema)
+            columns = [[] for _ in names]
+    if columns[0]:
+        yield pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_batches(batches, sink, fmt="csv"):
+    """Write record batches to a path or binary file one at a time. Returns the row count"""
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, EXPORT_SCHEMA, compression="zstd")
+    elif fmt == "csv":
+        writer = pa_csv.CSVWriter(sink, EXPORT_SCHEMA)
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    row_count = 0
+    with writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            row_count += batch.num_rows
+    return row_count
+
+
+def iter_search_rows(query_text="", municipality=None, start_date=None, end_date=None):
+    """
+    Yield every matching row as a tuple, streamed from a server-side cursor
+    EXPORT_ITERSIZE rows at a time. The connection is held until the iterator
+    is exhausted or closed.
+    """
+    query, params = build_export_query(query_text, municipality, start_date, end_date)
+    with get_pool().connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(search.SET_THRESHOLD_SQL, params)
+        # Plain tuples instead of the pool's RealDictCursor rows
+        with conn.cursor(name="search_export", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = EXPORT_ITERSIZE
+            cur.execute(query, params)
+            yield from cur
+
+
+def export_search(sink, fmt="csv", query_text="", municipality=None, start_date=None, end_date=None):
+    """Write all results of a search to `sink` as CSV or Parquet. Returns the row count"""
+    rows = iter_search_rows(query_text, municipality, start_date, end_date)
+    try:
+        return write_batches(record_batches(rows), sink, fmt)
+    finally:
+        rows.close()
+
+
+def _signature(params, token):
+    message = "&".join(f"{name}={params[name]}" for name in sorted(params) if name != "signature")
+    return hmac.new(token.encode(), message.encode(), hashlib.sha256).hexdigest()
+
+
+def sign_export_params(params, token, ttl=EXPORT_LINK_TTL):
+    """
+    Export link parameters with an expiry time and an HMAC signature made with
+    the API token, so the app's export button works without handing the token
+    to the browser
+    """
+    signed = dict(params, expires=str(int(time.time()) + ttl))
+    signed["signature"] = _signature(signed, token)
+    return signed
+
+
+def export_signature_valid(params, token):
+    """Whether link parameters carry an unexpired signature made with `token`"""
+    try:
+        expired = int(params.get("expires", "")) < time.time()
+    except ValueError:
+        return False
+    return not expired and hmac.compare_digest(params.get("signature", ""), _signature(params, token))
+
+
+def iter_file_chunks(export_file, chunk_bytes=EXPORT_CHUNK_BYTES):
+    """Read a finished export file from disk in chunks, so it is never held in memory as a whole"""
+    while True:
+        chunk = export_file.read(chunk_bytes)
+        if not chunk:
+            return
+        yield chunk
+
+
+def export_to_tempfile(fmt="csv", **search_args):
+    """
+    Export to an anonymous temporary file on disk and return it rewound,
+    together with the row count. The caller closes the file.
+    """
+    export_file = tempfile.TemporaryFile(suffix=EXPORT_FORMATS[fmt][0])
+    try:
+        row_count = export_search(export_file, fmt, **search_args)
+    except Exception:
+        export_file.close()
+        raise
+    export_file.seek(0)
+    return export_file, row_count
+
+
+# =====================
+# Benchmark
+# =====================
+def peak_rss_mb():
+    """Peak resident set size of this process in MB (ru_maxrss is in kB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def synthetic_rows(count, seed=0):
+    """Rows shaped like the export query's output, for measuring the writer without a database"""
+    rng = random.Random(seed)
+    municipalities = ["Aarhus", "Odense", "Aalborg", "Esbjerg", "Vejle", "Randers", "Kolding", "Horsens"]
+    words = ["budget", "lokalplan", "fjernvarme", "takster", "ældreboliger", "klimatilpasning",
+             "daginstitution", "anlægsbevilling", "udbud", "skole", "trafik", "affald"]
+    first_day = date(2015, 1, 1)
+    for row_id in range(count):
+        text = " ".join(rng.choices(words, k=40))
+        yield (
+            row_id,
+            rng.choice(municipalities),
+            first_day + timedelta(days=rng.randrange(3650)),
+            " ".join(rng.choices(words, k=5)).capitalize(),
+            rng.choice(words),
+            text,
+            text,
+            text[:120],
+            rng.random() < 0.5,
+            str(rng.randrange(10_000_000)) if rng.random() < 0.2 else None,
+            rng.sample(words, 3),
+            text[:200],
+            f"https://example.invalid/{row_id}.pdf",
+            rng.random(),
+        )
+
+
+def benchmark(rows=1_000_000, fmt="parquet", max_rss_mb=None):
+    """Export synthetic rows to a temporary file and print throughput and peak RSS"""
+    rss_before = peak_rss_mb()
+    started = time.perf_counter()
+    with tempfile.TemporaryFile() as export_file:
+        row_count = write_batches(record_batches(synthetic_rows(rows)), export_file, fmt)
+        size_mb = export_file.tell() / 1024 / 1024
+    elapsed = time.perf_counter() - started
+    rss_after = peak_rss_mb()
+    print(f"{row_count} rows as {fmt}: {size_mb:.0f} MB in {elapsed:.1f} s "
+          f"({row_count / elapsed:,.0f} rows/s)")
+    print(f"Peak RSS: {rss_before:.0f} MB before, {rss_after:.0f} MB after")
+    if max_rss_mb is not None and rss_after > max_rss_mb:
+        raise SystemExit(f"Peak RSS {rss_after:.0f} MB is above the limit of {max_rss_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench_parser = subparsers.add_parser("bench", help="export synthetic rows and report peak RSS")
+    bench_parser.add_argument("--rows", type=int, default=1_000_000)
+    bench_parser.add_argument("--format", choices=sorted(EXPORT_FORMATS), default="parquet")
+    bench_parser.add_argument("--max-rss-mb", type=float, help="exit with an error above this peak RSS")
+    args = parser.parse_args()
+
+    benchmark(args.rows, args.format, args.max_rss_mb)
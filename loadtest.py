@@ -0,0 +1,403 @@
+"""
+Belastningstest af Streamlit-appen med mange samtidige sessioner i én proces.
+
+Hver simuleret bruger er en AppTest-session (streamlit.testing), der kører
+app.py i samme proces som de andre, ligesom sessionerne i en rigtig
+Streamlit-server deler forbindelsespulje, caches og indekser. Brugerne
+skriver søgninger, skifter kommune, bladrer og ser på fanen "Populære emner",
+med en tilfældig tænkepause mellem hvert trin. Websocket-laget (serialisering
+af svaret til browseren) er ikke med, så tallene er en nedre grænse.
+
+Kør mod en lokal Postgres (fx benchmark-databasen fra benchmark.py) for et
+stigende antal sessioner; resultatet gemmes som JSON og kan tegnes som kurve:
+    DB_NAME=kommunedata_bench python loadtest.py run --sessions 1 2 4 8 16 32 --duration 60
+    python loadtest.py plot benchmark_results/loadtest-<tidspunkt>.json
+
+Tid til første visning i en ny proces og tiden pr. rerun på hver side, med og
+uden opvarmning (warmup.py); kør den før og efter en ændring og sammenlign:
+    DB_NAME=kommunedata_bench python loadtest.py firstpaint --reruns 20
+    DB_NAME=kommunedata_bench python loadtest.py firstpaint --reruns 20 --warm-up
+"""
+import argparse
+import importlib
+import json
+import os
+import random
+import resource
+import threading
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+import db
+from benchmark import BENCH_RESULTS_DIR, _git_commit, percentiles
+
+# =====================
+# Load Test Settings
+# =====================
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+LOADTEST_TIMEOUT = float(os.getenv("LOADTEST_TIMEOUT", "60"))  # sekunder én rerun må tage
+SAMPLE_INTERVAL = 0.25  # seconds between samples of connections, CPU and RSS
+SEARCH_BUTTON = "🔎 Søg"
+# Page names as in app.py (not imported, since importing app.py would render it)
+SEARCH_PAGE = "Søg i kommunale møder"
+TOPICS_PAGE = "Populære emner"
+
+# Mix of common and rare words, prefixes and operators, so the result cache sees both hits and misses
+QUERIES = [
+    "budget", "lokalplan", "fjernvarme", "takster", "ældreboliger", "skole", "udbud", "klimatilpasning",
+    "daginstitution", "anlægsbevilling", "budget OR takster", "skole -lukning", '"ny skole"', "fjernvarm*",
+    "renovering plejehjem", "cykelsti", "spildevand", "garantistillelse", "bibliotek", "trafiksikkerhed",
+]
+
+
+def rss_mb():
+    """Current resident set size of this process in MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        # Not Linux: the peak is the best available approximation
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the pool, the number of backends connected to the database
+    (on its own connection, outside the pool) and the process RSS.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        super().__init__(name="loadtest-sampler", daemon=True)
+        self.interval = interval
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        conn = psycopg2.connect(dbname=db.DB_NAME, user=db.DB_USER, password=db.DB_PASSWORD,
+                                host=db.DB_HOST, port=db.DB_PORT)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                while not self._stop_event.is_set():
+                    cur.execute("SELECT COUNT(*) FROM pg_stat_activity WHERE datname = current_database()")
+                    backends = cur.fetchone()[0] - 1  # minus this connection
+                    pool = db.pool_stats() or {}
+                    self.samples.append({
+                        "backends": backends,
+                        "pool_open": pool.get("open", 0),
+                        "pool_in_use": pool.get("in_use", 0),
+                        "rss_mb": rss_mb(),
+                    })
+                    self._stop_event.wait(self.interval)
+        finally:
+            conn.close()
+
+
+class Session:
+    """One simulated user: an AppTest session driven through a random flow"""
+
+    def __init__(self, rng, queries, think_time):
+        from streamlit.testing.v1 import AppTest
+
+        self.app = AppTest.from_file(APP_PATH, default_timeout=LOADTEST_TIMEOUT)
+        self.rng = rng
+        self.queries = queries
+        self.think_time = think_time
+        self.timings = []  # (step, ms)
+        self.errors = []
+
+    def _rerun(self, step, action=None):
+        """Apply an action to the current page and time the rerun it causes"""
+        started = time.perf_counter()
+        try:
+            (action() if action else self.app).run()
+        except Exception as e:
+            self.errors.append(f"{step}: {e}")
+            return
+        self.timings.append((step, (time.perf_counter() - started) * 1000))
+        if self.app.exception:
+            self.errors.append(f"{step}: {self.app.exception[0].message}")
+        elif self.app.error:
+            self.errors.append(f"{step}: {self.app.error[0].value}")
+
+    def _widget(self, widgets, label=None, key=None):
+        for widget in widgets:
+            if (key is not None and widget.key == key) or (label is not None and widget.label == label):
+                return widget
+        return None
+
+    def _open_page(self, page):
+        """Switch page with the navigation radio, if the app has one and another page is shown"""
+        radio = self._widget(self.app.radio, key="page")
+        if radio is not None and radio.value != page:
+            self._rerun("open_search" if page == SEARCH_PAGE else "open_topics", lambda: radio.set_value(page))
+
+    def _search(self, step):
+        button = self._widget(self.app.button, label=SEARCH_BUTTON)
+        if button is not None:
+            self._rerun(step, button.click)
+
+    def _think(self):
+        if self.think_time:
+            time.sleep(self.rng.expovariate(1 / self.think_time))
+
+    def type_query(self):
+        """Enter a query in two steps (every committed value reruns with suggestions), then search"""
+        self._open_page(SEARCH_PAGE)
+        query_text = self.rng.choice(self.queries)
+        cut = max(3, len(query_text) // 2)
+        for partial in (query_text[:cut], query_text):
+            field = self._widget(self.app.text_input, key="query")
+            if field is None:
+                return
+            self._rerun("type_query", lambda: field.input(partial))
+        self._search("search")
+
+    def switch_municipality(self):
+        self._open_page(SEARCH_PAGE)
+        select = self._widget(self.app.selectbox, label="Filtrér efter kommune:")
+        if select is None or not select.options:
+            return
+        self._rerun("switch_municipality", lambda: select.select(self.rng.choice(select.options)))
+        self._search("search_municipality")
+
+    def next_page(self):
+        self._open_page(SEARCH_PAGE)
+        button = self._widget(self.app.button, key="next_page")
+        if button is not None:
+            self._rerun("next_page", button.click)
+
+    def popular_topics(self):
+        """Open the Popular topics page and change the trend filter"""
+        self._open_page(TOPICS_PAGE)
+        select = self._widget(self.app.selectbox, key="trend_municipality")
+        if select is None or not select.options:
+            self._rerun("popular_topics")
+            return
+        self._rerun("popular_topics", lambda: select.select(self.rng.choice(select.options)))
+
+    def run(self, deadline):
+        self._rerun("first_paint")
+        steps = [self.type_query, self.type_query, self.switch_municipality, self.next_page, self.popular_topics]
+        while time.monotonic() < deadline:
+            self._think()
+            self.rng.choice(steps)()
+
+
+def run_level(sessions, duration, think_time=1.0, queries=QUERIES, seed=0):
+    """
+    Run `sessions` simulated users concurrently for `duration` seconds and
+    return latency per step, throughput, connections, CPU and RSS.
+    """
+    rng = random.Random(seed)
+    users = [Session(random.Random(rng.random()), queries, think_time) for _ in range(sessions)]
+    pool_before = dict(db.pool_stats() or {})
+    sampler = Sampler()
+    sampler.start()
+
+    cpu_before = cpu_seconds()
+    started = time.monotonic()
+    deadline = started + duration
+    threads = [threading.Thread(target=user.run, args=(deadline,), name=f"loadtest-session-{i}")
+               for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    cpu = cpu_seconds() - cpu_before
+    sampler.stop()
+
+    timings = [timing for user in users for timing in user.timings]
+    errors = [error for user in users for error in user.errors]
+    pool_after = db.pool_stats() or {}
+    samples = sampler.samples or [{"backends": 0, "pool_open": 0, "pool_in_use": 0, "rss_mb": rss_mb()}]
+    steps = {}
+    for step, ms in timings:
+        steps.setdefault(step, []).append(ms)
+
+    result = {
+        "sessions": sessions,
+        "duration_s": elapsed,
+        "reruns": len(timings),
+        "reruns_per_s": len(timings) / elapsed,
+        **(percentiles([ms for _, ms in timings]) if timings else {}),
+        "steps": {step: {"n": len(samples_ms), **percentiles(samples_ms)} for step, samples_ms in steps.items()},
+        "errors": len(errors),
+        "error_examples": errors[:5],
+        "peak_backends": max(sample["backends"] for sample in samples),
+        "peak_pool_open": max(sample["pool_open"] for sample in samples),
+        "peak_pool_in_use": max(sample["pool_in_use"] for sample in samples),
+        "pool_timeouts": pool_after.get("timeouts", 0) - pool_before.get("timeouts", 0),
+        "pool_wait_ms_mean": _mean_wait_ms(pool_before, pool_after),
+        "cpu_percent": cpu / elapsed * 100,
+        "peak_rss_mb": max(sample["rss_mb"] for sample in samples),
+    }
+    print(f"{sessions:>4} sessions  {result['reruns_per_s']:7.1f} reruns/s  "
+          f"p50 {result.get('p50_ms', 0):8.1f} ms  p95 {result.get('p95_ms', 0):8.1f} ms  "
+          f"p99 {result.get('p99_ms', 0):8.1f} ms  backends {result['peak_backends']:>3}  "
+          f"pool {result['peak_pool_in_use']}/{pool_after.get('max', '?')}  timeouts {result['pool_timeouts']:>3}  "
+          f"CPU {result['cpu_percent']:5.0f}%  RSS {result['peak_rss_mb']:7.1f} MB  errors {result['errors']}")
+    return result
+
+
+def _mean_wait_ms(before, after):
+    """Mean wait for a pooled connection between two pool_stats() readings"""
+    checkouts = after.get("checkouts", 0) - before.get("checkouts", 0)
+    waited = after.get("wait_seconds_total", 0.0) - before.get("wait_seconds_total", 0.0)
+    return waited / checkouts * 1000 if checkouts else 0.0
+
+
+def max_sessions(levels, target_p95_ms):
+    """Largest tested session count that kept p95 under the target without pool timeouts or errors"""
+    ok = [level["sessions"] for level in levels
+          if level.get("p95_ms", float("inf")) <= target_p95_ms and not level["pool_timeouts"] and not level["errors"]]
+    return max(ok) if ok else None
+
+
+def run(session_counts, duration=60, think_time=1.0, target_p95_ms=1000, queries=QUERIES):
+    """Run every level in turn (smallest first) and return the scaling curve as one document"""
+    levels = []
+    for sessions in sorted(session_counts):
+        levels.append(run_level(sessions, duration, think_time, queries))
+    capacity = max_sessions(levels, target_p95_ms)
+    print(f"Max sessions with p95 <= {target_p95_ms:.0f} ms and no pool timeouts: {capacity}")
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "database": db.DB_NAME,
+        "pool_max": db.DB_POOL_MAX,
+        "duration_s": duration,
+        "think_time_s": think_time,
+        "target_p95_ms": target_p95_ms,
+        "max_sessions": capacity,
+        "levels": levels,
+    }
+
+
+def first_paint(reruns=20, warm_up=False, query_text="budget"):
+    """
+    Time to the first rendered page in this (fresh) process, then the time of
+    plain reruns on the search page and on the Popular topics page. With
+    `warm_up`, warmup.warm_up() runs first, as startup.sh does before traffic.
+    """
+    # A running server has Streamlit loaded before any session, so its import is not part of the first paint
+    importlib.import_module("streamlit.testing.v1")
+
+    document = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "commit": _git_commit(),
+        "database": db.DB_NAME,
+        "warm_up": warm_up,
+    }
+    if warm_up:
+        import warmup
+
+        started = time.perf_counter()
+        warmup.warm_up(write_snapshot=True)
+        document["warm_up_ms"] = (time.perf_counter() - started) * 1000
+
+    rss_before = rss_mb()
+    session = Session(random.Random(0), [query_text], think_time=0)
+    session._rerun("first_paint")
+    for _ in range(reruns):
+        session._rerun("rerun_search")
+    session.type_query()
+    for _ in range(reruns):
+        session._rerun("rerun_search_results")
+    session._open_page(TOPICS_PAGE)
+    for _ in range(reruns):
+        session._rerun("rerun_topics")
+
+    steps = {}
+    for step, ms in session.timings:
+        steps.setdefault(step, []).append(ms)
+    document["first_paint_ms"] = steps.pop("first_paint", [None])[0]
+    document["steps"] = {step: {"n": len(samples_ms), **percentiles(samples_ms)} for step, samples_ms in steps.items()}
+    document["rss_mb"] = {"before": rss_before, "after": rss_mb()}
+    document["errors"] = session.errors[:5]
+
+    if document.get("warm_up_ms") is not None:
+        print(f"{'warm_up':<24} {document['warm_up_ms']:8.1f} ms")
+    print(f"{'first_paint':<24} {document['first_paint_ms'] or 0:8.1f} ms")
+    for step, stats in document["steps"].items():
+        print(f"{step:<24} p50 {stats['p50_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms  (n={stats['n']})")
+    for error in document["errors"]:
+        print(f"error: {error}")
+    return document
+
+
+def save(document, prefix="loadtest"):
+    os.makedirs(BENCH_RESULTS_DIR, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = os.path.join(BENCH_RESULTS_DIR, f"{prefix}-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2, default=str)
+    return path
+
+
+def plot(path):
+    """Write the scaling curve (latency, throughput, connections against sessions) next to the JSON file"""
+    import altair as alt
+    import pandas as pd
+
+    with open(path) as f:
+        document = json.load(f)
+    df = pd.DataFrame(document["levels"])
+    base = alt.Chart(df).encode(x=alt.X("sessions:Q", title="Samtidige sessioner"))
+    latency = base.transform_fold(["p50_ms", "p95_ms", "p99_ms"], as_=["percentile", "ms"]).mark_line(
+        point=True
+    ).encode(
+        y=alt.Y("ms:Q", title="Rerun (ms)"), color=alt.Color("percentile:N", title=None),
+        tooltip=["sessions:Q", "percentile:N", "ms:Q"]
+    ).properties(title="Svartid pr. rerun", width=500, height=250)
+    throughput = base.mark_line(point=True).encode(
+        y=alt.Y("reruns_per_s:Q", title="Reruns/s"), tooltip=["sessions", "reruns_per_s"]
+    ).properties(title="Gennemløb", width=500, height=250)
+    connections = base.mark_line(point=True).encode(
+        y=alt.Y("peak_backends:Q", title="Forbindelser"), tooltip=["sessions", "peak_backends", "pool_timeouts"]
+    ).properties(title="Databaseforbindelser (maks.)", width=500, height=250)
+    resources = base.mark_line(point=True).encode(
+        y=alt.Y("cpu_percent:Q", title="CPU %"), tooltip=["sessions", "cpu_percent", "peak_rss_mb"]
+    ).properties(title="CPU (RSS i tooltip)", width=500, height=250)
+    chart_path = os.path.splitext(path)[0] + ".html"
+    ((latency | throughput) & (connections | resources)).save(chart_path)
+    return chart_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="run the load test for each session count")
+    run_parser.add_argument("--sessions", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    run_parser.add_argument("--duration", type=float, default=60, help="seconds per session count")
+    run_parser.add_argument("--think-time", type=float, default=1.0, help="mean pause between steps (s)")
+    run_parser.add_argument("--target-p95-ms", type=float, default=1000)
+    run_parser.add_argument("--queries", nargs="+", default=QUERIES)
+    plot_parser = subparsers.add_parser("plot", help="write the scaling curve of a result file as HTML")
+    plot_parser.add_argument("path")
+    first_paint_parser = subparsers.add_parser("firstpaint", help="measure time to first paint and rerun times")
+    first_paint_parser.add_argument("--reruns", type=int, default=20)
+    first_paint_parser.add_argument("--warm-up", action="store_true", help="run warmup.warm_up() first")
+    first_paint_parser.add_argument("--query", default="budget")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        path = save(run(args.sessions, args.duration, args.think_time, args.target_p95_ms, args.queries))
+        print(f"Results: {path}")
+        print(f"Chart: {plot(path)}")
+    elif args.command == "firstpaint":
+        print(f"Results: {save(first_paint(args.reruns, args.warm_up, args.query), prefix='firstpaint')}")
+    else:
+        print(f"Chart: {plot(args.path)}")
@@ -0,0 +1,268 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import ContextDecorator
+
+from cache import approx_size
+
+# =====================
+# Instrumentation Settings
+# =====================
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") not in ("0", "false", "False")
+METRICS_BUFFER_SIZE = int(os.getenv("METRICS_BUFFER_SIZE", "1000"))  # seneste DB-kald i ringbufferen
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "1000"))
+# At most one EXPLAIN (ANALYZE, BUFFERS) per tag in this many seconds, since it runs the query again
+EXPLAIN_INTERVAL = float(os.getenv("SLOW_QUERY_EXPLAIN_INTERVAL", "300"))
+EXPLAIN_BUFFER_SIZE = 50
+
+# Prometheus histogram buckets for execute time (seconds)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_PREFIX = "kommunedata_db"
+
+# Only read-only statements are EXPLAIN ANALYZE'd (it executes them): queries that take row or
+# advisory locks, use sequences or modify data in a CTE are skipped, and the rest run in a
+# READ ONLY transaction
+EXPLAINABLE_RE = re.compile(r"^\s*(SELECT|WITH|EXECUTE\s+stmt_)", re.IGNORECASE)
+WRITING_RE = re.compile(
+    r"\b(INSERT|UPDATE|DELETE|MERGE|FOR\s+(NO\s+KEY\s+)?(UPDATE|SHARE|KEY\s+SHARE)"
+    r"|pg_(try_)?advisory\w*|nextval|setval|lo_\w+)\b",
+    re.IGNORECASE
+)
+
+logger = logging.getLogger(__name__)
+
+_tag = contextvars.ContextVar("metrics_tag", default="untagged")
+_explain_slow = contextvars.ContextVar("metrics_explain_slow", default=True)
+_local = threading.local()
+_lock = threading.Lock()
+_calls = deque(maxlen=METRICS_BUFFER_SIZE)
+_plans = deque(maxlen=EXPLAIN_BUFFER_SIZE)
+_totals = {}  # tag -> counters
+_last_explain = {}  # tag -> monotonic time of the last EXPLAIN
+
+
+class tagged(ContextDecorator):
+    """
+    Context manager / decorator that tags the DB calls made inside it, e.g.
+    @metrics.tagged("do_search"). Tags follow contextvars, so work handed to
+    a thread pool keeps its tag when submitted with contextvars.copy_context().run.
+    """
+
+    def __init__(self, tag):
+        self.tag = tag
+        self._token = None
+
+    def _recreate_cm(self):
+        # A fresh instance per decorated call, so concurrent calls do not share the token
+        return tagged(self.tag)
+
+    def __enter__(self):
+        self._token = _tag.set(self.tag)
+        return self
+
+    def __exit__(self, *exc):
+        _tag.reset(self._token)
+        return False
+
+
+class without_explain(ContextDecorator):
+    """
+    Context manager / decorator under which slow queries are still counted but
+    not EXPLAIN ANALYZE'd, e.g. the warm-up, whose queries are slow because the
+    caches are cold and would only be run a second time. Follows contextvars
+    like `tagged`.
+    """
+
+    def __init__(self):
+        self._token = None
+
+    def _recreate_cm(self):
+        return without_explain()
+
+    def __enter__(self):
+        self._token = _explain_slow.set(False)
+        return self
+
+    def __exit__(self, *exc):
+        _explain_slow.reset(self._token)
+        return False
+
+
+def current_tag():
+    return _tag.get()
+
+
+def note_acquire(seconds):
+    """Called by the pool after a checkout; attached to the next query on this thread"""
+    _local.acquire = seconds
+
+
+def record_execute(query, params, seconds, error=None):
+    """Record one execute() and return the entry, so fetches can add rows and bytes to it"""
+    tag = _tag.get()
+    acquire = getattr(_local, "acquire", None)
+    _local.acquire = None
+    entry = {
+        "time": time.time(),
+        "tag": tag,
+        "acquire_ms": acquire * 1000 if acquire is not None else None,
+        "execute_ms": seconds * 1000,
+        "rows": 0,
+        "bytes": 0,
+        "statement": " ".join(query.split())[:300] if isinstance(query, str) else str(query)[:300],
+        "error": error,
+    }
+    slow = seconds * 1000 >= SLOW_QUERY_MS
+    with _lock:
+        _calls.append(entry)
+        totals = _totals.setdefault(tag, {
+            "calls": 0, "errors": 0, "slow": 0, "execute_seconds": 0.0, "acquire_seconds": 0.0,
+            "rows": 0, "bytes": 0, "buckets": [0] * len(BUCKETS),
+        })
+        totals["calls"] += 1
+        totals["errors"] += error is not None
+        totals["slow"] += slow
+        totals["execute_seconds"] += seconds
+        totals["acquire_seconds"] += acquire or 0.0
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                totals["buckets"][i] += 1
+        explain = (slow and error is None and not getattr(_local, "explaining", False) and _explain_slow.get()
+                   and time.monotonic() - _last_explain.get(tag, float("-inf")) >= EXPLAIN_INTERVAL)
+        if explain:
+            _last_explain[tag] = time.monotonic()
+
+    if explain:
+        threading.Thread(target=_explain, args=(tag, query, params, seconds), name="slow-query-explain",
+                         daemon=True).start()
+    return entry
+
+
+def record_fetch(entry, rows):
+    """Add fetched rows (a list of rows, or a single row) to an execute entry"""
+    if entry is None or rows is None:
+        return
+    count = len(rows) if isinstance(rows, list) else 1
+    size = approx_size(rows)
+    entry["rows"] += count
+    entry["bytes"] += size
+    with _lock:
+        totals = _totals.get(entry["tag"])
+        if totals is not None:
+            totals["rows"] += count
+            totals["bytes"] += size
+
+
+def is_read_only(statement):
+    """
+    Whether a statement can safely run again under EXPLAIN ANALYZE. An EXECUTE
+    is judged by the SQL of its prepared statement.
+    """
+    import db
+
+    if not EXPLAINABLE_RE.match(statement):
+        return False
+    match = re.match(r"\s*EXECUTE\s+(stmt_\w+)", statement)
+    if match:
+        statement = db.prepared_sql(match.group(1))
+        if statement is None:
+            return False
+    return not WRITING_RE.search(statement)
+
+
+def _explain(tag, query, params, seconds):
+    """
+    EXPLAIN (ANALYZE, BUFFERS) the last statement of a slow query on another
+    pooled connection. Earlier statements (set_config calls) run first so the
+    plan sees the same settings; prepared statements are prepared on that
+    connection if needed. Only read-only statements (is_read_only) are
+    explained, in a READ ONLY transaction that is rolled back.
+    """
+    import db
+
+    statements = [statement for statement in query.split(";") if statement.strip()]
+    if not statements or not is_read_only(statements[-1]):
+        return
+    if len(statements) > 1 and not isinstance(params, dict):
+        return
+    _local.explaining = True
+    try:
+        with db.db_cursor() as cur:
+            cur.execute("SET TRANSACTION READ ONLY")
+            for statement in statements[:-1]:
+                cur.execute(statement, params)
+            match = re.match(r"\s*EXECUTE\s+(stmt_\w+)", statements[-1])
+            if match:
+                db.ensure_prepared(cur, match.group(1))
+            cur.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {statements[-1]}", params)
+            plan = cur.fetchone()["QUERY PLAN"][0]
+        with _lock:
+            _plans.append({"time": time.time(), "tag": tag, "execute_ms": seconds * 1000,
+                           "statement": " ".join(statements[-1].split())[:1000], "plan": plan})
+        logger.warning("Slow query (%s, %.0f ms) explained: %.1f ms in EXPLAIN ANALYZE",
+                       tag, seconds * 1000, plan.get("Execution Time", 0))
+    except Exception:
+        logger.exception("EXPLAIN of slow %s query failed", tag)
+    finally:
+        _local.explaining = False
+
+
+def recent_calls():
+    """The ring buffer of recent DB calls, newest first"""
+    with _lock:
+        return [dict(entry) for entry in reversed(_calls)]
+
+
+def slow_query_plans():
+    """Sampled EXPLAIN (ANALYZE, BUFFERS) plans of slow queries, newest first"""
+    with _lock:
+        return list(reversed(_plans))
+
+
+def totals():
+    """Counters per tag since the process started"""
+    with _lock:
+        return {tag: dict(values, buckets=list(values["buckets"])) for tag, values in _totals.items()}
+
+
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def prometheus_text(pool=None):
+    """All counters in the Prometheus text exposition format; `pool` is db.pool_stats()"""
+    lines = []
+    counters = totals()
+    for name, key, kind, help_text in (
+        ("queries_total", "calls", "counter", "DB calls"),
+        ("errors_total", "errors", "counter", "DB calls that raised"),
+        ("slow_queries_total", "slow", "counter", f"DB calls slower than {SLOW_QUERY_MS:.0f} ms"),
+        ("acquire_seconds_total", "acquire_seconds", "counter", "Time spent waiting for a pooled connection"),
+        ("rows_total", "rows", "counter", "Rows fetched"),
+        ("bytes_total", "bytes", "counter", "Approximate bytes fetched"),
+    ):
+        lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+        lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+        for tag, values in sorted(counters.items()):
+            lines.append(f"{METRIC_PREFIX}_{name}{_labels(tag=tag)} {values[key]}")
+
+    lines.append(f"# HELP {METRIC_PREFIX}_execute_seconds Time spent executing DB calls")
+    lines.append(f"# TYPE {METRIC_PREFIX}_execute_seconds histogram")
+    for tag, values in sorted(counters.items()):
+        for bound, count in zip(BUCKETS, values["buckets"]):
+            lines.append(f"{METRIC_PREFIX}_execute_seconds_bucket{_labels(tag=tag, le=bound)} {count}")
+        lines.append(f"{METRIC_PREFIX}_execute_seconds_bucket{_labels(tag=tag, le='+Inf')} {values['calls']}")
+        lines.append(f"{METRIC_PREFIX}_execute_seconds_sum{_labels(tag=tag)} {values['execute_seconds']}")
+        lines.append(f"{METRIC_PREFIX}_execute_seconds_count{_labels(tag=tag)} {values['calls']}")
+
+    for name, kind in (("in_use", "gauge"), ("idle", "gauge"), ("open", "gauge"), ("max", "gauge"),
+                       ("timeouts", "counter"), ("discarded", "counter")):
+        if pool and name in pool:
+            metric = f"{METRIC_PREFIX}_pool_{name}" + ("_total" if kind == "counter" else "")
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {pool[name]}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,178 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import psycopg2
+
+import refresh
+import search
+from cache import search_cache, search_key
+from db import DB_POOL_MAX, get_pool
+
+# =====================
+# Pipeline Settings
+# =====================
+# Server-side statement_timeout per query (ms)
+RESULTS_TIMEOUT_MS = int(os.getenv("SEARCH_RESULTS_TIMEOUT_MS", "30000"))
+COUNT_TIMEOUT_MS = int(os.getenv("SEARCH_COUNT_TIMEOUT_MS", "5000"))
+FACETS_TIMEOUT_MS = int(os.getenv("SEARCH_FACETS_TIMEOUT_MS", "5000"))
+# How long the response waits for the count and facets after the results (s); slower ones
+# are cancelled then, so they give their connections back
+SECONDARY_GRACE = float(os.getenv("SEARCH_SECONDARY_GRACE", "0.5"))
+PIPELINE_WORKERS = int(os.getenv("SEARCH_PIPELINE_WORKERS", "8"))
+# Pooled connections the count and facet queries of all sessions may hold at once; kept below
+# DB_POOL_MAX, so the results queries always find a free connection
+SECONDARY_CONNECTIONS = int(os.getenv("SEARCH_SECONDARY_CONNECTIONS", str(max(1, DB_POOL_MAX // 2))))
+# Results per page in the app; warmup.py searches with the same limit, so it fills the same cache keys
+RESULTS_PER_PAGE = 20
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="search-pipeline")
+_secondary_slots = threading.BoundedSemaphore(SECONDARY_CONNECTIONS)
+
+
+class QueryTask:
+    """
+    One count or facet statement running on its own pooled connection, once
+    one of the SECONDARY_CONNECTIONS slots is free. cancel() sends a cancel
+    request to the backend (like pg_cancel_backend) while the statement is
+    running, and stops a task that is still waiting for a slot.
+    """
+
+    def __init__(self, name, query, params, timeout_ms, fetch):
+        self.name = name
+        self.query = query
+        self.params = params
+        self.timeout_ms = timeout_ms
+        self.fetch = fetch
+        self.elapsed = None
+        self._conn = None
+        self._lock = threading.Lock()
+        self._cancelled = False
+
+    def run(self):
+        started = time.monotonic()
+        while not _secondary_slots.acquire(timeout=0.05):
+            if self._cancelled:
+                return None
+        try:
+            with get_pool().connection() as conn:
+                with self._lock:
+                    if self._cancelled:
+                        return None
+                    self._conn = conn
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT set_config('statement_timeout', %s, true)", [str(self.timeout_ms)])
+                        cur.execute(self.query, self.params)
+                        return self.fetch(cur)
+                finally:
+                    with self._lock:
+                        self._conn = None
+                    self.elapsed = time.monotonic() - started
+        finally:
+            _secondary_slots.release()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            if self._conn is not None:
+                try:
+                    self._conn.cancel()
+                except psycopg2.Error:
+                    pass
+
+
+def _facets(cur):
+    facets = {"municipality": [], "category": []}
+    for row in cur.fetchall():
+        facets[row["facet"]].append((row["value"], row["count"]))
+    return facets
+
+
+def _secondary(task, future, deadline):
+    """
+    Wait for a count/facet query until the deadline; one that is still
+    running (or still waiting for a slot) is cancelled then. Returns None
+    for a query that did not finish.
+    """
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        logger.info("%s query cancelled, still running after the results were ready", task.name)
+        task.cancel()
+        future.cancel()
+    except psycopg2.errors.QueryCanceled:
+        logger.info("%s query hit its statement timeout", task.name)
+    except Exception:
+        logger.exception("%s query failed", task.name)
+    return None
+
+
+def search_page(query_text="", municipality=None, start_date=None, end_date=None, limit=20, after=None,
+                with_count=True, with_facets=True, collapse=None):
+    """
+    Results, total count and facet counts for one search, with the three
+    queries running in parallel on separate pooled connections. With
+    `collapse` the results and the count are per near-duplicate cluster; the
+    facets always count every matching item.
+
+    The results decide when the response is ready: the count and facets get
+    SECONDARY_GRACE seconds more, after which they are cancelled and come back
+    as None. Returns {"rows", "total_count", "facets", "timings"}.
+    """
+    if search.SEARCH_BACKEND != "postgres":
+        rows, total_count = search.search(query_text, municipality, start_date, end_date, limit, with_count, after,
+                                          collapse=collapse)
+        return {"rows": rows, "total_count": total_count, "facets": None, "timings": {}}
+
+    collapse = search.COLLAPSE_DUPLICATES if collapse is None else collapse
+    collapse = collapse and search.collapse_available()
+    generation, _ = refresh.current_generation()
+    key = search_key(query_text, municipality, start_date, end_date)
+    filters = dict(municipality=municipality, start_date=start_date, end_date=end_date)
+
+    secondary, cache_keys = {}, {}
+    for name, enabled, build, extra, timeout_ms, fetch in (
+        ("count", with_count, search.build_count_query, {"collapse": collapse}, COUNT_TIMEOUT_MS,
+         lambda cur: cur.fetchone()["total_count"]),
+        ("facets", with_facets, search.build_facet_query, {}, FACETS_TIMEOUT_MS, _facets),
+    ):
+        if not enabled:
+            continue
+        cache_keys[name] = key + (name,) + tuple(extra.values())
+        cached = search_cache.get(cache_keys[name], generation)
+        if cached is not None:
+            secondary[name] = (None, None, cached)
+            continue
+        task = QueryTask(name, *build(query_text, **filters, **extra), timeout_ms, fetch)
+        # copy_context keeps the metrics tag of the caller (see metrics.tagged)
+        secondary[name] = (task, _executor.submit(contextvars.copy_context().run, task.run), None)
+
+    started = time.monotonic()
+    try:
+        rows, _ = search.search(query_text, municipality, start_date, end_date, limit, with_count=False,
+                                after=after, timeout_ms=RESULTS_TIMEOUT_MS, collapse=collapse)
+    except Exception:
+        for task, _, _ in secondary.values():
+            if task is not None:
+                task.cancel()
+        raise
+    timings = {"results": time.monotonic() - started}
+
+    deadline = time.monotonic() + SECONDARY_GRACE
+    response = {"rows": rows, "total_count": None, "facets": None, "timings": timings}
+    for name, (task, future, cached) in secondary.items():
+        if task is None:
+            response["total_count" if name == "count" else name] = cached
+            continue
+        value = _secondary(task, future, deadline)
+        if value is not None:
+            search_cache.put(cache_keys[name], value, generation)
+            timings[name] = task.elapsed
+        response["total_count" if name == "count" else name] = value
+    return response
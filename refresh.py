@@ -0,0 +1,205 @@
+import importlib
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+
+import metrics
+from db import db_cursor
+
+# =====================
+# Refresh Settings
+# =====================
+VIEW_NAME = "sourceview.foraisearch_with_search"
+SOURCE_TABLES = ("source.referater", "source.subjects")
+
+REFRESH_INTERVAL = float(os.getenv("REFRESH_INTERVAL", "3600"))  # sekunder mellem faste opdateringer
+REFRESH_POLL_INTERVAL = float(os.getenv("REFRESH_POLL_INTERVAL", "60"))  # sekunder mellem tjek for ændringer
+REFRESH_ON_CHANGE = os.getenv("REFRESH_ON_CHANGE", "1") not in ("0", "false", "False")
+
+# Key for pg_try_advisory_lock, so only one refresh runs across all processes
+REFRESH_LOCK_KEY = 74_201_001
+
+# Modules that register on_refresh callbacks. The app and the API both run a scheduler and
+# whichever takes the advisory lock refreshes, so each imports all of them before starting
+REFRESH_MODULES = ("search", "snapshot", "rollup", "alerts", "dedup")
+
+logger = logging.getLogger(__name__)
+
+_refresh_lock = threading.Lock()
+_state_lock = threading.Lock()
+_state = {
+    "generation": None,
+    "refreshed_at": None,
+    "source_fingerprint": None,
+}
+_callbacks = []
+_scheduler = None
+
+
+def source_fingerprint(cur):
+    """
+    Cheap change marker for the source tables: total inserted/updated/deleted
+    tuples according to the statistics collector.
+    """
+    cur.execute(
+        """
+        SELECT COALESCE(SUM(n_tup_ins + n_tup_upd + n_tup_del), 0) AS changes
+        FROM pg_stat_user_tables
+        WHERE schemaname || '.' || relname = ANY(%s)
+        """,
+        [list(SOURCE_TABLES)]
+    )
+    return int(cur.fetchone()["changes"])
+
+
+def load_generation():
+    """Read the latest refresh generation from the refresh log into the process state"""
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            SELECT generation, refreshed_at, source_fingerprint
+            FROM sourceview.view_refresh_log
+            WHERE view_name = %s
+            ORDER BY generation DESC
+            LIMIT 1
+            """,
+            [VIEW_NAME]
+        )
+        row = cur.fetchone()
+    if row:
+        with _state_lock:
+            _state.update(row)
+    return current_generation()
+
+
+def current_generation():
+    """Return (generation, refreshed_at) of the materialized view as last seen by this process"""
+    with _state_lock:
+        return _state["generation"], _state["refreshed_at"]
+
+
+def on_refresh(callback):
+    """Register a callback(generation) that runs after every successful refresh in this process"""
+    if callback not in _callbacks:
+        _callbacks.append(callback)
+    return callback
+
+
+@metrics.tagged("refresh_view")
+def refresh_view(force=False):
+    """
+    Refresh the materialized view CONCURRENTLY, so readers are never blocked.
+
+    Only one refresh runs at a time: within the process via a lock, and across
+    processes via a Postgres advisory lock. Unless `force` is set, the refresh is
+    skipped when the source tables have not changed since the last generation.
+    Returns the new generation, or None when nothing was refreshed.
+    """
+    if not _refresh_lock.acquire(blocking=False):
+        return None
+    try:
+        with db_cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s) AS locked", [REFRESH_LOCK_KEY])
+            if not cur.fetchone()["locked"]:
+                return None
+            try:
+                fingerprint = source_fingerprint(cur)
+                with _state_lock:
+                    unchanged = fingerprint == _state["source_fingerprint"]
+                if unchanged and not force:
+                    return None
+
+                started = time.monotonic()
+                cur.execute("SELECT now() AS started_at")
+                started_at = cur.fetchone()["started_at"]
+                try:
+                    cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {VIEW_NAME}")
+                except psycopg2.errors.ObjectNotInPrerequisiteState:
+                    # A view that has never been populated cannot be refreshed concurrently
+                    cur.connection.rollback()
+                    cur.execute(f"REFRESH MATERIALIZED VIEW {VIEW_NAME}")
+                duration_ms = int((time.monotonic() - started) * 1000)
+
+                cur.execute(
+                    """
+                    INSERT INTO sourceview.view_refresh_log
+                        (view_name, started_at, duration_ms, source_fingerprint)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING generation, refreshed_at, source_fingerprint
+                    """,
+                    [VIEW_NAME, started_at, duration_ms, fingerprint]
+                )
+                row = cur.fetchone()
+                cur.connection.commit()
+            finally:
+                cur.connection.rollback()
+                cur.execute("SELECT pg_advisory_unlock(%s)", [REFRESH_LOCK_KEY])
+                cur.connection.commit()
+    finally:
+        _refresh_lock.release()
+
+    with _state_lock:
+        _state.update(row)
+    logger.info("Refreshed %s to generation %s in %d ms", VIEW_NAME, row["generation"], duration_ms)
+
+    for callback in list(_callbacks):
+        try:
+            callback(row["generation"])
+        except Exception:
+            logger.exception("Refresh callback %r failed", callback)
+    return row["generation"]
+
+
+class RefreshScheduler(threading.Thread):
+    """
+    Background thread that refreshes the view on a fixed interval and, when
+    REFRESH_ON_CHANGE is set, as soon as the source tables change.
+    """
+
+    def __init__(self, interval=REFRESH_INTERVAL, poll_interval=REFRESH_POLL_INTERVAL,
+                 on_change=REFRESH_ON_CHANGE):
+        super().__init__(name="refresh-scheduler", daemon=True)
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.on_change = on_change
+        self._stop_event = threading.Event()
+        self._last_refresh = time.monotonic()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @metrics.tagged("refresh_scheduler")
+    def tick(self):
+        """One scheduling decision: refresh when the interval elapsed or the sources changed"""
+        load_generation()
+        due = time.monotonic() - self._last_refresh >= self.interval
+        if due or self.on_change:
+            # Without `force`, refresh_view() skips the work when nothing changed
+            if refresh_view(force=due) is not None or due:
+                self._last_refresh = time.monotonic()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Scheduled refresh of %s failed", VIEW_NAME)
+            self._stop_event.wait(self.poll_interval)
+
+
+def start_scheduler():
+    """
+    Start the process-wide refresh scheduler once, after importing
+    REFRESH_MODULES so every refresh runs all callbacks; safe to call on every rerun
+    """
+    global _scheduler
+    for module in REFRESH_MODULES:
+        importlib.import_module(module)
+    with _state_lock:
+        if _scheduler is None or not _scheduler.is_alive():
+            _scheduler = RefreshScheduler()
+            _scheduler.start()
+    return _scheduler
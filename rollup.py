@@ -0,0 +1,294 @@
+import logging
+import os
+
+import pandas as pd
+
+import refresh
+import snapshot
+from cache import ResultCache
+from db import db_cursor
+
+# =====================
+# Kategori-rollup
+# =====================
+CATEGORY_ROLLUP_VIEW = "sourceview.category_rollup"
+ROLLUP_COLUMNS = ["municipality", "category", "count"]
+
+# The rollup is small and only changes with the view generation
+rollup_cache = ResultCache(max_entries=8)
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_category_rollup(generation=None):
+    """Rebuild the (municipality, category, count) rollup after a view refresh"""
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {CATEGORY_ROLLUP_VIEW}")
+    rollup_cache.clear()
+
+
+refresh.on_refresh(refresh_category_rollup)
+
+
+def _from_snapshot_or_live(key, from_snapshot, live, prefer_snapshot=True):
+    """
+    Load from the Parquet snapshot when it is fresh, otherwise with a live query.
+    If the live query fails (database down or overloaded), a stale snapshot is
+    better than nothing. Results are cached per view generation.
+    """
+    generation, _ = refresh.current_generation()
+    value = rollup_cache.get(key, generation)
+    if value is not None:
+        return value
+
+    dataset = snapshot.open_snapshot(generation) if prefer_snapshot else None
+    if dataset is not None:
+        value = from_snapshot(dataset)
+    else:
+        try:
+            value = live()
+        except Exception:
+            dataset = snapshot.open_snapshot(generation, allow_stale=True)
+            if dataset is None:
+                raise
+            logger.warning("Live query for %s failed; using a stale snapshot", key, exc_info=True)
+            value = from_snapshot(dataset)
+    rollup_cache.put(key, value, generation)
+    return value
+
+
+def _live_category_rollup():
+    with db_cursor() as cur:
+        cur.execute(f"SELECT municipality, category, count FROM {CATEGORY_ROLLUP_VIEW}")
+        df = pd.DataFrame(cur.fetchall(), columns=ROLLUP_COLUMNS)
+    df["count"] = df["count"].astype("int64")
+    return df
+
+
+def _live_municipalities():
+    with db_cursor() as cur:
+        cur.execute(f"SELECT DISTINCT municipality FROM {refresh.VIEW_NAME} ORDER BY municipality")
+        return [row["municipality"] for row in cur.fetchall()]
+
+
+def load_category_rollup():
+    """
+    Load the whole rollup from the snapshot (see snapshot.py) or with one query,
+    or from the in-process cache when it has already been loaded for the
+    current view generation
+    """
+    return _from_snapshot_or_live("category_rollup", snapshot.category_rollup, _live_category_rollup)
+
+
+def load_municipalities():
+    """All municipalities in the view, for the search filter"""
+    return _from_snapshot_or_live("municipalities", snapshot.municipalities, _live_municipalities)
+
+
+def all_categories(rollup):
+    """Category counts across all municipalities, most frequent first"""
+    return (rollup.groupby("category", as_index=False)["count"].sum()
+            .sort_values("count", ascending=False, ignore_index=True))
+
+
+def categories_by_municipality(rollup):
+    """Category counts per municipality"""
+    return rollup.sort_values(["municipality", "count"], ascending=[True, False], ignore_index=True)
+
+
+def municipality_categories(rollup, municipality):
+    """Category counts for a single municipality, most frequent first"""
+    return (rollup.loc[rollup["municipality"] == municipality, ["category", "count"]]
+            .sort_values("count", ascending=False, ignore_index=True))
+
+
+# =====================
+# Kategoritrends
+# =====================
+CATEGORY_TRENDS_TABLE = "sourceview.category_trends"
+TREND_COLUMNS = ["municipality", "category", "month", "count"]
+TRENDS_WATERMARK = "category_trends"
+# The newest months are counted again from the view on every refresh, since that is where
+# items are still edited, recategorised and deleted; everything is every TRENDS_FULL_INTERVAL
+TRENDS_RECOUNT_MONTHS = int(os.getenv("TRENDS_RECOUNT_MONTHS", "3"))
+TRENDS_FULL_INTERVAL = float(os.getenv("TRENDS_FULL_INTERVAL", "86400"))  # sekunder
+TRENDS_FULL_WATERMARK = "category_trends_full"  # updated_at: the last full recount
+# Most points per line before "auto" downsamples to quarters, and then to years
+TRENDS_MAX_POINTS = int(os.getenv("TRENDS_MAX_POINTS", "36"))
+# Period frequency and start-of-period frequency for each chart resolution
+RESOLUTIONS = {"month": ("M", "MS"), "quarter": ("Q", "QS"), "year": ("Y", "YS")}
+
+
+def refresh_category_trends(generation=None, rebuild=False):
+    """
+    Keep the monthly (municipality, category, month, count) table in step with
+    the view without grouping all of it on every refresh. Rows added since the
+    last run (id above the watermark) are folded in; the last
+    TRENDS_RECOUNT_MONTHS months are counted again from the view, so edits and
+    deletes there are reflected at once; and every TRENDS_FULL_INTERVAL seconds
+    (or with `rebuild`) all months are, which fixes older items that changed
+    category or were deleted. Returns the number of counts changed.
+    """
+    with db_cursor(commit=True) as cur:
+        # The row lock makes concurrent processes fold each id range only once
+        cur.execute("SELECT last_id FROM sourceview.rollup_watermark WHERE rollup_name = %s FOR UPDATE",
+                    [TRENDS_WATERMARK])
+        row = cur.fetchone()
+        last_id = row["last_id"] if row else 0
+        cur.execute(
+            f"""
+            SELECT
+                (SELECT COALESCE(MAX(id), 0) FROM {refresh.VIEW_NAME}) AS max_id,
+                (date_trunc('month', CURRENT_DATE) - make_interval(months => %s))::date AS recount_from,
+                (SELECT updated_at FROM sourceview.rollup_watermark WHERE rollup_name = %s)
+                    < now() - make_interval(secs => %s) IS NOT FALSE AS full_due
+            """,
+            [TRENDS_RECOUNT_MONTHS - 1, TRENDS_FULL_WATERMARK, TRENDS_FULL_INTERVAL]
+        )
+        row = cur.fetchone()
+        max_id = row["max_id"]
+        # A view rebuilt from scratch can hand out lower ids than already folded in
+        full = rebuild or max_id < last_id or row["full_due"]
+        recount_from = None if full else row["recount_from"]
+        params = {"last_id": last_id, "max_id": max_id, "recount_from": recount_from}
+        counted = """
+            id <= %(max_id)s
+            AND category IS NOT NULL AND municipality IS NOT NULL AND meeting_date IS NOT NULL
+        """
+
+        updated = 0
+        if not full and max_id > last_id:
+            # New rows in the recounted months are counted below
+            cur.execute(
+                f"""
+                INSERT INTO {CATEGORY_TRENDS_TABLE} AS t (municipality, category, month, count)
+                SELECT municipality, category, date_trunc('month', meeting_date)::date, COUNT(*)
+                FROM {refresh.VIEW_NAME}
+                WHERE id > %(last_id)s AND {counted} AND meeting_date < %(recount_from)s
+                GROUP BY 1, 2, 3
+                ON CONFLICT (municipality, category, month) DO UPDATE SET count = t.count + EXCLUDED.count
+                """,
+                params
+            )
+            updated += cur.rowcount
+
+        cur.execute(
+            f"""
+            CREATE TEMP TABLE recounted_trends ON COMMIT DROP AS
+            SELECT municipality, category, date_trunc('month', meeting_date)::date AS month, COUNT(*) AS count
+            FROM {refresh.VIEW_NAME}
+            WHERE {counted} AND (%(recount_from)s::date IS NULL OR meeting_date >= %(recount_from)s)
+            GROUP BY 1, 2, 3
+            """,
+            params
+        )
+        cur.execute(
+            f"""
+            DELETE FROM {CATEGORY_TRENDS_TABLE} t
+            WHERE (%(recount_from)s::date IS NULL OR t.month >= %(recount_from)s)
+              AND NOT EXISTS (
+                  SELECT 1 FROM recounted_trends r
+                  WHERE r.municipality = t.municipality AND r.category = t.category AND r.month = t.month
+              )
+            """,
+            params
+        )
+        updated += cur.rowcount
+        cur.execute(
+            f"""
+            INSERT INTO {CATEGORY_TRENDS_TABLE} AS t (municipality, category, month, count)
+            SELECT municipality, category, month, count FROM recounted_trends
+            ON CONFLICT (municipality, category, month) DO UPDATE SET count = EXCLUDED.count
+            WHERE t.count <> EXCLUDED.count
+            """
+        )
+        updated += cur.rowcount
+
+        watermarks = [TRENDS_WATERMARK] + ([TRENDS_FULL_WATERMARK] if full else [])
+        cur.execute(
+            """
+            INSERT INTO sourceview.rollup_watermark (rollup_name, last_id, updated_at)
+            SELECT rollup_name, %s, now() FROM unnest(%s::text[]) AS rollup_name
+            ON CONFLICT (rollup_name) DO UPDATE SET last_id = EXCLUDED.last_id, updated_at = EXCLUDED.updated_at
+            """,
+            [max_id, watermarks]
+        )
+    rollup_cache.clear()
+    logger.info("Updated %s to id %s (%s): %d counts changed", CATEGORY_TRENDS_TABLE, max_id,
+                "all months recounted" if full else f"recounted from {recount_from}", updated)
+    return updated
+
+
+refresh.on_refresh(refresh_category_trends)
+
+
+def _live_category_trends():
+    with db_cursor() as cur:
+        cur.execute(f"SELECT municipality, category, month, count FROM {CATEGORY_TRENDS_TABLE}")
+        df = pd.DataFrame(cur.fetchall(), columns=TREND_COLUMNS)
+    df["month"] = pd.to_datetime(df["month"])
+    df["count"] = df["count"].astype("int64")
+    return df
+
+
+def load_category_trends():
+    """
+    Load the whole trends table (one row per municipality, category and month)
+    with one query, cached per view generation. The table is maintained
+    incrementally, so it is read live; the snapshot is only the fallback.
+    """
+    return _from_snapshot_or_live("category_trends", snapshot.category_trends, _live_category_trends,
+                                  prefer_snapshot=False)
+
+
+def top_categories(trends, n=5, municipality=None):
+    """The n categories with the most items overall, or in one municipality"""
+    if municipality is not None:
+        trends = trends.loc[trends["municipality"] == municipality]
+    return trends.groupby("category")["count"].sum().nlargest(n).index.tolist()
+
+
+def category_trends(trends, municipality=None, categories=None, start=None, end=None):
+    """Monthly counts per category for one municipality, or summed over all of them"""
+    mask = pd.Series(True, index=trends.index)
+    if municipality is not None:
+        mask &= trends["municipality"] == municipality
+    if categories:
+        mask &= trends["category"].isin(categories)
+    if start is not None:
+        mask &= trends["month"] >= pd.Timestamp(start)
+    if end is not None:
+        mask &= trends["month"] <= pd.Timestamp(end)
+    return (trends.loc[mask].groupby(["category", "month"], as_index=False)["count"].sum()
+            .rename(columns={"month": "period"}))
+
+
+def choose_resolution(df, max_points=TRENDS_MAX_POINTS):
+    """The finest resolution that keeps each line at or below max_points points"""
+    if df.empty:
+        return "month"
+    first, last = df["period"].min(), df["period"].max()
+    months = (last.year - first.year) * 12 + last.month - first.month + 1
+    if months <= max_points:
+        return "month"
+    if months / 3 <= max_points:
+        return "quarter"
+    return "year"
+
+
+def downsample_trends(df, resolution="auto", max_points=TRENDS_MAX_POINTS):
+    """
+    Sum monthly (category, period, count) rows into quarters or years for long
+    ranges and fill periods without items with 0, so the lines do not
+    interpolate over gaps. Returns the frame and the resolution used.
+    """
+    if resolution == "auto":
+        resolution = choose_resolution(df, max_points)
+    if df.empty:
+        return df, resolution
+    period_freq, start_freq = RESOLUTIONS[resolution]
+    periods = df["period"].dt.to_period(period_freq).dt.start_time
+    wide = df.groupby([periods, "category"])["count"].sum().unstack("category", fill_value=0)
+    wide = wide.reindex(pd.date_range(wide.index.min(), wide.index.max(), freq=start_freq), fill_value=0)
+    wide.index.name = "period"
+    return wide.stack().rename("count").reset_index(), resolution
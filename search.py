@@ -0,0 +1,564 @@
+import logging
+import os
+import statistics
+import threading
+import time
+
+import psycopg2
+
+import refresh
+from cache import detail_cache, search_cache, search_key
+from db import db_cursor, execute_prepared
+from tsquery import parse_query
+
+# =====================
+# Søgning i PostgreSQL
+# =====================
+VIEW_NAME = "sourceview.foraisearch_with_search"
+
+# Trigram matching on the precomputed search_text column (sql/002_search_text_trgm.sql).
+# "%" compares the query with the whole text (similarity), "<%" with the best
+# matching part of it (word_similarity), which suits short queries better: a few
+# words are never similar to a whole agenda text. Fuzzy matching only runs when
+# the keyword match finds nothing (see build_match_source)
+FUZZY_MODES = {
+    # operator: (match predicate, score expression, threshold setting, pg_trgm's default threshold)
+    "%": ("search_text %% %(query_text)s",
+          "similarity(search_text, %(query_text)s)",
+          "pg_trgm.similarity_threshold", 0.3),
+    "<%": ("%(query_text)s <%% search_text",
+           "word_similarity(%(query_text)s, search_text)",
+           "pg_trgm.word_similarity_threshold", 0.6),
+}
+FUZZY_OPERATOR = os.getenv("SEARCH_FUZZY_OPERATOR", "<%")
+SIMILARITY_THRESHOLD = float(os.getenv("SEARCH_SIMILARITY_THRESHOLD", FUZZY_MODES[FUZZY_OPERATOR][3]))
+SIMILARITY_WEIGHT = 0.8
+
+# Upper bound on rows per search, whatever the caller asks for
+MAX_SEARCH_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "100"))
+# Matches are counted up to COUNT_CAP; a broader search reports COUNT_CAP + 1 ("more than COUNT_CAP")
+COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", "1000"))
+
+# "postgres" searches the view directly, "memory" uses the in-process BM25 index (bm25.py),
+# "hybrid" fuses the Postgres hits with semantic nearest neighbours (embeddings.py)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "postgres")
+
+# Near-duplicate clusters (dedup.py, sql/006_near_duplicates.sql). With collapsing, each
+# cluster shows up once, as its best-ranked matching item, with the number of similar items.
+# Off by default; without the table, searches fall back to showing every item
+NEAR_DUPLICATES_TABLE = "sourceview.near_duplicates"
+COLLAPSE_DUPLICATES = os.getenv("SEARCH_COLLAPSE_DUPLICATES", "0") not in ("0", "false", "False")
+
+# Reciprocal rank fusion: score = sum of 1 / (RRF_K + rank) over the fused rankings
+RRF_K = 60
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "100"))
+
+# The result list only needs the header of each hit; the rest is fetched by id
+# when a result is opened (fetch_details)
+LIST_COLUMNS = ("id", "municipality", "date", "subject_title")
+DETAIL_COLUMNS = (
+    "id", "summary", "tags", "content_url", "category", "search_sentences",
+    "decided_or_not", "future_action", "description", "amount",
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Whether NEAR_DUPLICATES_TABLE exists; None until looked up, and again after every refresh
+_collapse_lock = threading.Lock()
+_collapse_state = {"available": None}
+
+
+def collapse_available():
+    """
+    Whether near-duplicate collapsing can run, i.e. sql/006_near_duplicates.sql
+    has been applied. Looked up once and again after each refresh, so the
+    migration takes effect without a restart.
+    """
+    with _collapse_lock:
+        if _collapse_state["available"] is not None:
+            return _collapse_state["available"]
+    with db_cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL AS available", [NEAR_DUPLICATES_TABLE])
+        available = cur.fetchone()["available"]
+    if not available:
+        logger.warning("%s does not exist (sql/006_near_duplicates.sql); searching without collapsing",
+                       NEAR_DUPLICATES_TABLE)
+    with _collapse_lock:
+        _collapse_state["available"] = available
+    return available
+
+
+def _recheck_collapse(generation):
+    with _collapse_lock:
+        _collapse_state["available"] = None
+
+
+refresh.on_refresh(_recheck_collapse)
+
+
+def count_is_capped(total_count):
+    """Whether a total from search() stopped at COUNT_CAP, i.e. there are more matches than COUNT_CAP"""
+    return total_count is not None and total_count > COUNT_CAP
+
+
+def clamp_limit(limit):
+    """Keep the requested number of results within 1..MAX_SEARCH_LIMIT"""
+    return max(1, min(int(limit), MAX_SEARCH_LIMIT))
+
+
+def build_match_filters(query_text="", municipality=None, start_date=None, end_date=None,
+                        threshold=SIMILARITY_THRESHOLD, fuzzy_operator=FUZZY_OPERATOR):
+    """
+    WHERE conditions besides the text match (excluded words, municipality,
+    date range) and the parameters of the whole search; shared by both arms
+    of build_match_source. The query text goes through tsquery.parse_query,
+    so operators and stray characters typed by the user never reach
+    to_tsquery unescaped.
+    Returns (filters, params).
+    """
+    parsed = parse_query(query_text)
+    params = {
+        "query_text": query_text,
+        "match_query": parsed.match,
+        "prefix_query": parsed.prefix,
+        "threshold_setting": FUZZY_MODES[fuzzy_operator][2],
+        "threshold": str(threshold),
+    }
+
+    filters = []
+    if parsed.exclude:
+        filters.append("NOT search_vector @@ to_tsquery('danish', %(exclude_query)s)")
+        params["exclude_query"] = parsed.exclude
+    if municipality and municipality != "Alle":
+        filters.append("municipality = %(municipality)s")
+        params["municipality"] = municipality
+
+    # meeting_date is the date column cast once per refresh (sql/004_meeting_date.sql),
+    # so these compare the indexed column directly
+    if start_date:
+        filters.append("meeting_date >= %(start_date)s")
+        params["start_date"] = start_date
+
+    if end_date:
+        filters.append("meeting_date <= %(end_date)s")
+        params["end_date"] = end_date
+
+    return filters, params
+
+
+KEYWORD_MATCH_SQL = """(
+                    search_vector @@ to_tsquery('danish', %(match_query)s)
+                    OR search_vector @@ to_tsquery('danish', %(prefix_query)s)
+                )"""
+
+
+def build_match_source(query_text="", municipality=None, start_date=None, end_date=None, columns=LIST_COLUMNS,
+                       scored=True, threshold=SIMILARITY_THRESHOLD, fuzzy_operator=FUZZY_OPERATOR):
+    """
+    The matching rows of the view as a subquery for a FROM clause; shared by
+    the result, count, facet and export queries.
+
+    Keyword matches come from @@ on the search_vector GIN index and are
+    ranked by ts_rank. Only when there are none does the fuzzy arm run (% or
+    <% on the search_text trigram index, for misspelled words); otherwise its
+    NOT EXISTS is a One-Time Filter and the trigram index is never scanned.
+    Running both arms, the fuzzy one matched and scored nearly every row of
+    the view: similarity() over the long search texts was most of the time
+    of a search. With `scored` the rows carry ts_rank_score and
+    similarity_score.
+    Returns (sql, params).
+    """
+    filters, params = build_match_filters(query_text, municipality, start_date, end_date, threshold,
+                                          fuzzy_operator)
+    match_sql, score_sql = FUZZY_MODES[fuzzy_operator][:2]
+    other_filters = "".join(f"\n                AND {condition}" for condition in filters)
+    keyword_columns = fuzzy_columns = ", ".join(columns)
+    if scored:
+        # Ranked against the prefix query as well, so rows matching only a word* prefix still get a score
+        keyword_columns += (", COALESCE(ts_rank(search_vector, to_tsquery('danish', %(match_query)s)"
+                            " || to_tsquery('danish', %(prefix_query)s)), 0) AS ts_rank_score,"
+                            " 0::real AS similarity_score")
+        fuzzy_columns += f", 0::real AS ts_rank_score, COALESCE({score_sql}, 0) AS similarity_score"
+
+    query = f"""(
+            SELECT {keyword_columns}
+            FROM {VIEW_NAME}
+            WHERE {KEYWORD_MATCH_SQL}{other_filters}
+            UNION ALL
+            SELECT {fuzzy_columns}
+            FROM {VIEW_NAME}
+            WHERE {match_sql}{other_filters}
+                AND NOT EXISTS (
+                    SELECT 1
+                    FROM {VIEW_NAME}
+                    WHERE {KEYWORD_MATCH_SQL}{other_filters}
+                )
+        )"""
+    return query, params
+
+
+def capped_count_sql(source, collapse=False):
+    """
+    COUNT of the rows of a build_match_source subquery that stops reading
+    after COUNT_CAP + 1 of them (the count_limit parameter), so a broad search
+    is not counted to the end; near-duplicate clusters with `collapse`.
+    """
+    if collapse:
+        return f"""
+            SELECT COUNT(*) AS total_count
+            FROM (
+                SELECT DISTINCT COALESCE(nd.cluster_id, hits.id)
+                FROM {source} hits
+                LEFT JOIN {NEAR_DUPLICATES_TABLE} nd ON nd.id = hits.id
+                LIMIT %(count_limit)s
+            ) capped"""
+    return f"""
+            SELECT COUNT(*) AS total_count
+            FROM (SELECT 1 FROM {source} hits LIMIT %(count_limit)s) capped"""
+
+
+# The trigram threshold is set transaction-locally in the same round trip as each query
+SET_THRESHOLD_SQL = "SELECT set_config(%(threshold_setting)s, %(threshold)s, true);"
+
+
+def build_search_query(query_text="", municipality=None, start_date=None, end_date=None, limit=20,
+                       with_count=True, after=None, threshold=SIMILARITY_THRESHOLD,
+                       fuzzy_operator=FUZZY_OPERATOR, with_settings=True, collapse=False):
+    """
+    Build the single search statement for one page of results.
+
+    Scores are computed for the matching rows only and the total, capped at
+    COUNT_CAP + 1, comes from a subquery that runs once (see capped_count_sql). Pages use keyset pagination on (score DESC, id): `after` is
+    the (score, id) of the last row on the previous page. Without
+    `with_settings` the set_config prefix is left out (for prepared statements).
+    With `collapse` only the best-ranked match of each near-duplicate cluster
+    is returned, with its cluster_id and similar_count (the other matches).
+    Returns (sql, params).
+    """
+    source, params = build_match_source(query_text, municipality, start_date, end_date, threshold=threshold,
+                                        fuzzy_operator=fuzzy_operator)
+    params.update({"weight": SIMILARITY_WEIGHT, "limit": clamp_limit(limit), "count_limit": COUNT_CAP + 1})
+
+    keyset = ""
+    if after is not None:
+        params["after_score"], params["after_id"] = after
+        keyset = "WHERE score < %(after_score)s OR (score = %(after_score)s AND id > %(after_id)s)"
+
+    total_count_sql = "NULL::bigint"
+    if with_count:
+        count_source, _ = build_match_source(query_text, municipality, start_date, end_date, columns=("id",),
+                                             scored=False, threshold=threshold, fuzzy_operator=fuzzy_operator)
+        total_count_sql = f"({capped_count_sql(count_source, collapse)})"
+    columns = ", ".join(LIST_COLUMNS)
+
+    # Rows not clustered yet are their own cluster
+    cluster_sql = f""",
+        collapsed AS (
+            SELECT *
+            FROM (
+                SELECT
+                    {columns}, ts_rank_score, similarity_score, score, cluster_id,
+                    COUNT(*) OVER (PARTITION BY cluster_id) - 1 AS similar_count,
+                    row_number() OVER (PARTITION BY cluster_id ORDER BY score DESC, id) AS cluster_rank
+                FROM (
+                    SELECT matches.*, COALESCE(nd.cluster_id, matches.id) AS cluster_id
+                    FROM matches
+                    LEFT JOIN {NEAR_DUPLICATES_TABLE} nd ON nd.id = matches.id
+                ) clustered
+            ) ranked
+            WHERE cluster_rank = 1
+        )""" if collapse else ""
+    cluster_columns = ", cluster_id, similar_count" if collapse else ""
+
+    query = f"""
+        {SET_THRESHOLD_SQL if with_settings else ""}
+
+        WITH matches AS (
+            SELECT
+                {columns}, ts_rank_score, similarity_score,
+                ts_rank_score + similarity_score * %(weight)s AS score
+            FROM {source} matched
+        ){cluster_sql}
+        SELECT {columns}, ts_rank_score, similarity_score, score{cluster_columns}, {total_count_sql} AS total_count
+        FROM {"collapsed" if collapse else "matches"}
+        {keyset}
+        ORDER BY score DESC, id
+        LIMIT %(limit)s
+    """
+    return query, params
+
+
+def build_count_query(query_text="", municipality=None, start_date=None, end_date=None, collapse=False,
+                      **kwargs):
+    """
+    Number of matching rows (or near-duplicate clusters with `collapse`),
+    without scoring them; capped at COUNT_CAP + 1
+    """
+    source, params = build_match_source(query_text, municipality, start_date, end_date, columns=("id",),
+                                        scored=False, **kwargs)
+    params["count_limit"] = COUNT_CAP + 1
+    query = f"""
+        {SET_THRESHOLD_SQL}
+        {capped_count_sql(source, collapse)}
+    """
+    return query, params
+
+
+def build_facet_query(query_text="", municipality=None, start_date=None, end_date=None, **kwargs):
+    """Hit counts per municipality and per category for the matching rows, in one scan"""
+    source, params = build_match_source(query_text, municipality, start_date, end_date,
+                                        columns=("municipality", "category"), scored=False, **kwargs)
+    query = f"""
+        {SET_THRESHOLD_SQL}
+
+        SELECT
+            CASE WHEN GROUPING(municipality) = 0 THEN 'municipality' ELSE 'category' END AS facet,
+            COALESCE(CASE WHEN GROUPING(municipality) = 0 THEN municipality ELSE category END, '') AS value,
+            COUNT(*) AS count
+        FROM {source} matches
+        GROUP BY GROUPING SETS ((municipality), (category))
+        ORDER BY facet, count DESC
+    """
+    return query, params
+
+
+def search(query_text="", municipality=None, start_date=None, end_date=None, limit=20, with_count=True,
+           after=None, use_cache=True, backend=None, timeout_ms=None, collapse=None):
+    """
+    Run the search and return (rows, total_count) for one page.
+    total_count is None when `with_count` is False. The next page starts
+    after=(rows[-1]["score"], rows[-1]["id"]). `timeout_ms` sets a
+    statement_timeout for the Postgres query. `collapse` (default
+    SEARCH_COLLAPSE_DUPLICATES) shows one item per near-duplicate cluster;
+    only the Postgres backend collapses.
+
+    Results are served from the process-wide cache when the same normalized
+    search has been run against the current view generation.
+    """
+    backend = backend or SEARCH_BACKEND
+    limit = clamp_limit(limit)
+    collapse = COLLAPSE_DUPLICATES if collapse is None else collapse
+    collapse = collapse and backend == "postgres" and collapse_available()
+    key = search_key(query_text, municipality, start_date, end_date, limit, with_count, after, backend, collapse)
+    generation, _ = refresh.current_generation()
+    if use_cache:
+        cached = search_cache.get(key, generation)
+        if cached is not None:
+            return cached
+
+    if backend == "memory":
+        import bm25
+
+        result = bm25.get_engine().search(query_text, municipality, start_date, end_date, limit, with_count, after)
+    elif backend == "hybrid":
+        result = search_hybrid(query_text, municipality, start_date, end_date, limit, with_count, after)
+    else:
+        result = search_postgres(query_text, municipality, start_date, end_date, limit, with_count, after,
+                                 timeout_ms, collapse)
+
+    if use_cache:
+        search_cache.put(key, result, generation)
+    return result
+
+
+def search_postgres(query_text="", municipality=None, start_date=None, end_date=None, limit=20, with_count=True,
+                    after=None, timeout_ms=None, collapse=False):
+    """
+    One page of results from the view, in a single round trip. The search
+    statement is prepared once per pooled connection (db.execute_prepared),
+    so repeated searches skip parsing and planning.
+    """
+    query, params = build_search_query(query_text, municipality, start_date, end_date, limit, with_count, after,
+                                       with_settings=False, collapse=collapse)
+    setup = SET_THRESHOLD_SQL
+    if timeout_ms:
+        setup = "SELECT set_config('statement_timeout', %(timeout_ms)s, true);" + setup
+        params["timeout_ms"] = str(timeout_ms)
+    try:
+        with db_cursor() as cur:
+            execute_prepared(cur, query, params, setup)
+            # LIMIT is in the SQL; fetchmany keeps the client side bounded as well
+            rows = cur.fetchmany(clamp_limit(limit))
+    except psycopg2.errors.UndefinedTable:
+        if not collapse:
+            raise
+        # The near-duplicate table was dropped since collapse_available() looked
+        logger.warning("%s is gone; searching without collapsing", NEAR_DUPLICATES_TABLE)
+        with _collapse_lock:
+            _collapse_state["available"] = False
+        return search_postgres(query_text, municipality, start_date, end_date, limit, with_count, after,
+                               timeout_ms, collapse=False)
+
+    total_count = rows[0]["total_count"] if rows else 0
+    for row in rows:
+        row.pop("total_count", None)
+    return rows, (total_count if with_count else None)
+
+
+def reciprocal_rank_fusion(*rankings, k=RRF_K):
+    """Fuse ranked id lists into {id: score}, where each list contributes 1 / (k + rank)"""
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return fused
+
+
+def search_hybrid(query_text="", municipality=None, start_date=None, end_date=None, limit=20, with_count=True,
+                  after=None):
+    """
+    Keyword hits (ts_rank/similarity) and semantic nearest neighbours fused with
+    reciprocal rank fusion, so synonyms without a shared word are found as well.
+    Both rankings are cut at HYBRID_CANDIDATES; pages are taken from the fused list.
+    """
+    import embeddings
+
+    lexical_rows, lexical_total = search_postgres(query_text, municipality, start_date, end_date,
+                                                  HYBRID_CANDIDATES, with_count)
+    vector_ids, vector_scores = embeddings.vector_search(query_text, HYBRID_CANDIDATES)
+
+    # The vector hits still have to pass the filters and need their list columns
+    rows_by_id = {row["id"]: row for row in lexical_rows}
+    missing = [doc_id for doc_id in vector_ids.tolist() if doc_id not in rows_by_id]
+    if missing:
+        filters = ["id = ANY(%(ids)s)"]
+        params = {"ids": missing}
+        if municipality and municipality != "Alle":
+            filters.append("municipality = %(municipality)s")
+            params["municipality"] = municipality
+        if start_date:
+            filters.append("meeting_date >= %(start_date)s")
+            params["start_date"] = start_date
+        if end_date:
+            filters.append("meeting_date <= %(end_date)s")
+            params["end_date"] = end_date
+        with db_cursor() as cur:
+            cur.execute(f"SELECT {', '.join(LIST_COLUMNS)} FROM {VIEW_NAME} WHERE {' AND '.join(filters)}", params)
+            for row in cur.fetchall():
+                rows_by_id[row["id"]] = dict(row, ts_rank_score=0.0, similarity_score=0.0)
+
+    vector_score_by_id = dict(zip(vector_ids.tolist(), vector_scores.tolist()))
+    vector_ranking = [doc_id for doc_id in vector_ids.tolist() if doc_id in rows_by_id]
+    fused = reciprocal_rank_fusion([row["id"] for row in lexical_rows], vector_ranking)
+
+    ranked = sorted(fused.items(), key=lambda item: (-item[1], item[0]))
+    if after is not None:
+        after_score, after_id = after
+        ranked = [(doc_id, score) for doc_id, score in ranked
+                  if score < after_score or (score == after_score and doc_id > after_id)]
+
+    rows = [
+        dict(rows_by_id[doc_id], vector_score=vector_score_by_id.get(doc_id, 0.0), score=score)
+        for doc_id, score in ranked[:clamp_limit(limit)]
+    ]
+    vector_only = sum(1 for doc_id in vector_ranking if doc_id not in {row["id"] for row in lexical_rows})
+    total_count = lexical_total + vector_only if with_count else None
+    return rows, total_count
+
+
+def fetch_details(ids):
+    """
+    Fetch the full detail columns for the given result ids.
+    Returns {id: row}; rows already fetched for this view generation come from the cache.
+    """
+    generation, _ = refresh.current_generation()
+    details = {}
+    missing = []
+    for doc_id in ids:
+        cached = detail_cache.get(doc_id, generation)
+        if cached is not None:
+            details[doc_id] = cached
+        else:
+            missing.append(doc_id)
+
+    if missing:
+        with db_cursor() as cur:
+            cur.execute(
+                f"SELECT {', '.join(DETAIL_COLUMNS)} FROM {VIEW_NAME} WHERE id = ANY(%s)",
+                [missing]
+            )
+            for row in cur.fetchall():
+                details[row["id"]] = row
+                detail_cache.put(row["id"], row, generation)
+    return details
+
+
+def fetch_similar(cluster_id, exclude_id, query_text="", municipality=None, start_date=None, end_date=None,
+                  limit=50):
+    """
+    Result headers of the other matching items in a near-duplicate cluster,
+    newest first: the "similar" items behind a collapsed search result
+    """
+    source, params = build_match_source(query_text, municipality, start_date, end_date,
+                                        columns=LIST_COLUMNS + ("meeting_date",), scored=False)
+    params.update({"cluster_id": cluster_id, "exclude_id": exclude_id, "limit": limit})
+    columns = ", ".join(f"v.{column}" for column in LIST_COLUMNS)
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            {SET_THRESHOLD_SQL}
+
+            SELECT {columns}
+            FROM {source} v
+            JOIN {NEAR_DUPLICATES_TABLE} nd ON nd.id = v.id
+            WHERE nd.cluster_id = %(cluster_id)s AND v.id <> %(exclude_id)s
+            ORDER BY v.meeting_date DESC, v.id
+            LIMIT %(limit)s
+            """,
+            params
+        )
+        return cur.fetchall()
+
+
+def explain_search(query_text, analyze=False, **kwargs):
+    """Return the EXPLAIN plan (as JSON) of the search statement"""
+    return _explain(query_text, analyze, **kwargs)["Plan"]
+
+
+def _explain(query_text, analyze=False, **kwargs):
+    query, params = build_search_query(query_text, with_settings=False, **kwargs)
+    options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+    with db_cursor() as cur:
+        cur.execute(SET_THRESHOLD_SQL, params)
+        cur.execute(f"EXPLAIN ({options}) {query}", params)
+        return cur.fetchone()["QUERY PLAN"][0]
+
+
+def benchmark_prepared(queries, repeat=20, **kwargs):
+    """
+    Per query: planning and execution time from EXPLAIN ANALYZE, and the median
+    wall time (ms) of the search sent as plain SQL versus as a prepared statement.
+    """
+    results = {}
+    for query_text in queries:
+        explained = _explain(query_text, analyze=True, **kwargs)
+        query, params = build_search_query(query_text, with_settings=False, **kwargs)
+        timings = {"plain_ms": [], "prepared_ms": []}
+        with db_cursor() as cur:
+            for _ in range(repeat):
+                for mode, samples in timings.items():
+                    started = time.perf_counter()
+                    if mode == "plain_ms":
+                        cur.execute(SET_THRESHOLD_SQL + query, params)
+                    else:
+                        execute_prepared(cur, query, params, SET_THRESHOLD_SQL)
+                    cur.fetchall()
+                    samples.append((time.perf_counter() - started) * 1000)
+                    cur.connection.rollback()
+        results[query_text] = {
+            "planning_ms": explained["Planning Time"],
+            "execution_ms": explained["Execution Time"],
+            **{mode: statistics.median(samples) for mode, samples in timings.items()},
+        }
+    return results
+
+
+def index_scans(plan):
+    """Names of the indexes used anywhere in an EXPLAIN (FORMAT JSON) plan"""
+    names = set()
+    if "Index Name" in plan:
+        names.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        names |= index_scans(child)
+    return names
@@ -0,0 +1,233 @@
+"""
+Øjebliksbillede (snapshot) af søge-view'et som et partitioneret Parquet-datasæt.
+
+Efter hver opdatering af view'et skrives de kolonner, analyserne bruger, til
+SNAPSHOT_DIR/generation-<N>/municipality=<kommune>/year=<år>/*.parquet.
+Fanen "Populære emner" og kommunelisten læses herfra (memory-mappet, med
+kun de nødvendige kolonner), så de virker uden database ved opstart og
+ikke belaster Postgres. Kun når snapshottet er forældet, spørges databasen.
+
+Første snapshot (eller et nyt uden at opdatere view'et):
+    python snapshot.py write
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import psycopg2
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from pyarrow import fs
+
+import refresh
+from db import get_pool
+from export import record_batches
+
+# =====================
+# Snapshot Settings
+# =====================
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshot")
+# Without a known view generation (e.g. database unavailable) a snapshot is used up to this age (s)
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "86400"))
+SNAPSHOT_ITERSIZE = 10000
+SNAPSHOT_KEEP = 2  # generations kept on disk, so readers of the previous one are not cut off
+CURRENT_FILE = "current.json"
+
+# Only the columns the analytics use; the search itself stays on Postgres
+SNAPSHOT_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("municipality", pa.string()),
+    ("year", pa.int32()),
+    ("meeting_date", pa.date32()),
+    ("category", pa.string()),
+    ("subject_title", pa.string()),
+    ("decided_or_not", pa.bool_()),
+    ("amount", pa.string()),
+])
+PARTITIONING = ds.partitioning(
+    pa.schema([("municipality", pa.string()), ("year", pa.int32())]), flavor="hive"
+)
+
+logger = logging.getLogger(__name__)
+
+_write_lock = threading.Lock()
+_open_lock = threading.Lock()
+_open = {"path": None, "dataset": None, "meta": None}
+
+
+def _snapshot_rows():
+    """Stream the snapshot columns from the view with a server-side cursor"""
+    query = f"""
+        SELECT
+            id, municipality, EXTRACT(YEAR FROM meeting_date)::int AS year, meeting_date,
+            category, subject_title, decided_or_not, amount
+        FROM {refresh.VIEW_NAME}
+    """
+    with get_pool().connection() as conn:
+        with conn.cursor(name="view_snapshot", cursor_factory=psycopg2.extensions.cursor) as cur:
+            cur.itersize = SNAPSHOT_ITERSIZE
+            cur.execute(query)
+            yield from cur
+
+
+def write_snapshot(generation=None):
+    """
+    Write a new snapshot for `generation` and make it current. The dataset is
+    written to a temporary directory first and published with an atomic
+    replace of current.json, so readers never see a half-written snapshot.
+    Registered as a refresh callback; returns the snapshot directory.
+    """
+    if generation is None:
+        generation, _ = refresh.load_generation()
+    with _write_lock:
+        name = f"generation-{generation}"
+        final_path = os.path.join(SNAPSHOT_DIR, name)
+        tmp_path = final_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+        started = time.monotonic()
+        rows = _snapshot_rows()
+        try:
+            ds.write_dataset(
+                record_batches(rows, batch_rows=SNAPSHOT_ITERSIZE, schema=SNAPSHOT_SCHEMA),
+                tmp_path,
+                schema=SNAPSHOT_SCHEMA,
+                format="parquet",
+                partitioning=PARTITIONING,
+                max_partitions=8192,
+                existing_data_behavior="overwrite_or_ignore",
+            )
+        finally:
+            rows.close()
+
+        shutil.rmtree(final_path, ignore_errors=True)
+        os.replace(tmp_path, final_path)
+        meta = {
+            "generation": generation,
+            "path": name,
+            "written_at": datetime.now(timezone.utc).isoformat(),
+        }
+        current_tmp = os.path.join(SNAPSHOT_DIR, CURRENT_FILE + ".tmp")
+        with open(current_tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(current_tmp, os.path.join(SNAPSHOT_DIR, CURRENT_FILE))
+        _remove_old_generations(name)
+
+    logger.info("Wrote snapshot %s in %.1f s", final_path, time.monotonic() - started)
+    return final_path
+
+
+refresh.on_refresh(write_snapshot)
+
+
+def _remove_old_generations(current_name):
+    """Keep the newest SNAPSHOT_KEEP generation directories"""
+    generations = []
+    for entry in os.listdir(SNAPSHOT_DIR):
+        if entry.startswith("generation-") and entry != current_name:
+            path = os.path.join(SNAPSHOT_DIR, entry)
+            generations.append((os.path.getmtime(path), path))
+    for _, path in sorted(generations, reverse=True)[SNAPSHOT_KEEP - 1:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def read_meta():
+    """Metadata of the current snapshot, or None if there is none"""
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, CURRENT_FILE)) as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    meta["written_at"] = datetime.fromisoformat(meta["written_at"])
+    return meta
+
+
+def is_fresh(meta, generation=None):
+    """
+    A snapshot is fresh when it belongs to the current view generation. When
+    the generation is not known yet (no database contact so far), its age is
+    used instead.
+    """
+    if meta is None:
+        return False
+    if generation is not None:
+        return meta["generation"] == generation
+    age = (datetime.now(timezone.utc) - meta["written_at"]).total_seconds()
+    return age <= SNAPSHOT_MAX_AGE
+
+
+def open_snapshot(generation=None, allow_stale=False):
+    """
+    The current snapshot as a pyarrow Dataset over memory-mapped Parquet
+    files, or None when there is no snapshot or it is stale (unless
+    `allow_stale` is set). Opened datasets are shared within the process.
+    """
+    meta = read_meta()
+    if meta is None or not (allow_stale or is_fresh(meta, generation)):
+        return None
+    path = os.path.join(SNAPSHOT_DIR, meta["path"])
+    with _open_lock:
+        if _open["path"] != path:
+            try:
+                dataset = ds.dataset(path, schema=SNAPSHOT_SCHEMA, format="parquet", partitioning=PARTITIONING,
+                                     filesystem=fs.LocalFileSystem(use_mmap=True))
+            except (FileNotFoundError, pa.ArrowInvalid):
+                logger.warning("Snapshot %s could not be opened", path)
+                return None
+            _open.update(path=path, dataset=dataset, meta=meta)
+        return _open["dataset"]
+
+
+# =====================
+# Analytics from the snapshot
+# =====================
+def category_rollup(dataset, municipality=None):
+    """(municipality, category, count) for categorised items, read with column projection"""
+    filter_expr = ds.field("category").is_valid()
+    if municipality is not None:
+        # Partition column, so only that municipality's files are read
+        filter_expr = filter_expr & (ds.field("municipality") == municipality)
+    table = dataset.to_table(columns=["municipality", "category"], filter=filter_expr)
+    counts = table.group_by(["municipality", "category"]).aggregate([([], "count_all")])
+    df = counts.select(["municipality", "category", "count_all"]).rename_columns(
+        ["municipality", "category", "count"]).to_pandas()
+    df["count"] = df["count"].astype("int64")
+    return df
+
+
+def category_trends(dataset):
+    """(municipality, category, month, count), the same shape as sourceview.category_trends"""
+    filter_expr = ds.field("category").is_valid() & ds.field("meeting_date").is_valid()
+    table = dataset.to_table(columns=["municipality", "category", "meeting_date"], filter=filter_expr)
+    table = table.append_column("month", pc.floor_temporal(table["meeting_date"], unit="month"))
+    counts = table.group_by(["municipality", "category", "month"]).aggregate([([], "count_all")])
+    df = counts.select(["municipality", "category", "month", "count_all"]).rename_columns(
+        ["municipality", "category", "month", "count"]).to_pandas()
+    df["month"] = pd.to_datetime(df["month"])
+    df["count"] = df["count"].astype("int64")
+    return df
+
+
+def municipalities(dataset):
+    """All municipalities in the snapshot, from the partition directories without reading any file"""
+    names = {ds.get_partition_keys(fragment.partition_expression).get("municipality")
+             for fragment in dataset.get_fragments()}
+    return sorted(name for name in names if name is not None)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("write", help="write a snapshot of the current view generation")
+    args = parser.parse_args()
+
+    print(write_snapshot())
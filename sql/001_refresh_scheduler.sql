@@ -0,0 +1,18 @@
+-- Baggrundsopdatering af sourceview.foraisearch_with_search (se refresh.py)
+
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY kræver et unikt indeks på view'et
+CREATE UNIQUE INDEX IF NOT EXISTS foraisearch_with_search_id_uidx
+    ON sourceview.foraisearch_with_search (id);
+
+-- Én række pr. gennemført opdatering; generation bruges af UI og caches
+CREATE TABLE IF NOT EXISTS sourceview.view_refresh_log (
+    generation         bigserial PRIMARY KEY,
+    view_name          text        NOT NULL,
+    started_at         timestamptz NOT NULL,
+    refreshed_at       timestamptz NOT NULL DEFAULT clock_timestamp(),
+    duration_ms        integer,
+    source_fingerprint bigint
+);
+
+CREATE INDEX IF NOT EXISTS view_refresh_log_view_generation_idx
+    ON sourceview.view_refresh_log (view_name, generation DESC);
@@ -0,0 +1,66 @@
+-- Forudberegnet søgetekst + trigram- og tsvector-indeks til søgningen i search.py
+--
+-- Materialized view'et genskabes med en ekstra kolonne search_text, så similarity()
+-- og trigram-operatorerne (%, <%) ikke skal bygge teksten op for hver række ved
+-- hver søgning. Den eksisterende definition genbruges via pg_get_viewdef.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+DO $$
+DECLARE
+    view_def text;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM pg_attribute
+        WHERE attrelid = 'sourceview.foraisearch_with_search'::regclass
+          AND attname = 'search_text'
+          AND NOT attisdropped
+    ) THEN
+        view_def := rtrim(pg_get_viewdef('sourceview.foraisearch_with_search'::regclass, true), E'; \n');
+
+        EXECUTE 'DROP MATERIALIZED VIEW sourceview.foraisearch_with_search';
+        EXECUTE format($view$
+            CREATE MATERIALIZED VIEW sourceview.foraisearch_with_search AS
+            SELECT
+                base.*,
+                (((((((((COALESCE(base.municipality, '')::text || ' ') ||
+                COALESCE(base.title, '')::text) || ' ') ||
+                COALESCE(base.category, '')::text) || ' ') ||
+                COALESCE(base.description, '')::text) || ' ') ||
+                COALESCE(base.future_action, '')::text) || ' ') ||
+                COALESCE(base.subject_title, '')::text AS search_text
+            FROM (%s) base
+        $view$, view_def);
+    END IF;
+END
+$$;
+
+-- Indekser der forsvinder når view'et genskabes (se 001_refresh_scheduler.sql)
+CREATE UNIQUE INDEX IF NOT EXISTS foraisearch_with_search_id_uidx
+    ON sourceview.foraisearch_with_search (id);
+
+-- Fuld-tekst: search_vector @@ plainto_tsquery/to_tsquery
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_vector_gin
+    ON sourceview.foraisearch_with_search USING gin (search_vector);
+
+-- Trigram: search_text % query og query <% search_text
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_text_trgm_gin
+    ON sourceview.foraisearch_with_search USING gin (search_text gin_trgm_ops);
+
+ANALYZE sourceview.foraisearch_with_search;
+
+-- Kontrol: planen skal vise Bitmap Index Scan på de to GIN-indekser, ikke Seq Scan.
+-- Det samme tjek kan køres fra Python med search.explain_search() / search.index_scans().
+-- Søgningen bruger kun trigram-indekset, når ordsøgningen ikke finder noget (stavefejl).
+--
+-- SET pg_trgm.word_similarity_threshold = 0.6;
+-- EXPLAIN
+-- SELECT id
+-- FROM sourceview.foraisearch_with_search
+-- WHERE search_vector @@ plainto_tsquery('danish', 'fjernvarme')
+--    OR search_vector @@ to_tsquery('danish', 'fjernvarme:*');
+-- EXPLAIN
+-- SELECT id
+-- FROM sourceview.foraisearch_with_search
+-- WHERE 'fjernvarne' <% search_text;
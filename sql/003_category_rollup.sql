@@ -0,0 +1,18 @@
+-- Rollup af (kommune, kategori, antal) til fanen "Populære emner" (se rollup.py)
+--
+-- Opdateres af rollup.refresh_category_rollup() efter hver opdatering af
+-- sourceview.foraisearch_with_search. Alle andre optællinger i fanen afledes af
+-- denne ene tabel i pandas.
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS sourceview.category_rollup AS
+SELECT
+    municipality,
+    category,
+    COUNT(*) AS count
+FROM sourceview.foraisearch_with_search
+WHERE category IS NOT NULL
+GROUP BY municipality, category;
+
+-- Påkrævet for REFRESH MATERIALIZED VIEW CONCURRENTLY
+CREATE UNIQUE INDEX IF NOT EXISTS category_rollup_municipality_category_uidx
+    ON sourceview.category_rollup (municipality, category);
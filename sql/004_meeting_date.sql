@@ -0,0 +1,72 @@
+-- Datofiltrering i søgningen (se search.py)
+--
+-- Kolonnen date castes én gang ved opdatering af view'et til meeting_date (date),
+-- så søgningens datofiltre kan sammenligne direkte på kolonnen og bruge indeks.
+-- View'et sorteres efter (meeting_date, municipality), så rækkerne ligger samlet
+-- på disken efter dato og kommune, hvilket gør BRIN-indekset effektivt.
+
+-- category_rollup afhænger af view'et og genskabes nederst
+DROP MATERIALIZED VIEW IF EXISTS sourceview.category_rollup;
+
+DO $$
+DECLARE
+    view_def text;
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1
+        FROM pg_attribute
+        WHERE attrelid = 'sourceview.foraisearch_with_search'::regclass
+          AND attname = 'meeting_date'
+          AND NOT attisdropped
+    ) THEN
+        view_def := rtrim(pg_get_viewdef('sourceview.foraisearch_with_search'::regclass, true), E'; \n');
+
+        EXECUTE 'DROP MATERIALIZED VIEW sourceview.foraisearch_with_search';
+        EXECUTE format($view$
+            CREATE MATERIALIZED VIEW sourceview.foraisearch_with_search AS
+            SELECT
+                base.*,
+                base.date::date AS meeting_date
+            FROM (%s) base
+            ORDER BY meeting_date, base.municipality
+        $view$, view_def);
+    END IF;
+END
+$$;
+
+-- Indekser der forsvinder når view'et genskabes (se 001 og 002)
+CREATE UNIQUE INDEX IF NOT EXISTS foraisearch_with_search_id_uidx
+    ON sourceview.foraisearch_with_search (id);
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_vector_gin
+    ON sourceview.foraisearch_with_search USING gin (search_vector);
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_text_trgm_gin
+    ON sourceview.foraisearch_with_search USING gin (search_text gin_trgm_ops);
+
+-- Smalle søgninger i én kommune og en periode
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_municipality_date_idx
+    ON sourceview.foraisearch_with_search (municipality, meeting_date);
+
+-- Brede periodesøgninger på tværs af kommuner; lille indeks da data ligger sorteret efter dato
+CREATE INDEX IF NOT EXISTS foraisearch_with_search_date_brin
+    ON sourceview.foraisearch_with_search USING brin (meeting_date);
+
+-- category_rollup som i 003_category_rollup.sql
+CREATE MATERIALIZED VIEW IF NOT EXISTS sourceview.category_rollup AS
+SELECT
+    municipality,
+    category,
+    COUNT(*) AS count
+FROM sourceview.foraisearch_with_search
+WHERE category IS NOT NULL
+GROUP BY municipality, category;
+
+CREATE UNIQUE INDEX IF NOT EXISTS category_rollup_municipality_category_uidx
+    ON sourceview.category_rollup (municipality, category);
+
+ANALYZE sourceview.foraisearch_with_search;
+
+-- REFRESH ... CONCURRENTLY tilføjer nye rækker bagerst og bevarer ikke sorteringen.
+-- Hvis BRIN-indekset mister effekt over tid, skriver en almindelig (ikke-concurrent)
+-- opdatering rækkerne i view'ets sorteringsorden igen; kør den uden for spidsbelastning:
+--
+-- REFRESH MATERIALIZED VIEW sourceview.foraisearch_with_search;
@@ -0,0 +1,30 @@
+-- Udvikling over tid: antal pr. (kommune, kategori, måned) til fanen "Populære emner" (se rollup.py)
+--
+-- En almindelig tabel i stedet for et materialized view, så den kan opdateres trinvist:
+-- rollup.refresh_category_trends() lægger kun rækker med id over vandmærket
+-- (rollup_watermark.last_id) til, i stedet for at gruppere hele view'et hver gang.
+-- De seneste måneder tælles forfra ved hver opdatering og alle måneder med faste
+-- mellemrum (rækken category_trends_full), så ændrede og slettede punkter trækkes fra.
+
+CREATE TABLE IF NOT EXISTS sourceview.category_trends (
+    municipality text    NOT NULL,
+    category     text    NOT NULL,
+    month        date    NOT NULL,
+    count        bigint  NOT NULL,
+    PRIMARY KEY (municipality, category, month)
+);
+
+-- Alle kommuner over en periode; én kommune bruger primærnøglen
+CREATE INDEX IF NOT EXISTS category_trends_month_idx
+    ON sourceview.category_trends (month);
+
+-- Højeste id i view'et, der er talt med i hver trinvist opdateret rollup
+CREATE TABLE IF NOT EXISTS sourceview.rollup_watermark (
+    rollup_name text        PRIMARY KEY,
+    last_id     bigint      NOT NULL DEFAULT 0,
+    updated_at  timestamptz NOT NULL DEFAULT now()
+);
+
+INSERT INTO sourceview.rollup_watermark (rollup_name)
+VALUES ('category_trends')
+ON CONFLICT (rollup_name) DO NOTHING;
@@ -0,0 +1,25 @@
+-- Næsten ens mødepunkter (fx faste budgetopfølgninger og takstpunkter), se dedup.py
+--
+-- dedup.py beregner en MinHash-signatur pr. række i sourceview.foraisearch_with_search og
+-- grupperer rækker med næsten samme tekst i en klynge. Kun rækker der ikke står her endnu
+-- behandles, så jobbet kan køres efter hver opdatering af view'et.
+
+-- Én række pr. behandlet mødepunkt; cluster_id er det mindste id i klyngen (eget id hvis alene)
+CREATE TABLE IF NOT EXISTS sourceview.near_duplicates (
+    id           bigint      PRIMARY KEY,
+    cluster_id   bigint      NOT NULL,
+    signature    integer[]   NOT NULL,
+    processed_at timestamptz NOT NULL DEFAULT now()
+);
+
+-- Sammenlægning af klynger og "vis lignende" i søgningen
+CREATE INDEX IF NOT EXISTS near_duplicates_cluster_idx
+    ON sourceview.near_duplicates (cluster_id);
+
+-- LSH: signaturen delt i bånd; rækker med samme bucket i et bånd er kandidater til at være ens
+CREATE TABLE IF NOT EXISTS sourceview.minhash_buckets (
+    band   smallint NOT NULL,
+    bucket bigint   NOT NULL,
+    id     bigint   NOT NULL,
+    PRIMARY KEY (band, bucket, id)
+);
@@ -0,0 +1,40 @@
+-- Gemte søgninger med besked om nye mødepunkter (se alerts.py)
+--
+-- Efter hver opdatering af view'et matcher alerts.evaluate_new_rows() kun de rækker, der er
+-- kommet til siden sidst (id over vandmærket i rollup_watermark), mod alle gemte søgninger på én
+-- gang. Søgningerne står i et indeks over deres ord, så hver ny række kun tjekkes mod de søgninger,
+-- den kan matche, i stedet for at køre hver søgning mod view'et.
+
+CREATE TABLE IF NOT EXISTS sourceview.saved_searches (
+    id            bigserial   PRIMARY KEY,
+    owner         text        NOT NULL,
+    query_text    text        NOT NULL,
+    municipality  text,                   -- NULL: alle kommuner
+    match_query   tsquery     NOT NULL,   -- søgefeltets tekst efter tsquery.parse_query og to_tsquery
+    exclude_query tsquery,                -- -ord / NOT ord
+    anchors       text[],                 -- ord hvoraf mindst ét skal forekomme; NULL: tjekkes mod alt
+    created_at    timestamptz NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS saved_searches_owner_idx
+    ON sourceview.saved_searches (owner);
+
+-- Ét match pr. (søgning, mødepunkt); seen sættes, når brugeren har set det i appen
+CREATE TABLE IF NOT EXISTS sourceview.saved_search_matches (
+    saved_search_id bigint      NOT NULL REFERENCES sourceview.saved_searches (id) ON DELETE CASCADE,
+    item_id         bigint      NOT NULL,
+    matched_at      timestamptz NOT NULL DEFAULT now(),
+    seen            boolean     NOT NULL DEFAULT false,
+    PRIMARY KEY (saved_search_id, item_id)
+);
+
+CREATE INDEX IF NOT EXISTS saved_search_matches_unseen_idx
+    ON sourceview.saved_search_matches (saved_search_id)
+    WHERE NOT seen;
+
+-- Start ved view'ets nuværende højeste id, så eksisterende rækker ikke giver besked
+-- (rollup_watermark oprettes i 005_category_trends.sql)
+INSERT INTO sourceview.rollup_watermark (rollup_name, last_id)
+SELECT 'saved_search_alerts', COALESCE(MAX(id), 0)
+FROM sourceview.foraisearch_with_search
+ON CONFLICT (rollup_name) DO NOTHING;
@@ -1,2 +1,6 @@
 #!binbash
+# Bytecode, snapshot og Postgres' buffere varmes op, før serverne starter; serverne varmer
+# selv deres egne caches op (se warmup.py)
+python warmup.py
+python api.py serve --port="${API_PORT:-8001}" &
 streamlit run app.py --server.port=8000 --server.address=0.0.0.0
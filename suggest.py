@@ -0,0 +1,170 @@
+import bisect
+import logging
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import refresh
+from db import db_cursor
+from search import VIEW_NAME
+
+# =====================
+# Suggestion Settings
+# =====================
+SUGGEST_MIN_LENGTH = int(os.getenv("SUGGEST_MIN_LENGTH", "3"))  # korteste ord der foreslås
+SUGGEST_MIN_DOCS = int(os.getenv("SUGGEST_MIN_DOCS", "2"))  # ord skal forekomme i mindst så mange dokumenter
+SUGGEST_MAX_TERMS = int(os.getenv("SUGGEST_MAX_TERMS", "500000"))
+SUGGEST_RETRY_INTERVAL = float(os.getenv("SUGGEST_RETRY_INTERVAL", "60"))  # sekunder før et fejlet byg prøves igen
+
+logger = logging.getLogger(__name__)
+
+
+class PrefixIndex:
+    """
+    Sorted array of corpus words with their document frequency. All words
+    starting with a prefix form one contiguous slice, found with two bisects;
+    the most frequent ones in that slice are the suggestions.
+    """
+
+    def __init__(self, terms, doc_freqs, generation=None):
+        order = sorted(range(len(terms)), key=terms.__getitem__)
+        self.terms = [terms[i] for i in order]
+        self.doc_freqs = np.asarray(doc_freqs, dtype=np.int32)[order]
+        self.generation = generation
+
+    def suggest(self, prefix, k=5):
+        """Up to k (word, document frequency) for words starting with prefix, most frequent first"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        lo = bisect.bisect_left(self.terms, prefix)
+        hi = bisect.bisect_left(self.terms, prefix + "\uffff", lo)
+        if lo == hi:
+            return []
+        freqs = self.doc_freqs[lo:hi]
+        if hi - lo > k:
+            top = np.argpartition(-freqs, k)[:k]
+        else:
+            top = np.arange(hi - lo)
+        top = top[np.argsort(-freqs[top], kind="stable")]
+        return [(self.terms[lo + i], int(freqs[i])) for i in top]
+
+    def nbytes(self):
+        """Approximate memory held by the index"""
+        return (sys.getsizeof(self.terms) + sum(sys.getsizeof(term) for term in self.terms)
+                + self.doc_freqs.nbytes)
+
+
+def build_index(generation=None):
+    """
+    Build the prefix index from the words of the current view. ts_stat over a
+    'simple' tsvector gives the unstemmed words, so suggestions read like the
+    text and still match the search's prefix query (word:*).
+    """
+    started = time.monotonic()
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT word, ndoc
+            FROM ts_stat($$SELECT to_tsvector('simple', search_text) FROM {VIEW_NAME}$$)
+            WHERE length(word) >= %s AND ndoc >= %s AND word !~ '^[0-9.,-]+$'
+            ORDER BY ndoc DESC
+            LIMIT %s
+            """,
+            [SUGGEST_MIN_LENGTH, SUGGEST_MIN_DOCS, SUGGEST_MAX_TERMS]
+        )
+        rows = cur.fetchall()
+    index = PrefixIndex([row["word"] for row in rows], [row["ndoc"] for row in rows], generation)
+    logger.info("Built suggestion index for generation %s: %d words, %.1f MB in %.1fs",
+                generation, len(index.terms), index.nbytes() / 1e6, time.monotonic() - started)
+    return index
+
+
+class Suggester:
+    """
+    Process-wide owner of the current PrefixIndex. The index is built in the
+    background, the first time on demand and again when the view generation
+    changes, like the BM25 index in bm25.py; until the first build has
+    finished there are no suggestions rather than a blocked keystroke.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._build_lock = threading.Lock()
+        self._failed_at = None
+
+    def _rebuild(self, generation):
+        try:
+            self._index = build_index(generation)
+            self._failed_at = None
+        except Exception:
+            self._failed_at = time.monotonic()
+            logger.exception("Building the suggestion index failed")
+        finally:
+            self._build_lock.release()
+
+    def index(self):
+        """
+        Current index, or None before the first build. Starts a background
+        build when there is none for the current generation; after a failed
+        build, not again for SUGGEST_RETRY_INTERVAL seconds.
+        """
+        generation, _ = refresh.current_generation()
+        index = self._index
+        failed_at = self._failed_at
+        if ((index is None or index.generation != generation)
+                and (failed_at is None or time.monotonic() - failed_at >= SUGGEST_RETRY_INTERVAL)
+                and self._build_lock.acquire(blocking=False)):
+            threading.Thread(target=self._rebuild, args=(generation,), name="suggest-rebuild", daemon=True).start()
+        return index
+
+    def build(self):
+        """Build the index for the current generation in this thread (warm-up); waits for a running build"""
+        generation, _ = refresh.current_generation()
+        with self._build_lock:
+            if self._index is None or self._index.generation != generation:
+                self._index = build_index(generation)
+                self._failed_at = None
+        return self._index
+
+    def suggest(self, prefix, k=5):
+        """Suggestions from the current index; [] while the first one is being built"""
+        index = self.index()
+        return index.suggest(prefix, k) if index is not None else []
+
+    def stats(self):
+        """Size of the current index, or None before the first build"""
+        index = self._index
+        if index is None:
+            return None
+        return {"generation": index.generation, "terms": len(index.terms), "bytes": index.nbytes()}
+
+
+_suggester = None
+_suggester_lock = threading.Lock()
+
+
+def get_suggester():
+    """Return the process-wide suggester"""
+    global _suggester
+    if _suggester is None:
+        with _suggester_lock:
+            if _suggester is None:
+                _suggester = Suggester()
+    return _suggester
+
+
+def benchmark(index, prefixes, repeat=1000):
+    """Median and worst lookup time in microseconds per prefix"""
+    results = {}
+    for prefix in prefixes:
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            index.suggest(prefix)
+            timings.append((time.perf_counter() - started) * 1e6)
+        results[prefix] = (float(np.median(timings)), max(timings))
+    return results
@@ -0,0 +1,127 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Database tests build their own corpus, so they never run against the database in DB_NAME
+os.environ["DB_NAME"] = os.getenv("TEST_DB_NAME", "kommunedata_test")
+
+# =====================
+# Fixed corpus
+# =====================
+# (municipality, meeting date, category, subject_title, description)
+CORPUS = [
+    ("København", date(2024, 1, 15), "Økonomi", "Budget 2025 for skoleområdet",
+     "Forvaltningen fremlægger budget for folkeskoler og skolefritidsordninger med besparelser på vikarer."),
+    ("København", date(2024, 2, 12), "Økonomi", "Budgetopfølgning for første kvartal",
+     "Status på budget og forbrug i alle udvalg, herunder merforbrug på ældreområdet."),
+    ("København", date(2024, 3, 4), "Børn og unge", "Ny skole i Nordhavn",
+     "Byggeriet af en ny skole med plads til tre spor og en idrætshal skal i udbud."),
+    ("København", date(2024, 4, 22), "Teknik og miljø", "Lokalplan for Valby Maskinfabrik",
+     "Forslag til lokalplan med boliger, erhverv og en ny plads ved stationen."),
+    ("Aarhus", date(2024, 1, 29), "Teknik og miljø", "Fjernvarme til Skæring og Egå",
+     "Udbygning af fjernvarmenettet, så villaer med oliefyr kan skifte til fjernvarme."),
+    ("Aarhus", date(2024, 3, 18), "Økonomi", "Budget for fjernvarme og forsyning",
+     "Takster for fjernvarme og vand i det kommende budgetår."),
+    ("Aarhus", date(2024, 5, 6), "Social og sundhed", "Hjemmehjælp om aftenen",
+     "Ændring af visitationen til hjemmehjælp og praktisk hjælp for borgere over 80 år."),
+    ("Aarhus", date(2024, 6, 10), "Social og sundhed", "Ældreboliger i Viby",
+     "Opførelse af 40 ældreboliger med fælleshus og plejecenter i nærheden."),
+    ("Odense", date(2024, 2, 5), "Børn og unge", "Skolestruktur og sammenlægning af skoler",
+     "Høring om sammenlægning af to skoler og ny skolestruktur i den sydlige bydel."),
+    ("Odense", date(2024, 4, 8), "Teknik og miljø", "Lokalplan for boliger ved havnen",
+     "Lokalplanforslag for etageboliger, parkering og grønne arealer ved havnen."),
+    ("Odense", date(2024, 6, 24), "Økonomi", "Budget for anlæg af cykelstier",
+     "Anlægsbudget for nye cykelstier langs indfaldsvejene og bedre belysning."),
+    ("Odense", date(2024, 8, 19), "Social og sundhed", "Ældrepleje og plejehjem",
+     "Kvalitetsstandard for ældrepleje, plejehjem og madservice til ældre borgere."),
+    ("Aalborg", date(2024, 1, 8), "Teknik og miljø", "Fjernvarmeværk skifter til varmepumper",
+     "Fjernvarmeværket ønsker at erstatte naturgas med store varmepumper."),
+    ("Aalborg", date(2024, 3, 11), "Kultur og fritid", "Tilskud til idrætsforeninger",
+     "Fordeling af tilskud til foreninger, haller og baner i kommunen."),
+    ("Aalborg", date(2024, 5, 13), "Børn og unge", "Dagtilbud og normeringer",
+     "Minimumsnormeringer i dagtilbud og vuggestuer samt ansættelse af pædagoger."),
+    ("Aalborg", date(2024, 9, 2), "Økonomi", "Budget 2025 andenbehandling",
+     "Andenbehandling af budget med ændringsforslag om skoler og ældrepleje."),
+    ("Esbjerg", date(2024, 2, 19), "Teknik og miljø", "Klimatilpasning og kystbeskyttelse",
+     "Projekt om kystbeskyttelse, diger og regnvandsbassiner mod oversvømmelse."),
+    ("Esbjerg", date(2024, 4, 15), "Social og sundhed", "Hjemmehjælp og rehabilitering",
+     "Rehabiliteringsforløb før hjemmehjælp, så flere ældre klarer sig selv."),
+    ("Esbjerg", date(2024, 7, 1), "Børn og unge", "Renovering af skole i Ribe",
+     "Renovering af skolens faglokaler, ventilation og skolegård."),
+    ("Esbjerg", date(2024, 10, 7), "Teknik og miljø", "Lokalplan for vindmøller",
+     "Lokalplan og miljørapport for fire vindmøller ved motorvejen."),
+    ("Vejle", date(2024, 1, 22), "Kultur og fritid", "Ny svømmehal",
+     "Placering og budget for en ny svømmehal med varmtvandsbassin."),
+    ("Vejle", date(2024, 3, 25), "Teknik og miljø", "Fjernvarme i landsbyerne",
+     "Undersøgelse af fjernvarme eller varmepumper til landsbyer uden fjernvarmenet."),
+    ("Vejle", date(2024, 6, 3), "Social og sundhed", "Ældreboliger og plejeboliger",
+     "Behov for ældreboliger og plejeboliger frem mod 2035."),
+    ("Vejle", date(2024, 11, 11), "Økonomi", "Budget og takster for affald",
+     "Takster for affaldsindsamling og genbrugspladser i budgettet."),
+]
+
+
+def corpus_rows():
+    """CORPUS as rows of benchmark.SYNTHETIC_TABLE"""
+    rows = []
+    for row_id, (municipality, meeting_date, category, subject_title, description) in enumerate(CORPUS, start=1):
+        rows.append((
+            row_id, municipality, meeting_date, f"Dagsordenspunkt {row_id}", subject_title,
+            description.split(",")[0], description, "", subject_title.lower(),
+            [category.lower()], category, row_id % 3 != 0, None,
+            f"https://example.invalid/referat/{row_id}.pdf",
+        ))
+    return rows
+
+
+def _create_database():
+    """Create the test database if the server is reachable and it does not exist yet"""
+    import psycopg2
+
+    import db
+
+    connection = psycopg2.connect(dbname="postgres", user=db.DB_USER, password=db.DB_PASSWORD,
+                                  host=db.DB_HOST, port=db.DB_PORT, connect_timeout=3)
+    try:
+        connection.autocommit = True
+        with connection.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", [db.DB_NAME])
+            if cur.fetchone() is None:
+                cur.execute(f'CREATE DATABASE "{db.DB_NAME}"')
+    finally:
+        connection.close()
+
+
+@pytest.fixture(scope="session")
+def database():
+    """
+    The test database with CORPUS behind the search view, built the same way
+    as the benchmark corpus (benchmark.create_synthetic_table / build_view).
+    Skips the test when no PostgreSQL server is reachable.
+    """
+    import psycopg2
+    from psycopg2.extras import execute_values
+
+    import benchmark
+    import refresh
+    from db import db_cursor
+
+    try:
+        _create_database()
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no PostgreSQL test database: {str(e).strip()}")
+
+    with db_cursor(commit=True) as cur:
+        benchmark.check_benchmark_database(cur)
+        benchmark.create_synthetic_table(cur, reset=True)
+        execute_values(cur, f"INSERT INTO {benchmark.SYNTHETIC_TABLE} VALUES %s", corpus_rows())
+        cur.connection.commit()
+        benchmark.build_view(cur, verbose=False)
+    refresh.refresh_view(force=True)
+    return CORPUS
+
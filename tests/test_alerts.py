@@ -0,0 +1,37 @@
+import pytest
+
+import alerts
+from db import db_cursor
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+OWNER = "test-alerts@example.invalid"
+
+
+@pytest.fixture
+def saved_search():
+    saved_search_id = alerts.save_search(OWNER, "budget")
+    yield saved_search_id
+    alerts.delete_search(OWNER, saved_search_id)
+
+
+def test_mark_seen_only_marks_the_matches_that_were_shown(saved_search):
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"INSERT INTO {alerts.MATCHES_TABLE} (saved_search_id, item_id) VALUES (%s, 1), (%s, 2)",
+                    [saved_search, saved_search])
+    shown = [(match["saved_search_id"], match["id"]) for match in alerts.unseen_matches(OWNER)
+             if match["id"] == 1]
+
+    # Item 2 arrived after the page was rendered, so it was not shown
+    alerts.mark_seen(OWNER, shown)
+
+    assert [match["id"] for match in alerts.unseen_matches(OWNER)] == [2]
+    alerts.mark_seen(OWNER, [])
+    assert len(alerts.unseen_matches(OWNER)) == 1
+
+
+def test_mark_seen_ignores_other_owners_matches(saved_search):
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"INSERT INTO {alerts.MATCHES_TABLE} (saved_search_id, item_id) VALUES (%s, 3)", [saved_search])
+    alerts.mark_seen("someone-else@example.invalid", [(saved_search, 3)])
+    assert [match["id"] for match in alerts.unseen_matches(OWNER)] == [3]
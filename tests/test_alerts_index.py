@@ -0,0 +1,138 @@
+import random
+
+import pytest
+
+import alerts
+
+WORDS = ["budget", "skole", "takst", "fjernvarme", "lokalplan", "havn", "bolig", "vej"]
+MUNICIPALITIES = [None, "Aarhus", "Odense"]
+
+
+@pytest.mark.parametrize("tsquery_text, expected", [
+    ("'budget'", {"budget"}),
+    ("'budget' & 'skole'", {"budget"}),
+    ("'lokalplan' & 'vej':*", {"lokalplan"}),
+    ("'budget' | 'skole'", {"budget", "skole"}),
+    ("( 'a' | 'b' ) & 'c'", {"c"}),
+    ("( 'a' | 'b' ) & ( 'c' | 'd' | 'e' )", {"a", "b"}),
+    ("( 'a' | 'b' ) & 'c':*", {"c:*"}),
+    ("'budget' & !'takst'", {"budget"}),
+    ("!'takst' & ( 'skole' | 'havn' )", {"skole", "havn"}),
+    ("'fjernvarm' <-> 'pris'", {"fjernvarm"}),
+    ("'ny' <2> 'bolig' & 'havn'", {"bolig"}),
+    ("( 'ny' <-> 'skole' ) | 'budget'", {"skole", "budget"}),
+    ("'o''brien'", {"o'brien"}),
+])
+def test_anchors(tsquery_text, expected):
+    assert alerts.anchors(tsquery_text) == expected
+
+
+@pytest.mark.parametrize("tsquery_text", [
+    "!'takst'",
+    "!( 'takst' | 'skole' )",
+    "!'takst' & !'skole'",
+    "'budget' | !'takst'",
+    "",
+])
+def test_query_that_matches_without_any_word_has_no_anchors(tsquery_text):
+    assert alerts.anchors(tsquery_text) is None
+
+
+def test_unanchored_search_is_a_candidate_for_every_row():
+    index = alerts.SavedSearchIndex([
+        {"id": 1, "municipality": None, "anchors": alerts.anchors("!'takst'")},
+        {"id": 2, "municipality": "Aarhus", "anchors": alerts.anchors("!'takst' & !'skole'")},
+        {"id": 3, "municipality": None, "anchors": alerts.anchors("'budget'")},
+    ])
+    for lexemes in ([], ["takst"], ["budget", "skole"], ["vej"]):
+        assert 1 in index.candidates(lexemes, "Odense")
+        assert sorted(index.candidates(lexemes, "Aarhus"))[:2] == [1, 2]
+
+
+def test_prefix_anchor_matches_longer_lexemes_only():
+    index = alerts.SavedSearchIndex([{"id": 1, "municipality": None, "anchors": frozenset(["fjern:*"])}])
+    assert index.candidates(["fjernvarm"]) == [1]
+    assert index.candidates(["fjern"]) == [1]
+    assert index.candidates(["fjer", "varm"]) == []
+
+
+def matches(tsquery_text, lexemes):
+    """
+    Whether a row with these lexemes matches the tsquery text. Positions are not
+    known, so a phrase matches like AND, which accepts every row the phrase does
+    (as long as no phrase is negated)
+    """
+    tokens = [(match.group(0), match) for match in alerts.TSQUERY_TOKEN_RE.finditer(tsquery_text)]
+    position = 0
+
+    def peek():
+        return tokens[position][0] if position < len(tokens) else None
+
+    def unary():
+        nonlocal position
+        token, match = tokens[position]
+        position += 1
+        if token == "!":
+            return not unary()
+        if token == "(":
+            result = disjunction()
+            position += 1
+            return result
+        word = match.group(1).replace("''", "'")
+        if "*" in (match.group(2) or ""):
+            return any(lexeme.startswith(word) for lexeme in lexemes)
+        return word in lexemes
+
+    def binary(operand, is_operator, combine):
+        nonlocal position
+        result = operand()
+        while peek() is not None and is_operator(peek()):
+            position += 1
+            result = combine(result, operand())
+        return result
+
+    def phrase():
+        return binary(unary, lambda token: token.startswith("<"), lambda a, b: a and b)
+
+    def intersection():
+        return binary(phrase, lambda token: token == "&", lambda a, b: a and b)
+
+    def disjunction():
+        return binary(intersection, lambda token: token == "|", lambda a, b: a or b)
+
+    return disjunction()
+
+
+def random_tsquery(rng, depth=0, negated=False):
+    """A tsquery in the text form to_tsquery returns, with OR groups, negations, prefixes and phrases"""
+    shape = rng.random() if depth < 3 else 0
+    if shape < 0.4:
+        return f"'{rng.choice(WORDS)}'" + (":*" if rng.random() < 0.2 else "")
+    if shape < 0.5:
+        return "!" + random_tsquery(rng, depth + 1, negated=True)
+    if shape < 0.6 and not negated:
+        return f"'{rng.choice(WORDS)}' <-> '{rng.choice(WORDS)}'"
+    operator = rng.choice(["&", "|"])
+    sides = [random_tsquery(rng, depth + 1, negated) for _ in range(rng.randint(2, 3))]
+    return "( " + f" {operator} ".join(sides) + " )"
+
+
+def test_candidates_never_miss_a_matching_saved_search():
+    rng = random.Random(7)
+    saved = [(random_tsquery(rng), rng.choice(MUNICIPALITIES)) for _ in range(500)]
+    index = alerts.SavedSearchIndex([
+        {"id": saved_id, "municipality": municipality, "anchors": alerts.anchors(tsquery_text)}
+        for saved_id, (tsquery_text, municipality) in enumerate(saved)
+    ])
+    pruned = 0
+    for _ in range(300):
+        # Stems and longer forms, so prefixes match words they are not equal to
+        lexemes = {rng.choice(WORDS) + rng.choice(["", "", "er", "s"]) for _ in range(rng.randint(0, 4))}
+        municipality = rng.choice(MUNICIPALITIES[1:])
+        candidates = set(index.candidates(lexemes, municipality))
+        for saved_id, (tsquery_text, saved_municipality) in enumerate(saved):
+            if saved_municipality in (None, municipality) and matches(tsquery_text, lexemes):
+                assert saved_id in candidates, (tsquery_text, sorted(lexemes))
+        pruned += len(saved) - len(candidates)
+    # ... while still leaving most searches out
+    assert pruned > 300 * len(saved) / 2
@@ -0,0 +1,133 @@
+import gzip
+import json
+import tempfile
+from datetime import date
+from urllib.parse import urlencode
+from unittest import mock
+
+import pytest
+
+tornado_testing = pytest.importorskip("tornado.testing")
+
+import api  # noqa: E402
+import export  # noqa: E402
+import search  # noqa: E402
+
+
+def fake_search(query_text="", municipality=None, start_date=None, end_date=None, limit=20, with_count=True,
+                after=None, collapse=None):
+    """search.search without a database: `limit` rows for any query, 500 in total"""
+    if query_text == "fejl":
+        raise ValueError("Invalid query")
+    rows = [{"id": i, "score": 1.0 / i, "title": f"{query_text} punkt {i}", "date": date(2024, 1, i % 28 + 1),
+             "municipality": municipality or "Aarhus"} for i in range(1, limit + 1)]
+    return rows, 500 if with_count else None
+
+
+class ApiTestCase(tornado_testing.AsyncHTTPTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(search, "search", side_effect=fake_search)
+        self.search = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_app(self):
+        return api.make_app()
+
+    def fetch_json(self, path, **kwargs):
+        response = self.fetch(path, **kwargs)
+        return response, json.loads(response.body)
+
+
+class SearchHandlerTest(ApiTestCase):
+    def test_search_returns_rows_count_and_next_cursor(self):
+        response, body = self.fetch_json("/search?q=budget&municipality=Odense&limit=5&start_date=2024-01-01")
+        self.assertEqual(response.code, 200)
+        self.assertEqual([row["id"] for row in body["results"]], [1, 2, 3, 4, 5])
+        self.assertEqual(body["results"][0]["date"], "2024-01-02")
+        self.assertEqual(body["total_count"], 500)
+        self.assertIsNotNone(body["next_cursor"])
+        args = self.search.call_args.kwargs
+        self.assertEqual((args["municipality"], args["start_date"]), ("Odense", date(2024, 1, 1)))
+
+    def test_cursor_fetches_the_next_page_without_counting(self):
+        _, first = self.fetch_json("/search?q=budget&limit=5")
+        _, second = self.fetch_json(f"/search?q=budget&limit=5&cursor={first['next_cursor']}")
+        self.assertIsNone(second["total_count"])
+        self.assertEqual(self.search.call_args.kwargs["after"], (0.2, 5))
+
+    def test_bad_parameters_are_a_client_error(self):
+        for path in ("/search?q=budget&start_date=01-01-2024", "/search?q=budget&cursor=xyz", "/search?q=fejl"):
+            response, body = self.fetch_json(path)
+            self.assertEqual(response.code, 400, path)
+            self.assertIn("Invalid", body["error"])
+
+
+class BatchSearchHandlerTest(ApiTestCase):
+    def post_batch(self, body, **kwargs):
+        return self.fetch_json("/search/batch", method="POST", body=json.dumps(body), **kwargs)
+
+    def test_batch_answers_each_search_in_order(self):
+        response, body = self.post_batch({"queries": [{"q": "budget"}, {"q": "fejl"}, {"q": "skole", "limit": 2}]})
+        self.assertEqual(response.code, 200)
+        first, failed, last = body["responses"]
+        self.assertEqual(len(first["results"]), 20)
+        self.assertEqual(failed, {"error": "Invalid query"})
+        self.assertEqual([row["title"] for row in last["results"]], ["skole punkt 1", "skole punkt 2"])
+
+    def test_malformed_or_oversized_batch_is_rejected(self):
+        for body in ({"searches": []}, {"queries": {"q": "budget"}},
+                     {"queries": [{"q": "budget"}] * (api.API_MAX_BATCH + 1)}):
+            response, _ = self.post_batch(body)
+            self.assertEqual(response.code, 400, body)
+        self.search.assert_not_called()
+
+    def test_token_is_required_when_set(self):
+        with mock.patch.object(api, "API_TOKEN", "hemmelig"):
+            response, body = self.post_batch({"queries": [{"q": "budget"}]})
+            self.assertEqual(response.code, 401)
+            self.assertEqual(body["error"], "Missing or invalid API token")
+            response, _ = self.post_batch({"queries": [{"q": "budget"}]}, headers={"Authorization": "Bearer forkert"})
+            self.assertEqual(response.code, 401)
+            response, _ = self.post_batch({"queries": [{"q": "budget"}]},
+                                          headers={"Authorization": "Bearer hemmelig"})
+            self.assertEqual(response.code, 200)
+            # Single searches stay open
+            response, _ = self.fetch_json("/search?q=budget")
+            self.assertEqual(response.code, 200)
+
+    def test_export_requires_the_token_or_a_signed_link(self):
+        def small_export(fmt="csv", **search_args):
+            export_file = tempfile.TemporaryFile()
+            export_file.write(b"id\n1\n")
+            export_file.seek(0)
+            return export_file, 1
+
+        params = {"q": "budget", "format": "csv"}
+        with mock.patch.object(api, "API_TOKEN", "hemmelig"), \
+                mock.patch.object(export, "export_to_tempfile", small_export):
+            self.assertEqual(self.fetch("/export?q=budget&format=csv").code, 401)
+
+            signed = export.sign_export_params(params, "hemmelig")
+            response = self.fetch(f"/export?{urlencode(signed)}")
+            self.assertEqual((response.code, response.body), (200, b"id\n1\n"))
+
+            # Another search, another token or an old link does not pass
+            for link in (dict(signed, q="skole"), export.sign_export_params(params, "forkert"),
+                         export.sign_export_params(params, "hemmelig", ttl=-1)):
+                self.assertEqual(self.fetch(f"/export?{urlencode(link)}").code, 403)
+
+
+class CompressionTest(ApiTestCase):
+    def test_json_responses_are_gzipped_when_the_client_accepts_it(self):
+        response = self.fetch("/search?q=budget&limit=50", headers={"Accept-Encoding": "gzip"},
+                              decompress_response=False)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        body = json.loads(gzip.decompress(response.body))
+        self.assertEqual(len(body["results"]), 50)
+        self.assertLess(len(response.body), len(json.dumps(body)))
+
+    def test_plain_response_without_accept_encoding(self):
+        response = self.fetch("/search?q=budget&limit=50", decompress_response=False)
+        self.assertNotIn("Content-Encoding", response.headers)
+        self.assertEqual(len(json.loads(response.body)["results"]), 50)
@@ -0,0 +1,86 @@
+from datetime import date
+
+import pytest
+
+bm25 = pytest.importorskip("bm25")
+
+import search  # noqa: E402
+
+PARITY_QUERIES = ["budget", "fjernvarme", "skole", "lokalplan", "ældreboliger", "hjemmehjælp", "budget skole",
+                  "fjernvarme OR varmepumper", "lokalplan -vindmøller", "budg*"]
+PARITY_K = 5
+MIN_OVERLAP = 0.6
+
+
+def make_index(documents):
+    """BM25Index over (municipality, subject_title, search_text) tuples, without a database"""
+    vocabulary, terms, headers, doc_terms = {}, [], [], []
+    for doc_id, (municipality, subject_title, text) in enumerate(documents, start=1):
+        headers.append({"id": doc_id, "municipality": municipality, "date": "2024-01-01",
+                        "subject_title": subject_title})
+        counts = {}
+        for term in bm25.tokenize(f"{subject_title} {text}"):
+            term_id = vocabulary.setdefault(term, len(vocabulary))
+            if term_id == len(terms):
+                terms.append(term)
+            counts[term_id] = counts.get(term_id, 0) + 1
+        doc_terms.append((bm25.np.array(list(counts), dtype=bm25.np.int32),
+                          bm25.np.array(list(counts.values()), dtype=bm25.np.float32)))
+    return bm25.BM25Index(headers, [date(2024, 1, 1)] * len(documents), doc_terms, terms, generation=1)
+
+
+@pytest.fixture(scope="module")
+def index():
+    return make_index([
+        ("Odense", "Ny skole", "byggeri af en ny skole i bydelen"),
+        ("Odense", "Skolebus", "kørsel med skolebus til skole og hal"),
+        ("Aarhus", "Budget for skole", "budget og skole i samme punkt"),
+        ("Aarhus", "Fjernvarme", "fjernvarme til villaer"),
+        ("Vejle", "Varmepumper", "varmepumper i landsbyer"),
+        ("Vejle", "Ny hal", "en hal ved den nye skole"),
+    ])
+
+
+def ids(rows):
+    return {row["id"] for row in rows}
+
+
+def test_excluded_words_are_removed(index):
+    rows, total_count = index.search("skole -budget")
+    assert 3 not in ids(rows)
+    assert {1, 2, 6} <= ids(rows)
+    assert total_count == len(rows)
+
+
+def test_or_is_an_operator_not_a_word(index):
+    rows, _ = index.search("fjernvarme OR varmepumper")
+    assert ids(rows) == {4, 5}
+
+
+def test_phrase_needs_all_words(index):
+    rows, _ = index.search('"ny skole"')
+    assert ids(rows) == {1, 6}
+
+
+def test_only_excluded_words_match_nothing(index):
+    assert index.search("-skole") == ([], 0)
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+@pytest.mark.parametrize("query_text", PARITY_QUERIES)
+def test_relevance_parity_with_postgres(query_text):
+    """
+    The keyword hits (ts_rank > 0) in the Postgres top-k are found by the
+    in-memory backend as well. Weak fuzzy-only hits may differ: pg_trgm
+    compares the whole text, RapidFuzz single words.
+    """
+    postgres_rows, _ = search.search(query_text, limit=PARITY_K, with_count=False, use_cache=False,
+                                     backend="postgres", collapse=False)
+    memory_rows, _ = search.search(query_text, limit=PARITY_K, with_count=False, use_cache=False,
+                                   backend="memory")
+    keyword_hits = [row for row in postgres_rows if row["ts_rank_score"] > 0]
+    assert keyword_hits, f"no Postgres keyword hits for {query_text!r}"
+    overlap = len(ids(keyword_hits) & ids(memory_rows)) / len(keyword_hits)
+    assert overlap >= MIN_OVERLAP, (query_text, [row["subject_title"] for row in postgres_rows],
+                                    [row["subject_title"] for row in memory_rows])
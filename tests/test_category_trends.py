@@ -0,0 +1,63 @@
+from datetime import date
+
+import pytest
+
+import refresh
+import rollup
+from db import db_cursor
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+
+def trends_table():
+    with db_cursor() as cur:
+        cur.execute(f"SELECT municipality, category, month, count FROM {rollup.CATEGORY_TRENDS_TABLE}")
+        return {(row["municipality"], row["category"], row["month"]): row["count"] for row in cur.fetchall()}
+
+
+def trends_from_view():
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT municipality, category, date_trunc('month', meeting_date)::date AS month, COUNT(*) AS count
+            FROM {refresh.VIEW_NAME}
+            WHERE category IS NOT NULL AND municipality IS NOT NULL AND meeting_date IS NOT NULL
+            GROUP BY 1, 2, 3
+            """
+        )
+        return {(row["municipality"], row["category"], row["month"]): row["count"] for row in cur.fetchall()}
+
+
+@pytest.fixture
+def drifted_trends():
+    """
+    The trends table after an old item changed category and a recent one was
+    deleted: counts the watermark alone would never correct
+    """
+    rollup.refresh_category_trends(rebuild=True)
+    this_month = date.today().replace(day=1)
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"UPDATE {rollup.CATEGORY_TRENDS_TABLE} SET count = count + 1 WHERE month = '2024-01-01'")
+        cur.execute(f"INSERT INTO {rollup.CATEGORY_TRENDS_TABLE} VALUES ('Odense', 'Økonomi', %s, 1)",
+                    [this_month])
+    yield this_month
+    rollup.refresh_category_trends(rebuild=True)
+
+
+def test_rebuild_matches_the_view():
+    rollup.refresh_category_trends(rebuild=True)
+    assert trends_table() == trends_from_view()
+
+
+def test_recent_months_are_recounted_on_every_refresh(drifted_trends):
+    rollup.refresh_category_trends()
+    table = trends_table()
+    assert ("Odense", "Økonomi", drifted_trends) not in table
+    # Older months wait for the full recount
+    assert table != trends_from_view()
+
+
+def test_full_recount_when_due(drifted_trends, monkeypatch):
+    monkeypatch.setattr(rollup, "TRENDS_FULL_INTERVAL", 0)
+    rollup.refresh_category_trends()
+    assert trends_table() == trends_from_view()
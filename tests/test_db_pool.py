@@ -0,0 +1,62 @@
+import threading
+
+import pytest
+
+import db
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+
+@pytest.fixture
+def pool():
+    pool = db.ConnectionPool(minconn=1, maxconn=4, dbname=db.DB_NAME, user=db.DB_USER,
+                             password=db.DB_PASSWORD, host=db.DB_HOST, port=db.DB_PORT)
+    yield pool
+    pool.closeall()
+
+
+def backend_pid(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_backend_pid()")
+        return cur.fetchone()[0]
+
+
+def concurrent_checkouts(pool, count):
+    """Hold `count` connections at once and return their backend pids"""
+    barrier = threading.Barrier(count)
+    pids = []
+
+    def work():
+        with pool.connection() as conn:
+            pids.append(backend_pid(conn))
+            barrier.wait(timeout=5)
+
+    threads = [threading.Thread(target=work) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return set(pids)
+
+
+def test_returned_connections_stay_open_above_minconn(pool):
+    first = concurrent_checkouts(pool, 4)
+    stats = pool.stats()
+    assert (stats["open"], stats["idle"], stats["in_use"]) == (4, 4, 0)
+
+    # A second burst reuses the same backends instead of connecting again
+    assert concurrent_checkouts(pool, 4) == first
+    assert pool.stats()["connects"] == 4
+
+
+def test_connection_closed_elsewhere_is_forgotten(pool):
+    conn = pool.getconn()
+    pool.prepared_statements(conn).add("stmt_test")
+    conn.close()
+    pool.putconn(conn)
+    stats = pool.stats()
+    assert (stats["open"], stats["discarded"]) == (0, 1)
+    assert conn not in pool._prepared
+
+    with pool.connection() as fresh:
+        assert pool.prepared_statements(fresh) == set()
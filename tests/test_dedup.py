@@ -0,0 +1,48 @@
+import dedup
+
+# Recurring items as municipalities write them: the same text with a new date and amount
+BUDGET_FOLLOW_UP = ("Budgetopfølgning for kultur og fritid med status på drift og anlæg samt forventet regnskab "
+                    "for året og forslag til omplaceringer mellem bevillingerne i udvalgets område. "
+                    "Forbruget pr. {date} udgør {amount} mio. kr.")
+RATES = ("Takster for pasning i dagtilbud og skolefritidsordninger for {year} fastsættes efter byrådets "
+         "budgetvedtagelse, og forældrebetalingen for en vuggestueplads bliver {amount} kr. om måneden.")
+LOCAL_PLAN = ("Lokalplan for nyt boligområde ved havnen med op til 120 boliger og et grønt område langs åen "
+              "sendes i offentlig høring i otte uger.")
+
+
+def sig(text):
+    return dedup.signature(dedup.shingles(text))
+
+
+def test_recurring_items_that_differ_in_date_or_amount_are_near_duplicates():
+    pairs = [
+        (BUDGET_FOLLOW_UP.format(date="31. marts 2024", amount="12,3"),
+         BUDGET_FOLLOW_UP.format(date="30. juni 2024", amount="14,1")),
+        (RATES.format(year=2024, amount="3.420"), RATES.format(year=2025, amount="3.515")),
+    ]
+    for text_a, text_b in pairs:
+        sig_a, sig_b = sig(text_a), sig(text_b)
+        assert dedup.similarity(sig_a, sig_b) >= dedup.DEDUP_THRESHOLD
+        # ... and they meet as LSH candidates in the first place
+        assert set(dedup.band_buckets(sig_a)) & set(dedup.band_buckets(sig_b))
+
+
+def test_unrelated_items_are_not_near_duplicates():
+    texts = [BUDGET_FOLLOW_UP.format(date="31. marts 2024", amount="12,3"), RATES.format(year=2024, amount="3.420"),
+             LOCAL_PLAN]
+    for i, text_a in enumerate(texts):
+        for text_b in texts[i + 1:]:
+            assert dedup.similarity(sig(text_a), sig(text_b)) < 0.2
+
+
+def test_shingles_ignore_case_punctuation_and_repeats():
+    plain = dedup.shingles("budget 2024 budget 2024")
+    assert sorted(dedup.shingles("Budget 2024: Budget 2024!").tolist()) == sorted(plain.tolist())
+    assert len(plain) == 2
+    assert len(dedup.shingles("Budget")) == 1
+
+
+def test_text_without_words_has_no_signature():
+    assert dedup.signature(dedup.shingles(" – ")) is None
+    assert sig(LOCAL_PLAN).shape == (dedup.DEDUP_NUM_PERM,)
+    assert dedup.similarity(sig(LOCAL_PLAN), sig(LOCAL_PLAN.upper())) == 1.0
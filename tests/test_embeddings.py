@@ -0,0 +1,109 @@
+import os
+import zlib
+
+import numpy as np
+import pytest
+
+import benchmark
+import embeddings
+import refresh
+from db import db_cursor
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_ivf_finds_most_exact_neighbours_after_reload(tmp_path, dtype):
+    store = embeddings.EmbeddingStore(str(tmp_path))
+    store.meta["dtype"] = dtype
+    store.append(np.arange(3000), embeddings.synthetic_vectors(3000, 64, topics=20, seed=0))
+    store.append(np.arange(3000, 5000), embeddings.synthetic_vectors(2000, 64, topics=20, seed=1))
+
+    store = embeddings.EmbeddingStore(str(tmp_path))
+    assert store.count == 5000 and store.meta["dtype"] == dtype
+    recall = []
+    for query in embeddings.synthetic_vectors(20, 64, topics=20, seed=2):
+        ids, scores = store.nearest(query, k=20, nprobe=8)
+        assert list(scores) == sorted(scores, reverse=True)
+        exact = store.ids[embeddings.exact_nearest(store, query, k=20)]
+        recall.append(len(np.intersect1d(ids, exact)) / len(exact))
+    # Probing 8 of ~70 lists at random would find about 0.11 of them
+    assert np.mean(recall) >= 0.5
+
+
+class FakeEncoder:
+    """Encoder stand-in: a fixed random unit vector per text"""
+    dim = 16
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, texts):
+        self.encoded.extend(texts)
+        return np.array([self.vector(text) for text in texts], dtype=np.float32).reshape(-1, self.dim)
+
+    def vector(self, text):
+        vector = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(self.dim)
+        return vector / np.linalg.norm(vector)
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_update_overwrites_vectors_in_place(tmp_path, dtype):
+    store = embeddings.EmbeddingStore(str(tmp_path))
+    store.meta["dtype"] = dtype
+    vectors = embeddings.synthetic_vectors(500, 32, topics=10, seed=0)
+    store.append(np.arange(100, 600), vectors, hashes=np.arange(500))
+
+    changed = embeddings.synthetic_vectors(2, 32, topics=10, seed=1)
+    store.update([450, 101], changed, generation=7, hashes=[-1, -2])
+
+    store = embeddings.EmbeddingStore(str(tmp_path))
+    assert store.count == 500 and store.meta["generation"] == 7
+    assert list(store.hashes[store.positions([101, 450, 102])]) == [-2, -1, 2]
+    for doc_id, vector in zip([450, 101], changed):
+        ids, scores = store.nearest(vector, k=1, nprobe=len(store.ivf.centroids))
+        assert ids[0] == doc_id and scores[0] > 0.99
+        assert store.ivf.assignments[store.positions([doc_id])[0]] == np.argmax(store.ivf.centroids @ vector)
+
+
+def test_get_store_rereads_the_store_only_after_it_was_written(tmp_path, monkeypatch):
+    writer = embeddings.EmbeddingStore(str(tmp_path))
+    writer.append(np.arange(50), embeddings.synthetic_vectors(50, 8, topics=2, seed=0))
+    monkeypatch.setattr(embeddings, "_store", embeddings.EmbeddingStore(str(tmp_path)))
+    loads = []
+    load = embeddings.EmbeddingStore.load
+    monkeypatch.setattr(embeddings.EmbeddingStore, "load", lambda self: loads.append(1) or load(self))
+
+    for _ in range(3):
+        assert embeddings.get_store().count == 50
+    assert loads == []
+
+    writer.update([7], embeddings.synthetic_vectors(1, 8, topics=2, seed=1), hashes=[1])
+    # Both writes may fall in the same clock tick of the file system
+    loaded_mtime = embeddings._store.meta_mtime
+    os.utime(writer._file("meta.json"), ns=(loaded_mtime, loaded_mtime + 1_000_000_000))
+    assert embeddings.get_store().hashes[7] == 1
+    assert loads == [1]
+
+
+@pytest.mark.db
+def test_embed_new_rows_embeds_changed_text_again(database, tmp_path, monkeypatch):
+    monkeypatch.setattr(refresh, "_callbacks", [])
+    store, encoder = embeddings.EmbeddingStore(str(tmp_path)), FakeEncoder()
+    assert embeddings.embed_new_rows(store, encoder) == len(database)
+    assert embeddings.embed_new_rows(store, encoder) == 0
+
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"SELECT description FROM {benchmark.SYNTHETIC_TABLE} WHERE id = 3")
+        description = cur.fetchone()["description"]
+        cur.execute(f"UPDATE {benchmark.SYNTHETIC_TABLE} SET description = 'Ny tekst om cykelstier' WHERE id = 3")
+    try:
+        refresh.refresh_view(force=True)
+        encoder.encoded = []
+        assert embeddings.embed_new_rows(store, encoder) == 1
+        assert len(encoder.encoded) == 1 and "Ny tekst om cykelstier" in encoder.encoded[0]
+        assert store.count == len(database)
+        ids, scores = store.nearest(encoder.vector(encoder.encoded[0]), k=1, nprobe=len(store.ivf.centroids))
+        assert ids[0] == 3 and scores[0] > 0.99
+    finally:
+        with db_cursor(commit=True) as cur:
+            cur.execute(f"UPDATE {benchmark.SYNTHETIC_TABLE} SET description = %s WHERE id = 3", [description])
+        refresh.refresh_view(force=True)
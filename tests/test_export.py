@@ -0,0 +1,46 @@
+import tempfile
+from unittest import mock
+
+import pytest
+
+tornado_testing = pytest.importorskip("tornado.testing")
+
+import api  # noqa: E402
+import export  # noqa: E402
+
+
+def synthetic_export(fmt="csv", **search_args):
+    """export.export_to_tempfile without a database"""
+    export_file = tempfile.TemporaryFile()
+    row_count = export.write_batches(export.record_batches(export.synthetic_rows(20_000)), export_file, fmt)
+    export_file.seek(0)
+    return export_file, row_count
+
+
+class ExportHandlerTest(tornado_testing.AsyncHTTPTestCase):
+    def get_app(self):
+        return api.make_app()
+
+    def test_streams_the_export_file_in_chunks(self):
+        chunk_sizes = []
+        read_chunks = export.iter_file_chunks
+
+        def small_chunks(export_file):
+            for chunk in read_chunks(export_file, 64 * 1024):
+                chunk_sizes.append(len(chunk))
+                yield chunk
+
+        expected, _ = synthetic_export("csv")
+        with expected, mock.patch.object(export, "export_to_tempfile", synthetic_export), \
+                mock.patch.object(export, "iter_file_chunks", small_chunks):
+            response = self.fetch("/export?q=budget&format=csv")
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.headers["X-Total-Count"], "20000")
+            self.assertIn("attachment", response.headers["Content-Disposition"])
+            self.assertEqual(response.body, expected.read())
+        self.assertGreater(len(chunk_sizes), 1)
+        self.assertLessEqual(max(chunk_sizes), 64 * 1024)
+
+    def test_unknown_format(self):
+        response = self.fetch("/export?q=budget&format=xlsx")
+        self.assertEqual(response.code, 400)
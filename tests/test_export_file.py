@@ -0,0 +1,44 @@
+import os
+import subprocess
+import sys
+
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import pytest
+
+import export
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Peak RSS allowed for exporting EXPORT_RSS_ROWS rows; the interpreter with pyarrow loaded
+# is already around 100 MB, and a file held in memory would be several hundred MB on top
+EXPORT_RSS_ROWS = 1_000_000
+EXPORT_MAX_RSS_MB = 400
+
+
+@pytest.mark.parametrize("fmt", sorted(export.EXPORT_FORMATS))
+def test_export_of_a_million_rows_keeps_peak_rss_flat(fmt):
+    """export.py bench in its own process, so the peak RSS is that of the export alone"""
+    result = subprocess.run(
+        [sys.executable, "export.py", "bench", "--rows", str(EXPORT_RSS_ROWS), "--format", fmt,
+         "--max-rss-mb", str(EXPORT_MAX_RSS_MB)],
+        cwd=ROOT, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
+
+
+@pytest.mark.parametrize("fmt", sorted(export.EXPORT_FORMATS))
+def test_export_file_is_streamed_back_in_bounded_chunks(fmt, tmp_path):
+    rows = list(export.synthetic_rows(2_500))
+    with open(tmp_path / "export", "w+b") as export_file:
+        assert export.write_batches(export.record_batches(iter(rows), batch_rows=1000), export_file, fmt) == 2_500
+        export_file.seek(0)
+        chunks = list(export.iter_file_chunks(export_file, chunk_bytes=16 * 1024))
+    assert len(chunks) > 1
+    assert max(len(chunk) for chunk in chunks) <= 16 * 1024
+
+    (tmp_path / f"copy{export.EXPORT_FORMATS[fmt][0]}").write_bytes(b"".join(chunks))
+    reader = pq.read_table if fmt == "parquet" else pa_csv.read_csv
+    table = reader(tmp_path / f"copy{export.EXPORT_FORMATS[fmt][0]}")
+    assert table.num_rows == 2_500
+    assert table.column("id").to_pylist() == [row[0] for row in rows]
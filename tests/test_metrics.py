@@ -0,0 +1,54 @@
+import threading
+
+import pytest
+
+import db
+import metrics
+
+
+@pytest.mark.parametrize("statement, read_only", [
+    ("SELECT id FROM sourceview.foraisearch_with_search WHERE id = %(id)s", True),
+    ("WITH matches AS (SELECT id FROM t) SELECT * FROM matches", True),
+    ("SELECT last_updated, deleted_at FROM t", True),
+    ("SELECT id FROM t WHERE id = 1 FOR UPDATE", False),
+    ("SELECT id FROM t FOR NO KEY UPDATE SKIP LOCKED", False),
+    ("SELECT id FROM t FOR SHARE", False),
+    ("SELECT pg_advisory_lock(74201001)", False),
+    ("SELECT pg_try_advisory_xact_lock(%s)", False),
+    ("SELECT nextval('sourceview.saved_searches_id_seq')", False),
+    ("WITH gone AS (DELETE FROM t WHERE id = 1 RETURNING id) SELECT count(*) FROM gone", False),
+    ("WITH moved AS (UPDATE t SET x = 1 RETURNING id) SELECT * FROM moved", False),
+    ("INSERT INTO t VALUES (1)", False),
+    ("UPDATE t SET x = 1", False),
+    ("REFRESH MATERIALIZED VIEW sourceview.foraisearch_with_search", False),
+])
+def test_is_read_only(statement, read_only):
+    assert metrics.is_read_only(statement) == read_only
+
+
+def test_prepared_statements_are_judged_by_their_sql():
+    select_name, _, _ = db.prepared_form("SELECT id FROM t WHERE id = %(id)s")
+    insert_name, _, _ = db.prepared_form("WITH x AS (INSERT INTO t VALUES (%(id)s) RETURNING id) SELECT * FROM x")
+    assert metrics.is_read_only(f"EXECUTE {select_name} (1)")
+    assert not metrics.is_read_only(f"EXECUTE {insert_name} (1)")
+    assert not metrics.is_read_only("EXECUTE stmt_unknown (1)")
+
+
+def test_slow_queries_are_not_explained_under_without_explain(monkeypatch):
+    explained = []
+    done = threading.Event()
+
+    def fake_explain(tag, query, params, seconds):
+        explained.append(tag)
+        done.set()
+
+    monkeypatch.setattr(metrics, "_explain", fake_explain)
+    monkeypatch.setattr(metrics, "_last_explain", {})
+    seconds = metrics.SLOW_QUERY_MS / 1000
+    with metrics.without_explain():
+        metrics.record_execute("SELECT 1", None, seconds)
+    with metrics.tagged("after_warm_up"):
+        metrics.record_execute("SELECT 1", None, seconds)
+    assert done.wait(timeout=5)
+    assert explained == ["after_warm_up"]
+    assert metrics.totals()["untagged"]["slow"] >= 1
@@ -0,0 +1,78 @@
+import pytest
+
+import dedup
+import refresh
+import search
+from db import db_cursor
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+
+def ids(rows):
+    return [row["id"] for row in rows]
+
+
+@pytest.fixture
+def missing_table(monkeypatch):
+    """The near-duplicate table as it is before sql/006 has been run"""
+    monkeypatch.setattr(search, "NEAR_DUPLICATES_TABLE", "sourceview.near_duplicates_missing")
+    monkeypatch.setitem(search._collapse_state, "available", None)
+    yield
+    search._collapse_state["available"] = None
+
+
+def test_collapse_without_the_table_searches_every_item(missing_table):
+    expected, expected_count = search.search("budget", use_cache=False, collapse=False)
+    rows, total_count = search.search("budget", use_cache=False, collapse=True)
+    assert not search.collapse_available()
+    assert ids(rows) == ids(expected)
+    assert total_count == expected_count
+
+
+def test_table_dropped_after_the_lookup_falls_back(missing_table):
+    search._collapse_state["available"] = True
+    expected, _ = search.search("skole", use_cache=False, collapse=False)
+    rows, _ = search.search("skole", use_cache=False, collapse=True)
+    assert ids(rows) == ids(expected)
+    assert search._collapse_state["available"] is False
+
+
+def test_refresh_clusters_every_row():
+    assert dedup.cluster_after_refresh in refresh._callbacks
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"TRUNCATE {search.NEAR_DUPLICATES_TABLE}, {dedup.BUCKETS_TABLE}")
+    refresh.refresh_view(force=True)
+    with db_cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT COUNT(*) AS missing
+            FROM {search.VIEW_NAME} v
+            WHERE NOT EXISTS (SELECT 1 FROM {search.NEAR_DUPLICATES_TABLE} nd WHERE nd.id = v.id)
+            """
+        )
+        assert cur.fetchone()["missing"] == 0
+
+
+def test_new_row_bridging_two_stored_clusters_merges_them():
+    # Two decisions that share their first 19 words: too different to cluster (estimated Jaccard
+    # about 0.5), while the third item, halfway between them, is near both
+    common = ("Kommunalbestyrelsen godkender at skolen udvides med fire nye klasselokaler og et faglokale "
+              "til natur og teknologi finansieret af anlægspuljen ")
+    first = common + "i 2024 2025 og 2026 med tilskud fra staten til bygning"
+    second = common + "mens byggeriet udbydes i totalentreprise i foråret efter dialog med bestyrelsen"
+    bridge = common + "i 2024 2025 mens byggeriet udbydes"
+    signatures = {text: dedup.signature(dedup.shingles(text)) for text in (first, second, bridge)}
+    assert dedup.similarity(signatures[first], signatures[second]) < dedup.DEDUP_THRESHOLD
+    assert dedup.similarity(signatures[bridge], signatures[first]) >= dedup.DEDUP_THRESHOLD
+    assert dedup.similarity(signatures[bridge], signatures[second]) >= dedup.DEDUP_THRESHOLD
+
+    first_id, second_id, bridge_id = 9_000_001, 9_000_002, 9_000_003
+    # Not committed: the rows are rolled back when the connection goes back to the pool
+    with db_cursor() as cur:
+        assert dedup._cluster_chunk(cur, [{"id": first_id, "description": first}]) == (1, 0)
+        assert dedup._cluster_chunk(cur, [{"id": second_id, "description": second}]) == (1, 0)
+        assert dedup._cluster_chunk(cur, [{"id": bridge_id, "description": bridge}]) == (1, 1)
+        cur.execute(f"SELECT id, cluster_id FROM {search.NEAR_DUPLICATES_TABLE} WHERE id = ANY(%s) ORDER BY id",
+                    [[first_id, second_id, bridge_id]])
+        assert [(row["id"], row["cluster_id"]) for row in cur.fetchall()] == [
+            (first_id, first_id), (second_id, first_id), (bridge_id, first_id)]
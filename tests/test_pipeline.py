@@ -0,0 +1,143 @@
+import contextlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import pytest
+
+import pipeline
+import search
+from cache import search_cache
+from db import db_cursor
+
+
+class SlowTask:
+    """QueryTask stand-in whose statement finishes when the test releases it"""
+    started = []
+
+    def __init__(self, name, query, params, timeout_ms, fetch):
+        self.name = name
+        self.elapsed = None
+        self.release = threading.Event()
+        self.cancelled = False
+        SlowTask.started.append(self)
+
+    def run(self):
+        self.release.wait(timeout=5)
+        self.elapsed = 0.0
+        return 42 if self.name == "count" else {"municipality": [("Odense", 42)], "category": []}
+
+    def cancel(self):
+        self.cancelled = True
+        self.release.set()
+
+
+@pytest.fixture
+def slow_secondary(monkeypatch):
+    SlowTask.started = []
+    search_cache.clear()
+    monkeypatch.setattr(pipeline, "QueryTask", SlowTask)
+    monkeypatch.setattr(pipeline, "SECONDARY_GRACE", 0.05)
+    monkeypatch.setattr(search, "SEARCH_BACKEND", "postgres")
+    monkeypatch.setattr(search, "search", lambda *args, **kwargs: ([{"id": 1}], None))
+    yield
+    for task in SlowTask.started:
+        task.release.set()
+    search_cache.clear()
+
+
+def test_slow_count_and_facets_are_cancelled_after_the_grace_period(slow_secondary):
+    response = pipeline.search_page("budget", collapse=False)
+    assert response["rows"] == [{"id": 1}]
+    assert (response["total_count"], response["facets"]) == (None, None)
+    assert [task.cancelled for task in SlowTask.started] == [True, True]
+
+    # Nothing was cached, so the next search starts the queries again
+    pipeline.search_page("budget", collapse=False)
+    assert len(SlowTask.started) == 4
+
+
+class CountingPool:
+    """Pool stand-in that records how many connections are checked out at once"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.most_in_use = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self.lock:
+            self.in_use += 1
+            self.most_in_use = max(self.most_in_use, self.in_use)
+        try:
+            yield FakeConnection()
+        finally:
+            with self.lock:
+                self.in_use -= 1
+
+
+class FakeConnection:
+    def cursor(self):
+        return FakeCursor()
+
+    def cancel(self):
+        pass
+
+
+class FakeCursor:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, params=None):
+        time.sleep(0.02)
+
+
+def test_secondary_queries_hold_at_most_their_share_of_the_pool(monkeypatch):
+    pool = CountingPool()
+    monkeypatch.setattr(pipeline, "get_pool", lambda: pool)
+    monkeypatch.setattr(pipeline, "_secondary_slots", threading.BoundedSemaphore(2))
+
+    tasks = [pipeline.QueryTask("count", "SELECT 1", [], 1000, lambda cur: 1) for _ in range(8)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert list(executor.map(lambda task: task.run(), tasks)) == [1] * 8
+    assert pool.most_in_use == 2
+
+
+def test_cancelled_task_gives_up_waiting_for_a_slot(monkeypatch):
+    monkeypatch.setattr(pipeline, "get_pool", CountingPool)
+    monkeypatch.setattr(pipeline, "_secondary_slots", threading.BoundedSemaphore(1))
+    pipeline._secondary_slots.acquire()
+
+    task = pipeline.QueryTask("facets", "SELECT 1", [], 1000, lambda cur: 1)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(task.run)
+        task.cancel()
+        assert future.result(timeout=5) is None
+
+
+def sleeping_backends():
+    with db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) AS n FROM pg_stat_activity "
+                    "WHERE query = 'SELECT pg_sleep(5)' AND state = 'active'")
+        return cur.fetchone()["n"]
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+def test_cancel_stops_the_running_statement():
+    task = pipeline.QueryTask("count", "SELECT pg_sleep(5)", [], 10_000, lambda cur: cur.fetchone())
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(task.run)
+        # A cancel request only stops a statement that has reached the server
+        deadline = time.monotonic() + 5
+        while not sleeping_backends() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        task.cancel()
+        with pytest.raises(psycopg2.errors.QueryCanceled):
+            future.result(timeout=5)
+    assert task.elapsed < 4
@@ -0,0 +1,116 @@
+import threading
+import time
+
+import psycopg2
+import pytest
+
+import benchmark
+import db
+import refresh
+from db import db_cursor
+
+
+class IdleScheduler:
+    """RefreshScheduler stand-in that never touches the database"""
+
+    def __init__(self):
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def is_alive(self):
+        return self.started
+
+
+def test_scheduler_registers_every_refresh_callback(monkeypatch):
+    monkeypatch.setattr(refresh, "RefreshScheduler", IdleScheduler)
+    monkeypatch.setattr(refresh, "_scheduler", None)
+    scheduler = refresh.start_scheduler()
+    assert scheduler.started
+
+    import alerts
+    import dedup
+    import rollup
+    import snapshot
+
+    for callback in (snapshot.write_snapshot, rollup.refresh_category_rollup, rollup.refresh_category_trends,
+                     alerts.evaluate_new_rows, dedup.cluster_after_refresh):
+        assert callback in refresh._callbacks
+
+
+class NoProcessLock:
+    """Stands in for refresh._refresh_lock, so two threads contend like two processes would"""
+
+    def acquire(self, blocking=True):
+        return True
+
+    def release(self):
+        pass
+
+
+@pytest.fixture
+def counted_callbacks(monkeypatch):
+    """Replace the registered callbacks with one failing and one counting callback"""
+    calls = []
+
+    def failing(generation):
+        raise RuntimeError("callback failed")
+
+    monkeypatch.setattr(refresh, "_callbacks", [failing, calls.append])
+    return calls
+
+
+@pytest.fixture
+def blocked_source():
+    """Holds a lock on the table behind the view, so a REFRESH waits until the test releases it"""
+    conn = psycopg2.connect(dbname=db.DB_NAME, user=db.DB_USER, password=db.DB_PASSWORD, host=db.DB_HOST,
+                            port=db.DB_PORT)
+    with conn.cursor() as cur:
+        cur.execute(f"LOCK TABLE {benchmark.SYNTHETIC_TABLE} IN ACCESS EXCLUSIVE MODE")
+    yield conn
+    conn.rollback()
+    conn.close()
+
+
+def advisory_lock_held():
+    with db_cursor() as cur:
+        cur.execute("SELECT COUNT(*) AS held FROM pg_locks WHERE locktype = 'advisory' AND objid = %s AND granted",
+                    [refresh.REFRESH_LOCK_KEY])
+        return cur.fetchone()["held"] > 0
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+def test_concurrent_refreshes_run_once(monkeypatch, counted_callbacks, blocked_source):
+    monkeypatch.setattr(refresh, "_refresh_lock", NoProcessLock())
+    results = []
+    first = threading.Thread(target=lambda: results.append(refresh.refresh_view(force=True)))
+    first.start()
+    deadline = time.monotonic() + 10
+    while not advisory_lock_held():
+        assert time.monotonic() < deadline, "the first refresh never took the advisory lock"
+        time.sleep(0.05)
+
+    # The first refresh holds the advisory lock and waits on the source table
+    assert refresh.refresh_view(force=True) is None
+    blocked_source.rollback()
+    first.join(timeout=30)
+    assert results[0] is not None
+    assert counted_callbacks == [results[0]]
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+def test_unchanged_sources_are_refreshed_only_when_forced(monkeypatch, counted_callbacks):
+    generation = refresh.refresh_view(force=True)
+    assert generation is not None
+    assert refresh.refresh_view() is None
+
+    fingerprint = refresh._state["source_fingerprint"]
+    monkeypatch.setattr(refresh, "source_fingerprint", lambda cur: fingerprint + 1)
+    newer = refresh.refresh_view()
+    assert newer > generation
+    # The failing callback ran first and did not stop the next one
+    assert counted_callbacks == [generation, newer]
+    assert refresh.current_generation()[0] == newer
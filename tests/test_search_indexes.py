@@ -0,0 +1,43 @@
+import pytest
+
+import search
+from db import db_cursor
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+VECTOR_INDEX = "foraisearch_with_search_vector_gin"
+TRIGRAM_INDEX = "foraisearch_with_search_text_trgm_gin"
+
+
+def explain(build, query_text, **kwargs):
+    """
+    EXPLAIN (FORMAT JSON) plan of one of the search statements. Sequential
+    and plain index scans are disabled so the tiny test corpus is planned like
+    a large view (otherwise a full scan of any index is cheapest): the plan
+    only falls back to a Seq Scan when the match filter cannot use a bitmap
+    scan of the GIN indexes.
+    """
+    query, params = build(query_text, **kwargs)
+    query = query.replace(search.SET_THRESHOLD_SQL, "")
+    with db_cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        cur.execute("SET LOCAL enable_indexscan = off")
+        cur.execute(search.SET_THRESHOLD_SQL, params)
+        cur.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+        return cur.fetchone()["QUERY PLAN"][0]["Plan"]
+
+
+def node_types(plan):
+    types = {plan["Node Type"]}
+    for child in plan.get("Plans", []):
+        types |= node_types(child)
+    return types
+
+
+@pytest.mark.parametrize("build", [search.build_search_query, search.build_count_query, search.build_facet_query])
+@pytest.mark.parametrize("query_text", ["budget", "fjernvarme skole", "lokalplan*", "skolle"])
+def test_match_filter_uses_gin_indexes(build, query_text):
+    plan = explain(build, query_text)
+    assert {VECTOR_INDEX, TRIGRAM_INDEX} <= search.index_scans(plan)
+    assert "Seq Scan" not in node_types(plan)
+
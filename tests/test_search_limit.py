@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+
+import pytest
+
+import search
+
+
+class FakeCursor:
+    """Cursor that has far more rows than any page and records what was asked for"""
+
+    def __init__(self, n_rows):
+        self.rows = [{"id": i, "municipality": "Odense", "date": "2024-01-01", "subject_title": f"Punkt {i}",
+                      "ts_rank_score": 0.1, "similarity_score": 0.0, "score": 1.0 / (i + 1), "total_count": n_rows}
+                     for i in range(n_rows)]
+        self.params = None
+        self.fetch_sizes = []
+
+    def fetchmany(self, size=None):
+        self.fetch_sizes.append(size)
+        return [dict(row) for row in self.rows[:size]]
+
+    def fetchall(self):
+        raise AssertionError("search_postgres must not fetch an unbounded result")
+
+
+@pytest.fixture
+def cursor(monkeypatch):
+    cursor = FakeCursor(n_rows=1000)
+
+    @contextmanager
+    def fake_db_cursor(commit=False):
+        yield cursor
+
+    def fake_execute_prepared(cur, query, params, setup=""):
+        cur.params = params
+
+    monkeypatch.setattr(search, "db_cursor", fake_db_cursor)
+    monkeypatch.setattr(search, "execute_prepared", fake_execute_prepared)
+    return cursor
+
+
+@pytest.mark.parametrize("limit", [1, 20, search.MAX_SEARCH_LIMIT, search.MAX_SEARCH_LIMIT * 10, 0, -5])
+def test_rendered_rows_never_exceed_limit(cursor, limit):
+    rows, total_count = search.search_postgres("budget", limit=limit)
+
+    assert len(rows) <= search.clamp_limit(limit) <= search.MAX_SEARCH_LIMIT
+    assert cursor.params["limit"] == search.clamp_limit(limit)
+    assert cursor.fetch_sizes == [search.clamp_limit(limit)]
+    assert total_count == 1000
+    assert all("total_count" not in row for row in rows)
+
+
+def test_without_count(cursor):
+    rows, total_count = search.search_postgres("budget", limit=5, with_count=False)
+    assert len(rows) == 5
+    assert total_count is None
+
+
+def test_clamp_limit():
+    assert search.clamp_limit(0) == 1
+    assert search.clamp_limit("20") == 20
+    assert search.clamp_limit(search.MAX_SEARCH_LIMIT + 1) == search.MAX_SEARCH_LIMIT
+
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+@pytest.mark.parametrize("collapse", [False, True])
+def test_count_stops_after_the_cap(monkeypatch, collapse):
+    _, exact = search.search("budget", use_cache=False, collapse=False)
+    assert exact > 3
+    monkeypatch.setattr(search, "COUNT_CAP", 3)
+    _, total_count = search.search("budget", use_cache=False, collapse=collapse)
+    assert total_count == 4
+    assert search.count_is_capped(total_count)
+
+    query, params = search.build_count_query("budget", collapse=collapse)
+    with search.db_cursor() as cur:
+        cur.execute(query, params)
+        assert cur.fetchone()["total_count"] == 4
+
+    # Under the cap the count is exact
+    _, total_count = search.search("svømmehal", use_cache=False, collapse=collapse)
+    assert total_count == 1
+    assert not search.count_is_capped(total_count)
@@ -0,0 +1,61 @@
+import pytest
+
+import benchmark
+import refresh
+import search
+from db import db_cursor
+
+pytestmark = pytest.mark.db
+
+TRIGRAM_INDEX = "foraisearch_with_search_text_trgm_gin"
+
+# Synthetic rows added to the test corpus, so the planner sees a view of benchmark size
+BENCHMARK_ROWS = 20_000
+# The smallest municipalities, each well under 1% of the synthetic rows
+SELECTIVE_QUERIES = benchmark.MUNICIPALITIES[-3:]
+MAX_SCANNED_SHARE = 0.1
+KEYWORD_QUERIES = [query for shape, query in benchmark.DEFAULT_QUERIES.items() if shape != "typo"]
+
+
+@pytest.fixture(scope="module")
+def benchmark_corpus(database):
+    """The test corpus plus BENCHMARK_ROWS rows from the benchmark generator; removed again afterwards"""
+    with pytest.MonkeyPatch.context() as patch:
+        # The refresh callbacks (clustering, snapshot, ...) are not under test here
+        patch.setattr(refresh, "_callbacks", [])
+        benchmark.generate(BENCHMARK_ROWS)
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"ANALYZE {search.VIEW_NAME}")
+        cur.execute(f"SELECT COUNT(*) AS n FROM {search.VIEW_NAME}")
+        view_rows = cur.fetchone()["n"]
+    yield view_rows
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"DELETE FROM {benchmark.SYNTHETIC_TABLE} WHERE id > %s", [len(database)])
+        cur.execute(f"ANALYZE {benchmark.SYNTHETIC_TABLE}")
+    refresh.refresh_view(force=True)
+    with db_cursor(commit=True) as cur:
+        cur.execute(f"ANALYZE {search.VIEW_NAME}")
+
+
+def index_loops(plan, index_name):
+    """Total Actual Loops of the scans of `index_name` in an EXPLAIN ANALYZE plan"""
+    loops = plan["Actual Loops"] if plan.get("Index Name") == index_name else 0
+    return loops + sum(index_loops(child, index_name) for child in plan.get("Plans", []))
+
+
+@pytest.mark.parametrize("query_text", SELECTIVE_QUERIES)
+def test_selective_search_reads_a_fraction_of_the_view(benchmark_corpus, query_text):
+    plan = search.explain_search(query_text, analyze=True)
+    assert benchmark.scan_stats(plan)["rows_scanned"] < MAX_SCANNED_SHARE * benchmark_corpus
+
+
+@pytest.mark.parametrize("query_text", KEYWORD_QUERIES)
+def test_fuzzy_arm_only_runs_without_keyword_matches(benchmark_corpus, query_text):
+    plan = search.explain_search(query_text, analyze=True)
+    assert index_loops(plan, TRIGRAM_INDEX) == 0
+
+
+def test_misspelled_word_falls_back_to_fuzzy_matching(benchmark_corpus):
+    rows, _ = search.search(benchmark.DEFAULT_QUERIES["typo"], with_count=False, use_cache=False, collapse=False)
+    assert rows
+    assert all(row["ts_rank_score"] == 0 and row["similarity_score"] > 0 for row in rows)
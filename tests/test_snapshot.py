@@ -0,0 +1,21 @@
+import pytest
+
+import rollup
+import snapshot
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+
+@pytest.fixture
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "SNAPSHOT_DIR", str(tmp_path))
+    monkeypatch.setattr(snapshot, "_open", {"path": None, "dataset": None, "meta": None})
+    return tmp_path
+
+
+def test_municipalities_from_the_partitions_match_the_view(snapshot_dir):
+    snapshot.write_snapshot(generation=1)
+    dataset = snapshot.open_snapshot(generation=1)
+    live = [name for name in rollup._live_municipalities() if name is not None]
+    assert snapshot.municipalities(dataset) == live
+    assert len(live) > 1
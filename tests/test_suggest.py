@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+import refresh
+import suggest
+
+
+@pytest.fixture
+def slow_build(monkeypatch):
+    """build_index that finishes when the test releases it, or fails when told to"""
+    release = threading.Event()
+    calls = []
+
+    def build_index(generation=None):
+        calls.append(generation)
+        release.wait(timeout=5)
+        if build_index.fail:
+            raise RuntimeError("database unavailable")
+        return suggest.PrefixIndex(["budget", "budgetopfølgning", "skole"], [10, 3, 7], generation)
+
+    build_index.fail = False
+    monkeypatch.setattr(suggest, "build_index", build_index)
+    monkeypatch.setattr(refresh, "current_generation", lambda: (1, None))
+    yield release, calls, build_index
+    release.set()
+
+
+def wait_for_build(suggester):
+    with suggester._build_lock:
+        pass
+
+
+def test_no_suggestions_until_the_background_build_is_done(slow_build):
+    release, calls, _ = slow_build
+    suggester = suggest.Suggester()
+    assert suggester.suggest("bud") == []
+    assert suggester.suggest("bud") == []
+    assert len(calls) == 1
+
+    release.set()
+    wait_for_build(suggester)
+    assert suggester.suggest("bud") == [("budget", 10), ("budgetopfølgning", 3)]
+
+
+def test_failed_build_is_not_retried_on_every_keystroke(slow_build, monkeypatch):
+    release, calls, build_index = slow_build
+    build_index.fail = True
+    release.set()
+    suggester = suggest.Suggester()
+    assert suggester.suggest("bud") == []
+    wait_for_build(suggester)
+    assert suggester.suggest("bud") == []
+    assert len(calls) == 1
+
+    monkeypatch.setattr(suggest, "SUGGEST_RETRY_INTERVAL", 0)
+    build_index.fail = False
+    suggester.suggest("bud")
+    wait_for_build(suggester)
+    assert suggester.suggest("sko") == [("skole", 7)]
+    assert len(calls) == 2
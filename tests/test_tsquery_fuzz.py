@@ -0,0 +1,108 @@
+import random
+import re
+
+import pytest
+
+from tsquery import lexeme, parse_query
+
+# Characters users type, including everything that is special to to_tsquery
+PIECES = ["budget", "skole", "ældre", "fjernvarm*", "OR", "NOT", "or", "not", "-", "!", "&", "|", ":", ":*",
+          "(", ")", '"', "'", "\\", "<->", "<2>", "*", "''", "-ny", '"ny skole', "a:b", "x&y", "æøå", "1.000",
+          "lokalplan-forslag", "'; DROP TABLE x; --", "\t", " ", " ", "é", "日本"]
+
+LEXEME_RE = re.compile(r"'(?:[^'\\]|''|\\.)+'(?::\*)?")
+TOKEN_RE = re.compile(r"\s*(?:(?P<lexeme>'(?:[^'\\]|''|\\.)*'(?::\*)?)|(?P<op><->|[&|()]))")
+
+
+def tokens(tsquery):
+    position, result = 0, []
+    while position < len(tsquery.rstrip()):
+        match = TOKEN_RE.match(tsquery, position)
+        assert match, f"unexpected text at {position} in {tsquery!r}"
+        result.append(match.group("lexeme") or match.group("op"))
+        position = match.end()
+    return result
+
+
+def assert_valid_tsquery(tsquery):
+    """
+    Recursive descent over the subset of the tsquery grammar that parse_query
+    emits: quoted lexemes (optionally :*) combined with & | <-> and parentheses.
+    """
+    stream = tokens(tsquery)
+    position = 0
+
+    def operand():
+        nonlocal position
+        assert position < len(stream), f"operand expected at the end of {tsquery!r}"
+        token = stream[position]
+        position += 1
+        if token == "(":
+            expression()
+            assert position < len(stream) and stream[position] == ")", f"unbalanced parenthesis in {tsquery!r}"
+            position += 1
+        else:
+            assert LEXEME_RE.fullmatch(token), f"{token!r} is not a lexeme in {tsquery!r}"
+
+    def expression():
+        nonlocal position
+        operand()
+        while position < len(stream) and stream[position] in ("&", "|", "<->"):
+            position += 1
+            operand()
+
+    expression()
+    assert position == len(stream), f"trailing tokens in {tsquery!r}"
+
+
+def random_queries(n, seed):
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield "".join(rng.choice(PIECES) + rng.choice(["", " "]) for _ in range(rng.randint(0, 10)))
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_parse_query_output_always_parses(seed):
+    for query_text in random_queries(2000, seed):
+        parsed = parse_query(query_text)
+        for part in (parsed.match, parsed.prefix, parsed.exclude):
+            if part:
+                assert_valid_tsquery(part)
+        # A query with something to exclude but nothing to match never reaches the database as a match
+        assert bool(parsed.match) == bool(parsed.prefix) == bool(parsed.positive)
+        assert bool(parsed.exclude) == bool(parsed.excluded)
+
+
+def test_lexeme_escapes_quotes_and_backslashes():
+    rng = random.Random(0)
+    alphabet = "ab'\\:*&|!() æ"
+    for _ in range(2000):
+        word = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 8)))
+        for prefix in (False, True):
+            quoted = lexeme(word, prefix)
+            assert LEXEME_RE.fullmatch(quoted), quoted
+            assert quoted.endswith(":*") == prefix
+
+
+@pytest.mark.parametrize("query_text, match, exclude", [
+    ("budget skole", "'budget' & 'skole'", ""),
+    ("budget OR skole", "('budget' | 'skole')", ""),
+    ("budget -skole", "'budget'", "'skole'"),
+    ("NOT skole budget", "'budget'", "'skole'"),
+    ('"ny skole"', "('ny' <-> 'skole')", ""),
+    ("fjernvarm*", "'fjernvarm':*", ""),
+    ("it's", "('it' <-> 's')", ""),
+    ("& | ! ( ) :", "", ""),
+])
+def test_known_queries(query_text, match, exclude):
+    parsed = parse_query(query_text)
+    assert parsed.match == match
+    assert parsed.exclude == exclude
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures("database")
+def test_to_tsquery_accepts_random_queries():
+    import tsquery
+
+    assert tsquery.fuzz(iterations=2000, seed=0) == []
@@ -0,0 +1,41 @@
+import pytest
+
+import pipeline
+import search
+import warmup
+from cache import search_cache
+
+pytestmark = [pytest.mark.db, pytest.mark.usefixtures("database")]
+
+
+def test_warm_up_caches_the_apps_first_result_page(monkeypatch):
+    search_cache.clear()
+    timings = warmup.warm_up(queries=["budget"], in_process=False)
+    assert timings["search budget"] is not None
+
+    def no_query(*args, **kwargs):
+        raise AssertionError("the first result page was not served from the cache")
+
+    monkeypatch.setattr(search, "search_postgres", no_query)
+    monkeypatch.setattr(pipeline, "QueryTask", no_query)
+    # What app.py asks for on the first page of a new search with the default settings
+    response = pipeline.search_page("Budget", municipality="Alle", limit=pipeline.RESULTS_PER_PAGE,
+                                    collapse=search.COLLAPSE_DUPLICATES)
+    assert response["rows"]
+    assert response["total_count"] is not None
+    assert response["facets"] is not None
+    search_cache.clear()
+
+
+def test_altair_is_imported_after_the_first_page_is_warm(monkeypatch):
+    steps = []
+    monkeypatch.setattr(warmup, "_step", lambda timings, name, func, *args, **kwargs: steps.append(name))
+    monkeypatch.setattr(warmup, "_started", False)
+    warmup.warm_up(queries=["budget"])
+    assert steps[-1] == "import altair"
+    assert steps.index("search budget") < steps.index("import altair")
+    assert "altair" not in warmup.HEAVY_MODULES
+
+    # A process that has warmed up does not start the background warm-up as well
+    monkeypatch.setattr(warmup.threading, "Thread", None)
+    warmup.start()
@@ -0,0 +1,175 @@
+"""
+Oversættelse af søgefeltets tekst til gyldig tsquery-syntaks.
+
+Understøtter:
+    budget skole          begge ord (AND)
+    budget OR skole       et af ordene (også "|")
+    -skole / NOT skole    uden ordet
+    "ny skole"            ordene lige efter hinanden (frase)
+    fjernvarm*            ord der begynder med "fjernvarm"
+
+Alt andet (tegn som & ! : ( ) ' \\) fjernes, så to_tsquery aldrig får en
+ugyldig forespørgsel. Tjek mod databasen med tilfældige forespørgsler:
+    python tsquery.py fuzz --iterations 10000
+"""
+import argparse
+import random
+import re
+
+# Quoted phrase (an unterminated quote runs to the end) or a run of non-space characters
+TOKEN_RE = re.compile(r'(-|!)?"([^"]*)"?|(\S+)')
+WORD_RE = re.compile(r"\w+")
+
+
+class ParsedQuery:
+    """
+    The parts of a search query as tsquery strings, each one valid input for
+    to_tsquery() (or empty when there is nothing to match):
+
+    match    OR-groups joined by AND, with phrases and explicit prefixes
+    prefix   every positive word as a prefix, OR'ed (the loose "word:*" match)
+    exclude  the NOT terms OR'ed, to be filtered out with NOT ... @@
+
+    The same terms are kept as (words, is_prefix) tuples for backends that do
+    not speak tsquery (bm25.py): `groups` is the list of AND'ed OR-groups and
+    `excluded` the NOT terms; a term with several words is a phrase.
+    """
+
+    def __init__(self, match="", prefix="", exclude="", groups=(), excluded=()):
+        self.match = match
+        self.prefix = prefix
+        self.exclude = exclude
+        self.groups = [list(group) for group in groups]
+        self.excluded = list(excluded)
+
+    @property
+    def positive(self):
+        """Every positive term, across the OR-groups"""
+        return [term for group in self.groups for term in group]
+
+    def __repr__(self):
+        return f"ParsedQuery(match={self.match!r}, prefix={self.prefix!r}, exclude={self.exclude!r})"
+
+
+def lexeme(word, prefix=False):
+    """A single quoted tsquery lexeme; quotes and backslashes are escaped by doubling/escaping"""
+    quoted = "'" + word.replace("\\", "\\\\").replace("'", "''") + "'"
+    return quoted + ":*" if prefix else quoted
+
+
+def _term(words, prefix=False):
+    """One word, or a phrase of words that must follow each other"""
+    if len(words) == 1:
+        return lexeme(words[0], prefix)
+    return "(" + " <-> ".join(lexeme(word) for word in words[:-1]) + " <-> " + lexeme(words[-1], prefix) + ")"
+
+
+def _group(terms, operator):
+    if len(terms) == 1:
+        return terms[0]
+    return "(" + f" {operator} ".join(terms) + ")"
+
+
+def parse_query(query_text):
+    """Tokenize the search box text into a ParsedQuery"""
+    groups = []  # list of OR-groups; the groups are AND'ed
+    prefix_terms = []
+    excluded = []
+    word_groups = []  # the same terms as (words, is_prefix)
+    excluded_words = []
+    negate = False
+    join_or = False
+
+    for match in TOKEN_RE.finditer(query_text or ""):
+        phrase_negation, phrase, token = match.groups()
+        if token is not None:
+            if token.upper() == "OR" or token == "|":
+                join_or = bool(groups)
+                continue
+            if token.upper() == "NOT":
+                negate = True
+                continue
+            if token[0] in "-!":
+                negate = True
+                token = token[1:]
+            is_prefix = token.endswith("*")
+            words = WORD_RE.findall(token.lower())
+            if len(words) > 1:
+                # Hyphenated or punctuated words, e.g. "lokalplan-forslag"
+                term, loose = _term(words, is_prefix), [_term(words, True)]
+            elif words:
+                term, loose = lexeme(words[0], is_prefix), [lexeme(words[0], True)]
+        else:
+            negate = negate or bool(phrase_negation)
+            words = WORD_RE.findall(phrase.lower())
+            is_prefix = False
+            if words:
+                term = _term(words)
+                loose = [term]
+
+        if not words:
+            negate = join_or = False
+            continue
+
+        if negate:
+            excluded.append(term)
+            excluded_words.append((tuple(words), is_prefix))
+        elif join_or:
+            groups[-1].append(term)
+            word_groups[-1].append((tuple(words), is_prefix))
+            prefix_terms.extend(loose)
+        else:
+            groups.append([term])
+            word_groups.append([(tuple(words), is_prefix)])
+            prefix_terms.extend(loose)
+        negate = join_or = False
+
+    return ParsedQuery(
+        match=" & ".join(_group(group, "|") for group in groups),
+        prefix=" | ".join(prefix_terms),
+        exclude=" | ".join(excluded),
+        groups=word_groups,
+        excluded=excluded_words,
+    )
+
+
+def fuzz(iterations=10000, seed=None):
+    """
+    Parse random strings built from words and tsquery operator characters and
+    check every non-empty result with to_tsquery() in the database.
+    Returns the list of (query_text, error) that failed.
+    """
+    from db import db_cursor
+
+    rng = random.Random(seed)
+    pieces = ["budget", "skole", "ældre", "fjernvarm*", "OR", "NOT", "or", "-", "!", "&", "|", ":", ":*",
+              "(", ")", '"', "'", "\\", "<->", "*", "''", "-ny", '"ny skole', "a:b", "x&y", "æøå", "1.000", " "]
+    failures = []
+    with db_cursor() as cur:
+        for _ in range(iterations):
+            query_text = "".join(rng.choice(pieces) + rng.choice(["", " "]) for _ in range(rng.randint(1, 8)))
+            parsed = parse_query(query_text)
+            try:
+                for part in (parsed.match, parsed.prefix, parsed.exclude):
+                    if part:
+                        cur.execute("SELECT to_tsquery('danish', %s)", [part])
+            except Exception as e:
+                cur.connection.rollback()
+                failures.append((query_text, str(e).strip()))
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    fuzz_parser = subparsers.add_parser("fuzz", help="check random queries against to_tsquery in the database")
+    fuzz_parser.add_argument("--iterations", type=int, default=10000)
+    fuzz_parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    failures = fuzz(args.iterations, args.seed)
+    for query_text, error in failures[:20]:
+        print(f"{query_text!r}: {error}")
+    print(f"{args.iterations} queries, {len(failures)} failures")
+    if failures:
+        raise SystemExit(1)
@@ -0,0 +1,128 @@
+"""
+Opvarmning, så de første brugere ikke betaler for kolde caches.
+
+Serverprocesserne varmer deres egne caches op: API'et før det begynder at
+lytte, Streamlit-processen i baggrunden ved første session (start()). Begge
+henter view'ets generation, kommuneliste, rollup, trends og forslagsindeks og
+kører de første resultatsider for WARMUP_QUERIES præcis som appen gør, så
+appens første søgninger rammer cachen.
+
+startup.sh kører desuden dette, før serverne starter:
+    python warmup.py
+
+Som egen proces gemmes kun det, der overlever processen: modulerne
+kompileres til bytecode, et manglende snapshot skrives (så kommunelisten kan
+læses uden database), og forespørgslerne køres én gang, så Postgres har
+siderne i sine buffere. Processens egne caches smides væk, så tunge imports
+og forslagsindekset springes over.
+"""
+import argparse
+import compileall
+import importlib
+import logging
+import os
+import threading
+import time
+
+import metrics
+import pipeline
+import refresh
+import rollup
+import snapshot
+import suggest
+
+# =====================
+# Warm-up Settings
+# =====================
+WARMUP_QUERIES = [query for query in os.getenv("WARMUP_QUERIES", "budget,lokalplan,fjernvarme,skole").split(",")
+                  if query.strip()]
+# Needed by the first page view
+HEAVY_MODULES = ("pandas", "pyarrow.parquet")
+# Only needed by the "Populære emner" page; imported last, once everything the first page view
+# uses is warm, so a user who opens that page later does not wait for it
+LATE_MODULES = ("altair",)
+
+logger = logging.getLogger(__name__)
+
+_started = False
+_start_lock = threading.Lock()
+
+
+def _step(timings, name, func, *args, **kwargs):
+    """Run one warm-up step; a failing step is logged and recorded as None"""
+    started = time.perf_counter()
+    try:
+        with metrics.without_explain():
+            func(*args, **kwargs)
+    except Exception:
+        logger.exception("Warm-up step %s failed", name)
+        timings[name] = None
+        return
+    timings[name] = (time.perf_counter() - started) * 1000
+
+
+def ensure_snapshot():
+    """Write a snapshot for the current generation if there is no fresh one"""
+    generation, _ = refresh.current_generation()
+    if generation is not None and snapshot.open_snapshot(generation) is None:
+        snapshot.write_snapshot(generation)
+
+
+def warm_up(queries=WARMUP_QUERIES, write_snapshot=False, in_process=True):
+    """
+    Load everything the first page views need into this process's caches
+    (and Postgres' buffers). The searches are the app's first result pages
+    (pipeline.search_page with its limit and default collapsing), so they are
+    cached under the keys the app looks up. Without `in_process` only the
+    steps that help other processes run. Returns the time of each step in ms,
+    None for steps that failed; a failing database never stops the warm-up.
+    """
+    global _started
+    timings = {}
+    if in_process:
+        # start() has nothing left to do in a process that warms up itself (the API, loadtest.py)
+        with _start_lock:
+            _started = True
+        for module in HEAVY_MODULES:
+            _step(timings, f"import {module}", importlib.import_module, module)
+    _step(timings, "generation", refresh.load_generation)
+    if write_snapshot:
+        _step(timings, "snapshot", ensure_snapshot)
+    _step(timings, "municipalities", rollup.load_municipalities)
+    _step(timings, "category_rollup", rollup.load_category_rollup)
+    _step(timings, "category_trends", rollup.load_category_trends)
+    if in_process:
+        _step(timings, "suggestions", suggest.get_suggester().build)
+    for query_text in queries:
+        _step(timings, f"search {query_text}", pipeline.search_page, query_text, limit=pipeline.RESULTS_PER_PAGE)
+    if in_process:
+        for module in LATE_MODULES:
+            _step(timings, f"import {module}", importlib.import_module, module)
+    logger.info("Warm-up done: %s", ", ".join(
+        f"{name} {'failed' if ms is None else f'{ms:.0f} ms'}" for name, ms in timings.items()))
+    return timings
+
+
+def start():
+    """
+    Warm this process up in a background thread, once, unless it has already
+    warmed up; safe to call on every rerun
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--no-snapshot", action="store_true", help="do not write a missing snapshot")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # Bytecode for all modules, so the first import in the server does not compile them
+    compileall.compile_dir(os.path.dirname(os.path.abspath(__file__)), maxlevels=0, quiet=1)
+    for name, ms in warm_up(write_snapshot=not args.no_snapshot, in_process=False).items():
+        print(f"{name:<32} {'failed' if ms is None else f'{ms:8.0f} ms'}")